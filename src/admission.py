@@ -0,0 +1,280 @@
+# ================================================
+# Admission control for the conversion pipeline.
+
+#   async with dbLimiter.slot():
+#       ...
+#   order = await xmlLimiter.run(xml_to_json, document)
+
+# Each kind of work has its own limiter: DB-bound
+# (a request's connection and queries), XML-bound (lxml
+# parsing) and PDF-bound (weasyprint rendering). A limiter
+# lets `limit` callers in at a time and queues up to
+# `queueSize` more, first come first served. When the
+# queue is full the caller is turned away at once with
+# Overloaded (429); a caller that queues for longer than
+# `maxWait` seconds gets Overloaded (503). Both carry a
+# Retry-After estimated from the queue length and the
+# average time a slot is held. Rejecting early keeps a
+# burst from slowing every request in the process down
+# together.
+
+# Waits are capped by the request deadline
+# (src/requestDeadline.py). The limiters are module level
+# and outlive any one event loop (each Lambda invocation
+# and test runs its own asyncio.run), while their waiter
+# futures belong to the loop that made them, so slots and
+# queues are kept per running loop; a new loop starts with
+# a free limiter and the state of closed loops is dropped.
+# admissionSnapshot() reports queue depth, wait times and
+# rejections per limiter.
+# ================================================
+
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from src.dbMetrics import LatencyHistogram
+from src.requestDeadline import DeadlineExceeded, timeoutFor, withinDeadline
+from src.stageTiming import currentTimer
+
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"
+ADMISSION_DB_LIMIT = int(os.getenv("ADMISSION_DB_LIMIT", "32"))
+ADMISSION_XML_LIMIT = int(
+    os.getenv("ADMISSION_XML_LIMIT", str(os.cpu_count() or 4))
+)
+ADMISSION_PDF_LIMIT = int(os.getenv("ADMISSION_PDF_LIMIT", "2"))
+# callers allowed to wait, per limiter, on top of the ones admitted
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+# seconds a caller may wait for a slot
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+
+
+class Overloaded(Exception):
+    """A limiter turned the caller away"""
+
+    def __init__(self, limiter, statusCode, retryAfter, reason):
+        super().__init__(f"{limiter} {reason}")
+        self.limiter = limiter
+        self.statusCode = statusCode
+        self.retryAfter = retryAfter
+        self.reason = reason
+
+    def response(self):
+        """Lambda-style 429 / 503 response with Retry-After"""
+        return {
+            "statusCode": self.statusCode,
+            "headers": {"Retry-After": str(self.retryAfter)},
+            "body": json.dumps({
+                "error": f"Server busy: {self.reason}, retry later",
+                "limiter": self.limiter,
+            }),
+        }
+
+
+class LoopQueue:
+    """Slots taken and callers waiting, on one event loop"""
+
+    def __init__(self):
+        self.active = 0
+        self.waiters = deque()
+
+
+class AdmissionLimiter:
+    """
+    At most `limit` holders, a bounded FIFO wait queue, and
+    fail-fast rejection.
+    """
+
+    def __init__(self, name, limit, queueSize=ADMISSION_QUEUE_SIZE,
+                 maxWait=ADMISSION_MAX_WAIT, enabled=True):
+        self.name = name
+        self.limit = limit
+        self.queueSize = queueSize
+        self.maxWait = maxWait
+        self.enabled = enabled and limit > 0
+        # event loop -> LoopQueue
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def queue(self):
+        """The running loop's LoopQueue, made on first use"""
+        loop = asyncio.get_running_loop()
+        queue = self.queues.get(loop)
+        if queue is None:
+            with self.lock:
+                for closed in [key for key in self.queues
+                               if key.is_closed()]:
+                    del self.queues[closed]
+                queue = self.queues.setdefault(loop, LoopQueue())
+        return queue
+
+    def reset(self):
+        with self.lock:
+            self.admitted = 0
+            self.rejectedFull = 0
+            self.rejectedTimeout = 0
+            self.maxQueued = 0
+            self.waitTime = LatencyHistogram()
+            self.holdTotal = 0.0
+            self.holdCount = 0
+
+    def retryAfter(self):
+        """Seconds until a slot is likely free, at least 1"""
+        with self.lock:
+            hold = self.holdTotal / self.holdCount if self.holdCount else 1.0
+        rounds = (len(self.queue().waiters) + 1) / max(self.limit, 1)
+        return max(1, math.ceil(rounds * hold))
+
+    # ===========================================
+    # Purpose: Take a slot, queueing for one if needed
+
+    # Argument: None
+
+    # Return: None, raises Overloaded when the queue is full
+    # or the wait runs past maxWait
+    # ============================================
+    async def acquire(self):
+        if not self.enabled:
+            return
+        startedAt = time.perf_counter()
+        queue = self.queue()
+        if queue.active < self.limit and not queue.waiters:
+            queue.active += 1
+            self.recordAdmission(0.0)
+            return
+        if len(queue.waiters) >= self.queueSize:
+            with self.lock:
+                self.rejectedFull += 1
+            raise Overloaded(self.name, 429, self.retryAfter(),
+                             "queue is full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.waiters.append(waiter)
+        with self.lock:
+            self.maxQueued = max(self.maxQueued, len(queue.waiters))
+        # the request's own deadline can be shorter than maxWait
+        maxWait = timeoutFor(self.maxWait)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), maxWait)
+        except asyncio.TimeoutError:
+            self.abandon(waiter)
+            with self.lock:
+                self.rejectedTimeout += 1
+            if maxWait < self.maxWait:
+                raise DeadlineExceeded(f"{self.name}_queue") from None
+            raise Overloaded(self.name, 503, self.retryAfter(),
+                             "timed out waiting")
+        except BaseException:
+            self.abandon(waiter)
+            raise
+        waited = (time.perf_counter() - startedAt) * 1000
+        self.recordAdmission(waited)
+        timer = currentTimer()
+        if timer is not None:
+            timer.add(f"{self.name}_queue", waited)
+
+    def recordAdmission(self, waitedMs):
+        with self.lock:
+            self.admitted += 1
+            self.waitTime.record(waitedMs)
+
+    def abandon(self, waiter):
+        """Leave the queue; a slot already handed over is passed on"""
+        if waiter.done() and not waiter.cancelled():
+            self.release()
+        else:
+            waiter.cancel()
+            try:
+                self.queue().waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def release(self, heldMs=None):
+        if not self.enabled:
+            return
+        if heldMs is not None:
+            with self.lock:
+                self.holdTotal += heldMs / 1000
+                self.holdCount += 1
+        queue = self.queue()
+        # the slot goes straight to the next waiter, so a newcomer
+        # cannot jump the queue
+        while queue.waiters:
+            waiter = queue.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        queue.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold a slot for the duration of the block"""
+        await self.acquire()
+        heldSince = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.release((time.perf_counter() - heldSince) * 1000)
+
+    async def run(self, func, *args):
+        """
+        func(*args) on a worker thread while holding a slot. A thread
+        cannot be stopped, so when the caller gives up (deadline,
+        cancellation) the slot stays taken until the thread is done.
+        """
+        await self.acquire()
+        heldSince = time.perf_counter()
+        work = asyncio.ensure_future(asyncio.to_thread(func, *args))
+
+        def finished(work):
+            if not work.cancelled():
+                work.exception()
+            self.release((time.perf_counter() - heldSince) * 1000)
+
+        work.add_done_callback(finished)
+        return await withinDeadline(asyncio.shield(work), self.name)
+
+    def snapshot(self):
+        with self.lock:
+            queues = list(self.queues.values())
+            return {
+                "limit": self.limit,
+                "queue_size": self.queueSize,
+                "active": sum(queue.active for queue in queues),
+                "queued": sum(len(queue.waiters) for queue in queues),
+                "max_queued": self.maxQueued,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejectedFull,
+                "rejected_timeout": self.rejectedTimeout,
+                "wait": self.waitTime.snapshot(),
+                "mean_hold_ms": (
+                    self.holdTotal / self.holdCount * 1000
+                    if self.holdCount else 0.0
+                ),
+            }
+
+
+dbLimiter = AdmissionLimiter("db", ADMISSION_DB_LIMIT,
+                             enabled=ADMISSION_ENABLED)
+xmlLimiter = AdmissionLimiter("xml", ADMISSION_XML_LIMIT,
+                              enabled=ADMISSION_ENABLED)
+pdfLimiter = AdmissionLimiter("pdf", ADMISSION_PDF_LIMIT,
+                              enabled=ADMISSION_ENABLED)
+LIMITERS = (dbLimiter, xmlLimiter, pdfLimiter)
+
+
+def admissionSnapshot():
+    """Queue depth, wait times and rejections per limiter"""
+    return {limiter.name: limiter.snapshot() for limiter in LIMITERS}
+
+
+def resetAdmissionStats():
+    for limiter in LIMITERS:
+        limiter.reset()
@@ -1,26 +1,87 @@
+import asyncio
+import contextvars
 import json
-from src.mongodb import dbConnect, getOrderInfo
+import os
+from src.admission import Overloaded, dbLimiter, xmlLimiter
+from src.mongodb import dbConnect, deleteOrder, jsonDefault, releaseClient
 from src.despatch.despatchCreate import (
     create_despatch_advice,
+    delete_despatch_advice,
+    get_despatch_xml,
     validate_despatch_advice
 )
 from src.despatch.orderCreate import (
     validate_order_document,
-    create_order
+    create_order,
+    insert_orders
 )
 from src.despatch.xmlConversion import json_to_xml
 from src.despatch.despatchSupplier import despatchSupplier
 from src.despatch.deliveryCustomer import deliveryCustomer
 from src.despatch.OrderReference import create_order_reference
-from src.despatch.despatchLine import despatchLine
+from src.despatch.despatchLine import DespatchLineError, despatchLines
 from src.despatch.shipment import create_shipment
+from src.despatch.orderContext import OrderContext
+from src.idGenerator import SHIPMENT_PREFIX, withFreshId
+from src.idempotency import requestKey, runOnce
+from src.jobQueue import JobWorkerPool, currentJobId, jobStatus, submitJob
+from src.requestDeadline import isTimeout, timeoutResponse, withDeadline
+from src.queryBudget import (
+    ENDPOINT_QUERY_BUDGET,
+    QueryBudget,
+    currentBudget,
+    queryBudget,
+)
+from src.stageTiming import StageTimer, stage, timed
+
+# orders of one batch processed at the same time
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+# seconds a queued despatch job may run; no client is waiting on it,
+# so it gets longer than REQUEST_DEADLINE_SECONDS
+DESPATCH_JOB_DEADLINE = float(os.getenv("DESPATCH_JOB_DEADLINE", "300"))
+
+# fields of the endpointFunc response per profile; each profile
+# returns a subset of the next one. "full" is the original response,
+# with the despatch document in it three times (despatch_data, its
+# XML and despatch_xml). Below "full", despatch and shipment leave
+# out the documents the XML already carries, so "minimal" is the
+# order, despatch and validation summaries and a single copy of the
+# XML.
+RESPONSE_PROFILES = {
+    "minimal": ("order", "despatch", "despatch_xml", "validation"),
+    "standard": (
+        "order", "despatch", "despatch_xml", "validation",
+        "delivery_period", "backordering", "shipment", "despatch_line",
+    ),
+    "full": (
+        "order", "despatch", "despatch_xml", "validation",
+        "delivery_period", "backordering", "shipment", "despatch_line",
+    ),
+}
+# fields only returned when asked for with fields=
+EXTRA_RESPONSE_FIELDS = (
+    "order_id", "uuid", "despatch_id", "status", "validation_status",
+    "db_queries",
+)
+RESPONSE_FIELDS = frozenset(EXTRA_RESPONSE_FIELDS).union(
+    *RESPONSE_PROFILES.values()
+)
+DEFAULT_RESPONSE_PROFILE = os.getenv("RESPONSE_PROFILE", "full")
 
 
+@queryBudget(limit=ENDPOINT_QUERY_BUDGET)
+@withDeadline()
 async def endpointFunc(
     xmlDoc: str,
     shipment: dict,
     despatch: dict,
-    supplier: dict
+    supplier: dict,
+    timings: bool = False,
+    profile: str = None,
+    fields: list = None,
+    idempotency_key: str = None,
+    deadline: float = None
 ):
     """
     Main API endpoint function that coordinates the
@@ -31,9 +92,27 @@ async def endpointFunc(
         shipment (dict): Information about shipment details
         despatch (dict): Information about despatch details
         supplier (dict): Information about supplier details
+        timings (bool, optional): Add the per-stage timings to the
+        response body; the Server-Timing header is always set
+        profile (str, optional): Response profile, minimal, standard or
+        full (RESPONSE_PROFILES)
+        fields (list, optional): Response fields to return instead of
+        the profile's, see response_fields
+        idempotency_key (str, optional): Client key for this submission.
+        A repeated key returns the stored response instead of running
+        again; without one (and IDEMPOTENCY_CONTENT_HASH unset) every
+        call runs. See src/idempotency.py
+        deadline (float, optional): Seconds the request may take,
+        REQUEST_DEADLINE_SECONDS by default. Mongo operations, renders
+        and admission queues get what is left; past it the response
+        is a 504, see src/requestDeadline.py
 
     Returns:
         dict: Response containing results of the operations
+
+    Raises:
+        TypeError: Invalid document or details
+        ValueError: Unknown response profile or field
     """
     # Input validation
     if xmlDoc is None or not isinstance(xmlDoc, str):
@@ -45,15 +124,139 @@ async def endpointFunc(
     ):
         raise TypeError("Error: invalid shipment or despatch information")
 
+    shape = response_fields(profile, fields)
+    key, fingerprint = requestKey(
+        idempotency_key, xmlDoc, shipment, despatch, supplier, shape
+    )
+
+    async def run():
+        response = await run_endpoint(
+            xmlDoc, shipment, despatch, supplier, shape
+        )
+        # a strict budget fails here, before runOnce stores the
+        # response for replay
+        currentBudget().settle()
+        return response
+
+    # timed around runOnce, so the stored response carries no
+    # timings and a replay reports its own
+    timer = StageTimer("endpointFunc")
+    with timer:
+        response = await runOnce(
+            key, fingerprint, run,
+            compact=lambda response: compact_response(response, shape[0]),
+            expand=expand_response,
+        )
+    return timer.finish(response, include_timings=timings)
+
+
+def compact_response(response, profile):
+    """
+    The endpointFunc response as stored for replay. The copies of the
+    despatch XML (three of them in the full profile) are blanked and
+    the despatch ID kept instead; expand_response puts them back.
+
+    Args:
+        response (dict): Response from run_endpoint
+        profile (str): Response profile it was built for
+
+    Returns:
+        dict: The response to store
+    """
+    if not isinstance(response, dict) or response.get("statusCode") != 200:
+        return response
+    body = json.loads(response["body"])
+    despatch = body.get("despatch")
+    if not isinstance(despatch, dict):
+        despatch = {}
+    despatch_data = despatch.get("despatch_data")
+    if not isinstance(despatch_data, dict):
+        despatch_data = {}
+    despatch_id = body.get("despatch_id") or despatch.get("despatch_id")
+
+    restore = []
+    for path, container, field in (
+        ("xml_content", despatch, "xml_content"),
+        ("XMLData", despatch_data, "XMLData"),
+    ):
+        if despatch_id and isinstance(container.get(field), str):
+            container[field] = None
+            restore.append(path)
+    if isinstance(body.get("despatch_xml"), str):
+        if profile == "full" and despatch_data:
+            # rendered from despatch_data, which replay restores first
+            body["despatch_xml"] = None
+            restore.append("despatch_xml:rendered")
+        elif profile != "full" and despatch_id:
+            # the stored XML itself, see build_despatch_xml
+            body["despatch_xml"] = None
+            restore.append("despatch_xml")
+    if not restore:
+        return response
+    return dict(
+        response,
+        body=json.dumps(body),
+        replay={"despatch_id": despatch_id, "restore": restore},
+    )
+
+
+async def expand_response(stored):
+    """
+    Rebuild a response stored by compact_response, reading the despatch
+    XML back from the despatch it references
+
+    Args:
+        stored (dict): Response as stored
+
+    Returns:
+        dict: The response as first returned
+
+    Raises:
+        LookupError: The despatch is no longer there
+    """
+    replay = stored.get("replay")
+    if not replay:
+        return stored
+    response = {key: value for key, value in stored.items()
+                if key != "replay"}
+    body = json.loads(response["body"])
+    restore = replay["restore"]
+
+    if any(path != "despatch_xml:rendered" for path in restore):
+        result = await get_despatch_xml(replay["despatch_id"])
+        if result.get("statusCode") != 200:
+            raise LookupError(f"despatch {replay['despatch_id']} not found")
+        xml = result["body"]
+        if "xml_content" in restore:
+            body["despatch"]["xml_content"] = xml
+        if "XMLData" in restore:
+            body["despatch"]["despatch_data"]["XMLData"] = xml
+        if "despatch_xml" in restore:
+            body["despatch_xml"] = xml
+    if "despatch_xml:rendered" in restore:
+        body["despatch_xml"] = await xmlLimiter.run(
+            json_to_xml, body["despatch"]["despatch_data"], "DespatchAdvice"
+        )
+    response["body"] = json.dumps(body)
+    return response
+
+
+async def run_endpoint(xmlDoc, shipment, despatch, supplier, shape):
+    """
+    The endpointFunc pipeline, each numbered step timed as a stage
+    of the active StageTimer. A 5xx after the order was created
+    deletes what the run created, so a retry starts over instead of
+    adding a second order, shipment and despatch.
+    """
     try:
         # 1. Validate the XML order document and convert to JSON
         (
             is_valid,
             validation_issues,
             order_json
-        ) = await validate_order_document(
+        ) = await timed("validate_order", validate_order_document(
             xmlDoc, "xml"
-        )
+        ))
 
         if not is_valid:
             return {
@@ -66,165 +269,242 @@ async def endpointFunc(
                 ),
             }
 
-        # 2. Connect to the database
-        client, db = await dbConnect()
-        try:
-            # 3. Create an order from the validated document
-            order_create_input = {
-                "customer_id": order_json.get("CustomerID"),
-                "items": order_json.get("Items", []),
-            }
+        # 2. Connect to the database; the DB-bound rest of the
+        # request holds a dbLimiter slot (src/admission.py)
+        async with dbLimiter.slot():
+            client, db = await timed("db_connect", dbConnect())
+            created = []
+            response = None
+            try:
+                # 3. Create an order from the validated document
+                order_create_input = {
+                    "customer_id": order_json.get("CustomerID"),
+                    "items": order_json.get("Items", []),
+                }
 
-            order_result = await create_order(order_create_input)
-            order_response = json.loads(order_result.get("body", "{}"))
+                order_result = await timed(
+                    "create_order", create_order(order_create_input)
+                )
+                order_response = json.loads(order_result.get("body", "{}"))
 
-            if order_result.get("statusCode") != 200:
-                return order_result
+                if order_result.get("statusCode") != 200:
+                    return order_result
 
-            # Get the order ID and UUID for subsequent operations
-            order_id = order_response.get("order_id")
-            order_uuid = order_response.get("uuid")
-            order = await getOrderInfo(order_id, db)
-            salesOrderId = order.get('SalesOrderId', "")
+                order_id = order_response.get("order_id")
+                order_uuid = order_response.get("uuid")
+                created.append(lambda: deleteOrder(order_uuid, db))
 
-            # 4. Create order reference
-            order_ref = await create_order_reference(
-                order_id,
-                salesOrderId,
-                db
-            )
+                # Load the order once; every stage below reads it
+                # from here
+                order_context = await timed(
+                    "load_order", OrderContext.load(order_id, db)
+                )
+                if not order_context.order:
+                    return {
+                        "statusCode": 404,
+                        "body": json.dumps(
+                            {"error": "Order does not exist"}
+                        ),
+                    }
+                response = await despatch_pipeline(
+                    db, order_json, order_response, order_context,
+                    shipment, despatch, *shape, created=created
+                )
+                return response
+            finally:
+                if response is None or response.get("statusCode", 500) >= 500:
+                    # outside the request's context: a run that timed
+                    # out has no Mongo time (or query budget) left
+                    await asyncio.shield(asyncio.create_task(
+                        discard_created(created),
+                        context=contextvars.Context(),
+                    ))
+                releaseClient(client)
 
-            # 5. Get supplier information
-            supplier_info = {}
-            try:
-                supplier_info = await despatchSupplier(order_uuid)
-            except ValueError as e:
-                return {
-                    "statusCode": 400,
-                    "body": json.dumps({"error": f"Supplier error: {str(e)}"}),
-                }
+    except Overloaded as e:
+        return e.response()
+    except Exception as e:
+        if isTimeout(e):
+            return timeoutResponse()
+        return {
+            "statusCode": 500,
+            "body": json.dumps({
+                "error": f"Error processing request: {str(e)}"
+            }),
+        }
 
-            # 6. Get customer information for delivery
-            customer_info = {}
-            try:
-                if order_uuid:
-                    customer_info = await deliveryCustomer(order_uuid)
-            except ValueError as e:
-                return {
-                    "statusCode": 400,
-                    "body": json.dumps({"error": f"Customer error: {str(e)}"}),
-                }
 
-            # 7. Handle delivery period requirements
-            delivery_period_result = process_delivery_period(
-                shipment, order_id
-            )
+async def despatch_pipeline(
+    db, order_json, order_response, order_context, shipment, despatch,
+    profile="full", fields=RESPONSE_PROFILES["full"], created=None
+):
+    """
+    Steps 4 to 14 of endpointFunc, for an order that has been created
+    and loaded. Shared by endpointFunc and batchEndpointFunc.
 
-            # 8. Process shipment data if provided
-            shipment_result = {}
-            if 'ID' in shipment:
-                try:
-                    # Use a valid shipment ID format (SHIP-XXXXXX)
-                    shipment_id = shipment.get('ID', f"SHIP-{order_id[4:]}")
-                    if not shipment_id.startswith("SHIP-"):
-                        shipment_id = f"SHIP-{shipment_id[-6:]}"
+    Args:
+        db: Database connection
+        order_json (dict): The validated order document as JSON
+        order_response (dict): create_order response body
+        order_context (OrderContext): The loaded order
+        shipment (dict): Information about shipment details
+        despatch (dict): Information about despatch details
+        profile (str, optional): Response profile, see response_fields
+        fields (tuple, optional): Response fields to build
+        created (list, optional): Gets a coroutine function undoing
+        each record the pipeline inserts, see discard_created
 
-                    shipment_result = await create_shipment(
-                        shipment_id, shipment
-                    )
-                    if not shipment_result.get("success"):
-                        return {
-                            "statusCode": 400,
-                            "body": json.dumps({
-                                "error": f"Shipment error: {
-                                    shipment_result.get(
-                                        'error', 'Unknown error'
-                                    )
-                                }"
-                            }),
-                        }
-                except ValueError as e:
-                    return {
-                        "statusCode": 400,
-                        "body": json.dumps({
-                            "error": f"Shipment error: {str(e)}"
-                        }),
-                    }
+    Returns:
+        dict: Response containing results of the operations
+    """
+    if created is None:
+        created = []
+    # Get the order ID and UUID for subsequent operations
+    order_id = order_response.get("order_id")
+    order_uuid = order_response.get("uuid")
+    try:
+        salesOrderId = order_context.get('SalesOrderId', "")
 
-            # 9. Process backordering information
+        # 7. Handle delivery period requirements and
+        # 9. Process backordering information
+        # (pure, so they are done before the fan-out below)
+        with stage("delivery_period"):
+            delivery_period_result = process_delivery_period(
+                shipment, order_id
+            )
+        with stage("backordering"):
             backordering_result = process_backordering(
                 despatch, order_id
             )
 
-            # 10. Prepare despatch line if details provided
-            despatch_line_result = {}
-            if despatch.get('line_details'):
-                try:
-                    line_details = despatch.get('line_details', {})
-                    line_details.setdefault('ID', '1')
-                    line_details.setdefault('Note', 'Generated by system')
-                    line_details.setdefault('BackOrderReason', 'N/A')
-                    line_details.setdefault('LotNumber', '100001')
-                    line_details.setdefault('ExpiryDate', '2025-12-31')
-
-                    if not line_details.get('DeliveredQuantity'):
-                        # Default to full delivery if not specified
-                        items = order_json.get("Items", [])
-                        if items:
-                            line_details[
-                                'DeliveredQuantity'
-                            ] = items[0].get('quantity', 0)
-
-                    if not line_details.get('BackOrderQuantity'):
-                        line_details['BackOrderQuantity'] = 0
-
-                    despatch_line_result = despatchLine(
-                        line_details,
-                        order_uuid
+        # 4, 5, 6 and 8 only depend on the loaded order and the
+        # request, so they run concurrently. The first failing
+        # branch cancels the others. The shipment insert is undone
+        # if the request is turned away (see turn_away).
+        turned_away_from = len(created)
+        try:
+            async with asyncio.TaskGroup() as stages:
+                # 4. Create order reference
+                order_ref_task = stages.create_task(timed(
+                    "order_reference",
+                    create_order_reference(
+                        order_id,
+                        salesOrderId,
+                        db["orders"],
+                        order=order_context.order
                     )
-                except ValueError as e:
-                    return {
-                        "statusCode": 400,
-                        "body": json.dumps({
-                            "error": f"Despatch line error: {str(e)}"
-                        }),
-                    }
+                ))
+                # 5. Get supplier information
+                supplier_task = stages.create_task(timed(
+                    "supplier",
+                    supplier_stage(order_uuid, order_context.order)
+                ))
+                # 6. Get customer information for delivery
+                customer_task = stages.create_task(timed(
+                    "customer",
+                    customer_stage(order_uuid, order_context.order)
+                ))
+                # 8. Process shipment data if provided
+                shipment_task = stages.create_task(timed(
+                    "shipment",
+                    shipment_stage(shipment, order_id, db, created)
+                ))
+        except ExceptionGroup as errors:
+            return await turn_away(
+                created, turned_away_from, stage_error_response(errors)
+            )
 
-            # 11. Create the despatch advice with ALL collected data
-            despatch_input = {
-                "order_id": order_id,
-                "order_reference": order_ref,
-                "supplier": supplier_info,
-                "customer": {
-                    "id": order_json.get("CustomerID"),
-                    "details": customer_info
-                },
-                "shipment": shipment_result,
-                "despatch_line": despatch_line_result,
-                "backordering": backordering_result,
-                "delivery_period": delivery_period_result
-            }
+        order_ref = order_ref_task.result()
+        supplier_info = supplier_task.result()
+        customer_info = customer_task.result()
+        shipment_result = shipment_task.result()
+        order_context.update(order_ref)
 
-            # Call the fixed create_despatch_advice function
-            despatch_result = await create_despatch_advice(despatch_input)
-            despatch_response = json.loads(despatch_result.get("body", "{}"))
+        # 10. Prepare the despatch lines if details provided: one
+        # dict (the original single line) or a list of them
+        despatch_line_result = {}
+        line_details = despatch.get('line_details')
+        if line_details:
+            single = isinstance(line_details, dict)
+            specs = [line_details] if single else line_details
+            try:
+                if not isinstance(specs, list):
+                    raise ValueError(
+                        "line_details must be an object or a list"
+                    )
+                items = order_json.get("Items", [])
+                specs = [
+                    line_defaults(spec, index, items)
+                    for index, spec in enumerate(specs)
+                ]
+                with stage("despatch_line"):
+                    despatch_line_result = await despatchLines(
+                        specs, order_uuid, order=order_context.order
+                    )
+                if single:
+                    despatch_line_result = {
+                        "DespatchLine":
+                            despatch_line_result["DespatchLine"][0]
+                    }
+            except ValueError as e:
+                error = {"error": f"Despatch line error: {str(e)}"}
+                if isinstance(e, DespatchLineError):
+                    error["issues"] = e.errors
+                    if e.report:
+                        # missing / invalid fields per line
+                        error["line_report"] = e.report
+                return await turn_away(created, turned_away_from, {
+                    "statusCode": 400, "body": json.dumps(error)
+                })
 
-            if despatch_result.get("statusCode") != 200:
-                return despatch_result
+        # 11. Create the despatch advice with ALL collected data
+        despatch_input = {
+            "order_id": order_id,
+            "order_reference": order_ref,
+            "supplier": supplier_info,
+            "customer": {
+                "id": order_json.get("CustomerID"),
+                "details": customer_info
+            },
+            "shipment": shipment_result,
+            "despatch_line": despatch_line_result,
+            "backordering": backordering_result,
+            "delivery_period": delivery_period_result
+        }
 
-            # 12. Validate the created despatch advice
-            validation_result = await validate_despatch_advice(
-                despatch_response.get("despatch_id")
-            )
-            validation_response = json.loads(
-                validation_result.get("body", "{}")
+        # Call the fixed create_despatch_advice function
+        despatch_result = await timed(
+            "create_despatch",
+            create_despatch_advice(
+                despatch_input, order=order_context.order
             )
+        )
+        despatch_response = json.loads(despatch_result.get("body", "{}"))
+
+        if despatch_result.get("statusCode") != 200:
+            return despatch_result
+        created.append(lambda: delete_despatch_advice(
+            despatch_response.get("despatch_id")
+        ))
 
-            # 13. Convert despatch data to XML
+        # 12. Validate the created despatch advice
+        validation_result = await timed(
+            "validate_despatch",
+            validate_despatch_advice(despatch_response.get("despatch_id"))
+        )
+        validation_response = json.loads(
+            validation_result.get("body", "{}")
+        )
+
+        # 13. Convert despatch data to XML
+        async def build_despatch_xml():
+            if profile != "full" and despatch_response.get("xml_content"):
+                # the copy create_despatch_advice already rendered
+                return despatch_response["xml_content"]
             despatch_data = despatch_response.get("despatch_data", {})
             if not despatch_data:
                 # Fallback if despatch_data is not available
-                complete_despatch_json = {
+                despatch_data = {
                     "ID": despatch_response.get("despatch_id", ""),
                     "OrderReference": order_ref,
                     "DespatchSupplierParty": supplier_info,
@@ -234,33 +514,57 @@ async def endpointFunc(
                         "DespatchLine", {}
                     )
                 }
-                despatch_xml = json_to_xml(
-                    complete_despatch_json, "DespatchAdvice"
-                )
-            else:
-                # Use the despatch_data directly if available
-                despatch_xml = json_to_xml(despatch_data, "DespatchAdvice")
+            # lxml rendering, off the event loop and admission limited
+            return await timed("xml", xmlLimiter.run(
+                json_to_xml, despatch_data, "DespatchAdvice"
+            ))
 
-            # 14. Return the complete response with XML content
-            return {
-                "statusCode": 200,
-                "body": json.dumps(
-                    {
-                        "order": order_response,
-                        "despatch": despatch_response,
-                        "despatch_xml": despatch_xml,  # Add the XML string
-                        "validation": validation_response,
-                        "delivery_period": delivery_period_result,
-                        "backordering": backordering_result,
-                        "shipment": shipment_result,
-                        "despatch_line": despatch_line_result
-                    }
-                ),
-            }
-        finally:
-            client.close()
+        despatch_xml = None
+        if "despatch_xml" in fields:
+            despatch_xml = await build_despatch_xml()
 
+        # 14. Return the response; only the fields the profile (or
+        # fields=) asks for are built. Below "full", despatch and
+        # shipment leave out the documents the XML already carries.
+        builders = {
+            "order_id": lambda: order_id,
+            "uuid": lambda: order_uuid,
+            "despatch_id": lambda: despatch_response.get("despatch_id"),
+            "status": lambda: despatch_response.get("status"),
+            "validation_status": lambda: validation_response.get(
+                "validation_status"
+            ),
+            "order": lambda: order_response,
+            "despatch": lambda: despatch_response if profile == "full" else {
+                key: value for key, value in despatch_response.items()
+                if key not in ("despatch_data", "xml_content")
+            },
+            "despatch_xml": lambda: despatch_xml,
+            "validation": lambda: validation_response,
+            "delivery_period": lambda: delivery_period_result,
+            "backordering": lambda: backordering_result,
+            "shipment": lambda: shipment_result if profile == "full" else {
+                key: shipment_result[key]
+                for key in ("success", "inserted_id", "error")
+                if key in shipment_result
+            },
+            "despatch_line": lambda: despatch_line_result,
+            "db_queries": lambda: currentBudget().count,
+        }
+        return {
+            "statusCode": 200,
+            # despatch lines and shipments carry stored datetimes
+            "body": json.dumps(
+                {field: builders[field]() for field in fields},
+                default=jsonDefault,
+            ),
+        }
+
+    except Overloaded:
+        raise
     except Exception as e:
+        if isTimeout(e):
+            return timeoutResponse()
         return {
             "statusCode": 500,
             "body": json.dumps({
@@ -269,6 +573,566 @@ async def endpointFunc(
         }
 
 
+@queryBudget()
+async def batchEndpointFunc(items, concurrency=None, timings=False,
+                            profile=None, fields=None):
+    """
+    endpointFunc for many orders in one request, e.g. an ERP export
+
+    Items are processed with bounded concurrency over one database
+    connection. The orders of all valid documents are created with a
+    single bulk insert and their stored documents are handed straight
+    to the despatch stages, so no item re-reads its order. A failing
+    item is reported in its own result and does not fail the batch.
+    batch_ndjson() streams the same results as they complete.
+
+    Args:
+        items (list): dicts with xmlDoc, shipment, despatch and supplier,
+        as passed to endpointFunc
+        concurrency (int, optional): Items in flight at once, defaults
+        to BATCH_CONCURRENCY
+        timings (bool, optional): Add the per-stage timings (summed
+        over all items) to the response body
+        profile, fields (optional): Shape of each item's body, as for
+        endpointFunc
+
+    Returns:
+        dict: Response with one result per item (in input order),
+        each holding the statusCode and parsed body endpointFunc
+        would have returned, plus succeeded/failed counts
+    """
+    error = batch_input_error(items, profile, fields)
+    if error:
+        return error
+    shape = response_fields(profile, fields)
+
+    timer = StageTimer("batchEndpointFunc")
+    with timer:
+        results = [
+            result async for result in stream_batch(
+                items, concurrency, shape
+            )
+        ]
+    results.sort(key=lambda result: result["index"])
+    succeeded = sum(result["statusCode"] == 200 for result in results)
+    response = {
+        "statusCode": 200,
+        "body": json.dumps({
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "results": results,
+        }),
+    }
+    return timer.finish(response, include_timings=timings)
+
+
+async def batch_ndjson(items, concurrency=None, profile=None, fields=None):
+    """
+    batchEndpointFunc as newline-delimited JSON: one line per item,
+    written as soon as that item completes, so the first result goes
+    out before the last order is done and finished results are not
+    held in memory
+
+    Args:
+        items (list): As for batchEndpointFunc
+        concurrency (int, optional): Items in flight at once
+        profile, fields (optional): Shape of each item's body, as for
+        endpointFunc
+
+    Yields:
+        str: One JSON object and a newline per item ({"index",
+        "statusCode", "body"}), in completion order. An invalid batch
+        yields a single {"error"} line.
+    """
+    error = batch_input_error(items, profile, fields)
+    if error:
+        yield error["body"] + "\n"
+        return
+    shape = response_fields(profile, fields)
+    async for result in stream_batch(items, concurrency, shape):
+        yield json.dumps(result) + "\n"
+
+
+def batch_input_error(items, profile=None, fields=None):
+    """Error response for a batch that cannot be processed, else None"""
+    try:
+        response_fields(profile, fields)
+    except ValueError as e:
+        return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
+    if not isinstance(items, list):
+        return {
+            "statusCode": 400,
+            "body": json.dumps(
+                {"error": "Invalid request format: expected a list"}
+            ),
+        }
+    if len(items) > BATCH_MAX_ITEMS:
+        return {
+            "statusCode": 413,
+            "body": json.dumps({
+                "error": f"Batch too large: at most {BATCH_MAX_ITEMS} items"
+            }),
+        }
+    return None
+
+
+def batch_result(index, response):
+    """One item of a batch: its index, statusCode and parsed body"""
+    try:
+        body = json.loads(response.get("body") or "{}")
+    except ValueError:
+        body = response.get("body")
+    return {
+        "index": index,
+        "statusCode": response.get("statusCode"),
+        "body": body,
+    }
+
+
+async def stream_batch(items, concurrency=None, shape=None):
+    """
+    The batch pipeline, see batchEndpointFunc
+
+    Yields:
+        dict: batch_result() per item, in completion order
+    """
+    limiter = asyncio.Semaphore(concurrency or BATCH_CONCURRENCY)
+    shape = shape or response_fields()
+    pending = set()
+    done = set()
+
+    # 1. Validate every order document
+    async def validate(index, item):
+        if not isinstance(item, dict) or not isinstance(
+            item.get("xmlDoc"), str
+        ) or any(
+            not isinstance(item.get(key), dict)
+            for key in ("shipment", "despatch", "supplier")
+        ):
+            return index, None, {
+                "statusCode": 400,
+                "body": json.dumps({
+                    "error": "Invalid item: expected xmlDoc, shipment, "
+                    "despatch and supplier"
+                }),
+            }
+        async with limiter:
+            is_valid, issues, order_json = await timed(
+                "validate_order",
+                validate_order_document(item["xmlDoc"], "xml")
+            )
+        if not is_valid:
+            return index, None, {
+                "statusCode": 400,
+                "body": json.dumps({
+                    "error": "Invalid order document",
+                    "issues": issues
+                }),
+            }
+        return index, order_json, None
+
+    # 3. Despatch stages of one item
+    async def despatch_item(db, index, order_json, order_result, document):
+        if document is None:
+            return index, {
+                "statusCode": 500,
+                "body": json.dumps({
+                    "error": "Failed to create order: "
+                    f"{order_result.get('error')}"
+                }),
+            }
+        order_response = {
+            "order_id": order_result["order_id"],
+            "uuid": order_result["uuid"],
+            "status": order_result["status"],
+        }
+        item = items[index]
+        async with limiter:
+            with QueryBudget(name="batch item"):
+                try:
+                    return index, await despatch_pipeline(
+                        db,
+                        order_json,
+                        order_response,
+                        OrderContext(order_result["order_id"], document),
+                        item["shipment"],
+                        item["despatch"],
+                        *shape,
+                    )
+                except Overloaded as e:
+                    # the XML limiter turned this item away, not the
+                    # batch
+                    return index, e.response()
+
+    try:
+        valid = {}
+        pending = {
+            asyncio.create_task(validate(index, item))
+            for index, item in enumerate(items)
+        }
+        for next_done in asyncio.as_completed(pending):
+            index, order_json, error = await next_done
+            if error:
+                done.add(index)
+                yield batch_result(index, error)
+            else:
+                valid[index] = order_json
+
+        if not valid:
+            return
+        # the batch holds one dbLimiter slot, its own semaphore
+        # bounds the items in flight
+        async with dbLimiter.slot():
+            client, db = await timed("db_connect", dbConnect())
+            try:
+                # 2. Create all orders with one bulk insert
+                positions = sorted(valid)
+                order_results, documents = await timed(
+                    "create_orders",
+                    insert_orders([
+                        {
+                            "customer_id": valid[index].get("CustomerID"),
+                            "items": valid[index].get("Items", []),
+                        }
+                        for index in positions
+                    ], db)
+                )
+
+                pending = {
+                    asyncio.create_task(despatch_item(
+                        db, index, valid[index], order_result, document
+                    ))
+                    for index, order_result, document in zip(
+                        positions, order_results, documents
+                    )
+                }
+                for next_done in asyncio.as_completed(pending):
+                    index, response = await next_done
+                    done.add(index)
+                    yield batch_result(index, response)
+            finally:
+                releaseClient(client)
+
+    except Exception as e:
+        # the batch itself failed (or was turned away), the items
+        # not yet reported with it
+        response = e.response() if isinstance(e, Overloaded) else {
+            "statusCode": 500,
+            "body": json.dumps({
+                "error": f"Error processing request: {str(e)}"
+            }),
+        }
+        for index in range(len(items)):
+            if index not in done:
+                yield batch_result(index, response)
+    finally:
+        # the consumer stopped early or the batch failed
+        for task in pending:
+            task.cancel()
+
+
+async def submit_despatch_job(
+    xmlDoc: str,
+    shipment: dict,
+    despatch: dict,
+    supplier: dict,
+    profile: str = None,
+    fields: list = None,
+    idempotency_key: str = None
+):
+    """
+    Queue an endpointFunc run and return straight away, for orders
+    too large to finish inside the API Gateway timeout. A
+    despatch_worker_pool() runs the job; poll despatch_job_status().
+
+    Args:
+        As for endpointFunc
+
+    Returns:
+        dict: 202 response with job_id, status and status_link, 400
+        for invalid input
+    """
+    if not isinstance(xmlDoc, str) or any(
+        not isinstance(key, dict) for key in (shipment, despatch, supplier)
+    ):
+        return {
+            "statusCode": 400,
+            "body": json.dumps(
+                {"error": "Error: invalid document or despatch information"}
+            ),
+        }
+    try:
+        response_fields(profile, fields)
+    except ValueError as e:
+        return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
+
+    job_id = await submitJob("despatch", {
+        "xmlDoc": xmlDoc,
+        "shipment": shipment,
+        "despatch": despatch,
+        "supplier": supplier,
+        "profile": profile,
+        "fields": fields,
+        "idempotency_key": idempotency_key,
+    })
+    return {
+        "statusCode": 202,
+        "body": json.dumps({
+            "job_id": job_id,
+            "status": "queued",
+            "status_link": f"/v1/jobs/{job_id}",
+        }),
+    }
+
+
+async def despatch_job_status(job_id):
+    """
+    Status of a submitted job: status, attempts, the stages done so
+    far and, once finished, the endpointFunc response
+
+    Args:
+        job_id (str): ID returned by submit_despatch_job
+
+    Returns:
+        dict: Response with the job status, 404 for an unknown job
+    """
+    status = await jobStatus(job_id)
+    if status is None:
+        return {
+            "statusCode": 404,
+            "body": json.dumps({"error": "Job does not exist"}),
+        }
+    return {"statusCode": 200, "body": json.dumps(status)}
+
+
+async def run_despatch_job(payload):
+    """
+    Job handler: endpointFunc on a submitted payload. Without a client
+    key the job ID is the idempotency key, so an attempt retried after
+    the previous one finished (but could not record it) replays it.
+    """
+    if not payload.get("idempotency_key") and currentJobId():
+        payload = dict(payload, idempotency_key=f"job:{currentJobId()}")
+    try:
+        return await endpointFunc(**payload, deadline=DESPATCH_JOB_DEADLINE)
+    except (TypeError, ValueError) as e:
+        return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
+
+
+JOB_HANDLERS = {"despatch": run_despatch_job}
+
+
+def despatch_worker_pool(size=None, db=None):
+    """
+    Workers for submit_despatch_job: start() them on a long running
+    process (container, EC2), or drain() them from the scheduled
+    src/lambda/job_worker_handler.py, not inside the API Lambda
+    """
+    kwargs = {"size": size} if size else {}
+    return JobWorkerPool(JOB_HANDLERS, db=db, **kwargs)
+
+
+def response_fields(profile=None, fields=None):
+    """
+    Resolve the shape of an endpointFunc response
+
+    Args:
+        profile (str, optional): minimal, standard or full, defaults
+        to DEFAULT_RESPONSE_PROFILE
+        fields (list or str, optional): Response fields to return
+        instead of the profile's (a list or comma separated string),
+        including EXTRA_RESPONSE_FIELDS; despatch and shipment are
+        still trimmed unless profile is full
+
+    Returns:
+        tuple: (profile, fields)
+
+    Raises:
+        ValueError: Unknown profile or field
+    """
+    profile = profile or DEFAULT_RESPONSE_PROFILE
+    if profile not in RESPONSE_PROFILES:
+        raise ValueError(f"Unknown response profile: {profile}")
+    if fields is None:
+        return profile, RESPONSE_PROFILES[profile]
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",")]
+    unknown = [field for field in fields if field not in RESPONSE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown response fields: {', '.join(unknown)}")
+    return profile, tuple(dict.fromkeys(fields))
+
+
+class StageError(Exception):
+    """
+    Raised by a concurrent pipeline stage to end the request
+    with the given error response
+    """
+
+    def __init__(self, response):
+        super().__init__(response.get("body"))
+        self.response = response
+
+
+async def discard_created(created):
+    """
+    Undo the inserts of a failed run, newest first. Failures are
+    logged, not raised: the run's own error is the one to report.
+    """
+    for undo in reversed(created):
+        try:
+            await undo()
+        except Exception as e:
+            print(f"Could not undo a failed run's insert: {str(e)}")
+    created.clear()
+
+
+async def turn_away(created, start, response):
+    """
+    Undo the inserts a pipeline made from created[start:] on, and
+    return the 4xx response turning the request away
+    """
+    turned_away = created[start:]
+    del created[start:]
+    await discard_created(turned_away)
+    return response
+
+
+def stage_error(message):
+    """Build a StageError carrying a 400 response"""
+    return StageError({
+        "statusCode": 400,
+        "body": json.dumps({"error": message}),
+    })
+
+
+def stage_error_response(errors):
+    """
+    Pick the response for a failed group of concurrent stages
+
+    Args:
+        errors (ExceptionGroup): Errors raised inside the TaskGroup
+
+    Returns:
+        dict: The 400 response of the first StageError
+
+    Raises:
+        Exception: The first unexpected error, so it is reported the
+        same way as an error outside the concurrent stages
+    """
+    stage_errors = errors.subgroup(StageError)
+    if stage_errors is not None:
+        return first_leaf(stage_errors).response
+    raise first_leaf(errors)
+
+
+def first_leaf(errors):
+    """First non-group exception of a (possibly nested) ExceptionGroup"""
+    while isinstance(errors, BaseExceptionGroup):
+        errors = errors.exceptions[0]
+    return errors
+
+
+async def supplier_stage(order_uuid, order):
+    """Step 5: supplier information, mapped to a 400 on ValueError"""
+    try:
+        return await despatchSupplier(order_uuid, order=order)
+    except ValueError as e:
+        raise stage_error(f"Supplier error: {str(e)}")
+
+
+async def customer_stage(order_uuid, order):
+    """Step 6: customer information, mapped to a 400 on ValueError"""
+    if not order_uuid:
+        return {}
+    try:
+        return await deliveryCustomer(order_uuid, order=order)
+    except ValueError as e:
+        raise stage_error(f"Customer error: {str(e)}")
+
+
+async def shipment_stage(shipment, order_id, db=None, created=None):
+    """
+    Step 8: create the shipment if the request describes one
+
+    The insert is shielded from the cancellation of a failed sibling
+    stage, and undoing it is added to created (see discard_created)
+    before it starts, so a shipment cannot land after its request was
+    turned away.
+    """
+    if 'ID' not in shipment:
+        return {}
+    shipment_id = shipment['ID']
+    if not isinstance(shipment_id, str):
+        raise stage_error("Shipment error: Shipment ID must be a string")
+
+    insert = asyncio.ensure_future(insert_shipment(shipment))
+    if created is not None:
+        created.append(lambda: undo_shipment(insert, db))
+    try:
+        shipment_result = await asyncio.shield(insert)
+    except (TypeError, ValueError) as e:
+        raise stage_error(f"Shipment error: {str(e)}")
+
+    if not shipment_result.get("success"):
+        error = shipment_result.get('error', 'Unknown error')
+        raise stage_error(f"Shipment error: {error}")
+    return shipment_result
+
+
+async def insert_shipment(shipment):
+    """Insert the shipment under its own or a generated SHIP- ID"""
+    shipment_id = shipment['ID']
+    if shipment_id.startswith(SHIPMENT_PREFIX):
+        return await create_shipment(shipment_id, shipment)
+
+    # Generate an ID rather than cutting a (collision prone) suffix
+    # out of the given one, a new one is drawn if it is already taken
+    async def insert(new_id):
+        return await create_shipment(
+            new_id, dict(shipment, ID=new_id), raise_duplicate=True
+        )
+
+    return await withFreshId(SHIPMENT_PREFIX, insert, "ID")
+
+
+async def undo_shipment(insert, db):
+    """Delete the shipment an insert task created, once it is done"""
+    try:
+        shipment_result = await insert
+    except Exception:
+        return
+    shipment_id = shipment_result.get("document", {}).get("ID")
+    if shipment_result.get("success") and shipment_id:
+        await db["shipments"].delete_one({"ID": shipment_id})
+
+
+def line_defaults(spec, index, items):
+    """
+    A line spec with the system defaults filled in. Quantities default
+    to full delivery of the matching order item (by position).
+    """
+    if not isinstance(spec, dict):
+        return spec
+    spec = dict(spec)
+    spec.setdefault('ID', str(index + 1))
+    spec.setdefault('Note', 'Generated by system')
+    spec.setdefault('BackOrderReason', 'N/A')
+    spec.setdefault('LotNumber', '100001')
+    spec.setdefault('ExpiryDate', '2025-12-31')
+
+    if not spec.get('DeliveredQuantity'):
+        # Default to full delivery if not specified
+        if index < len(items):
+            spec['DeliveredQuantity'] = items[index].get('quantity', 0)
+        elif items:
+            spec['DeliveredQuantity'] = items[0].get('quantity', 0)
+
+    if not spec.get('BackOrderQuantity'):
+        spec['BackOrderQuantity'] = 0
+    return spec
+
+
 def process_delivery_period(shipment_info, order_id):
     """
     Process delivery period requirements
@@ -341,17 +1205,24 @@ def process_backordering(despatch_info, order_id):
     allow_backordering = despatch_info.get("allow_backordering", False)
     max_delay_days = despatch_info.get("max_delay_days", 0)
 
-    # Extract line-specific backordering information if available
+    # Extract line-specific backordering information if available,
+    # for one line (a dict) or several (a list)
     line_details = despatch_info.get("line_details", {})
+    if isinstance(line_details, dict):
+        line_details = [line_details] if line_details else []
+    elif not isinstance(line_details, list):
+        line_details = []
 
     backorder_items = []
-    if line_details:
-        backorder_qty = line_details.get("BackOrderQuantity", 0)
+    for index, line in enumerate(line_details):
+        if not isinstance(line, dict):
+            continue
+        backorder_qty = line.get("BackOrderQuantity", 0)
         if backorder_qty > 0:
             backorder_items.append({
-                "line_id": line_details.get("ID", "1"),
+                "line_id": line.get("ID", str(index + 1)),
                 "quantity": backorder_qty,
-                "reason": line_details.get(
+                "reason": line.get(
                     "BackOrderReason",
                     "Insufficient stock"
                 )
@@ -0,0 +1,210 @@
+# ================================================
+# In-process read-through caches for documents that
+# rarely change after creation (orders, despatches).
+
+# Entries are evicted least-recently-used once the cache
+# is full and expire after a TTL. Concurrent misses for
+# the same key share a single load. Writes invalidate by
+# tag (the document's IDs) so any key that resolved to
+# the document is dropped.
+# ================================================
+
+import asyncio
+import copy
+import os
+import time
+from collections import OrderedDict
+
+
+CACHE_ENABLED = os.getenv("DOC_CACHE_ENABLED", "1") != "0"
+ORDER_CACHE_SIZE = int(os.getenv("ORDER_CACHE_SIZE", "1024"))
+ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", "300"))
+DESPATCH_CACHE_SIZE = int(os.getenv("DESPATCH_CACHE_SIZE", "256"))
+DESPATCH_CACHE_TTL = float(os.getenv("DESPATCH_CACHE_TTL", "60"))
+
+
+class AsyncLRUCache:
+    """
+    Bounded LRU + TTL cache with single-flight async loading.
+
+    Values are deep-copied on the way out so callers can modify
+    what they get back without touching the cached copy.
+    """
+
+    def __init__(self, maxSize, ttl, enabled=True, clock=time.monotonic):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.enabled = enabled and maxSize > 0
+        self.clock = clock
+        # key -> (expiry, value, tags)
+        self.entries = OrderedDict()
+        self.tagIndex = {}
+        self.inflight = {}
+        # bumped on every invalidation so a load that started
+        # before a write never stores its (stale) result
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Cached value for key, or None on a miss / expired entry"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expiry, value, tags = entry
+        if expiry <= self.clock():
+            self.expirations += 1
+            self.drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def peek(self, key):
+        """Copy of the cached value for key without loading on a miss"""
+        value = self.get(key) if self.enabled else None
+        if value is None:
+            return None
+        self.hits += 1
+        return copy.deepcopy(value)
+
+    def set(self, key, value, tags=()):
+        if not self.enabled:
+            return
+        self.drop(key)
+        tags = tuple(tag for tag in tags if tag)
+        self.entries[key] = (self.clock() + self.ttl, value, tags)
+        for tag in tags:
+            self.tagIndex.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.maxSize:
+            oldest = next(iter(self.entries))
+            self.evictions += 1
+            self.drop(oldest)
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tagIndex.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagIndex[tag]
+
+    async def getOrLoad(self, key, loader, tags=None):
+        """
+        Return the cached value for key, loading it on a miss
+
+        Args:
+            key: Hashable cache key
+            loader: Coroutine function returning the value (None is
+            returned but never cached)
+            tags: Function mapping a loaded value to the tags (IDs)
+            it should be invalidated by
+
+        Returns:
+            A copy of the cached / loaded value
+        """
+        if not self.enabled:
+            return await loader()
+
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return copy.deepcopy(value)
+        self.misses += 1
+
+        pending = self.inflight.get(key)
+        if pending is not None:
+            try:
+                return copy.deepcopy(await asyncio.shield(pending))
+            except asyncio.CancelledError:
+                # the shared load was cancelled, not us: load it ourselves
+                if not pending.cancelled():
+                    raise
+                return await loader()
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        epoch = self.epoch
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            # retrieve it so an unawaited future does not warn
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if value is not None and epoch == self.epoch:
+                self.set(key, value, tags(value) if tags else ())
+        finally:
+            self.inflight.pop(key, None)
+        return copy.deepcopy(value)
+
+    def invalidate(self, key):
+        self.epoch += 1
+        self.invalidations += 1
+        self.drop(key)
+
+    def invalidateTag(self, tag):
+        """Drop every entry tagged with tag (e.g. a document ID)"""
+        self.epoch += 1
+        self.invalidations += 1
+        for key in list(self.tagIndex.get(tag, ())):
+            self.drop(key)
+
+    def clear(self):
+        self.epoch += 1
+        self.entries.clear()
+        self.tagIndex.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.maxSize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+    def resetStats(self):
+        self.hits = self.misses = 0
+        self.evictions = self.expirations = self.invalidations = 0
+
+
+orderCache = AsyncLRUCache(ORDER_CACHE_SIZE, ORDER_CACHE_TTL, CACHE_ENABLED)
+despatchCache = AsyncLRUCache(
+    DESPATCH_CACHE_SIZE, DESPATCH_CACHE_TTL, CACHE_ENABLED
+)
+
+
+def cacheNamespace(db):
+    """Part of the cache key that tells databases / collections apart"""
+    return getattr(db, "full_name", None) or getattr(db, "name", None) or id(db)
+
+
+def documentTags(*fields):
+    """Build a tags function returning the given ID fields of a document"""
+    def tags(document):
+        return [document.get(field) for field in fields]
+    return tags
+
+
+def cacheStats():
+    """Hit/miss counters for every document cache"""
+    return {
+        "orders": orderCache.stats(),
+        "despatches": despatchCache.stats(),
+    }
@@ -0,0 +1,481 @@
+# ================================================
+# Every index the code relies on, in one place.
+
+# Indexes are applied once per deploy / process start
+# and the applied version is stored in the schema_meta
+# collection, so later startups skip straight past it.
+# Bump INDEX_VERSION whenever a released INDEXES set changes.
+
+# A unique index cannot be built over documents that
+# already share a value. That failure is reported (and
+# logged) by name and is not retried in the background,
+# as only removing the duplicates can fix it. An index
+# that already exists with other options (e.g. a unique
+# orders.UUID_1 from before it was made non-unique) is
+# dropped and built again as declared.
+
+# Run at deploy time with:  python -m src.dbIndexes
+# ================================================
+
+import asyncio
+import contextvars
+import logging
+import os
+import time
+import pymongo
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+META_COLLECTION = "schema_meta"
+META_ID = "indexes"
+
+# how long stored endpointFunc responses are replayed, see
+# src/idempotency.py. A changed value only applies to a new
+# index (MongoDB needs collMod to change an existing TTL)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+
+# keys: list of (field, direction) pairs, options: create_index kwargs,
+# covers: the existing queries served by the index
+INDEXES = [
+    {
+        "collection": "orders",
+        "keys": [("UUID", pymongo.ASCENDING)],
+        # not unique: older data may repeat a UUID (deleteOrder
+        # removes every copy), which would block the migration
+        "options": {},
+        "covers": [
+            "mongodb.getOrderInfo: orders.find_one({$or: [{UUID}, ...]})",
+            "mongodb.deleteOrder: orders.delete_many({UUID})",
+        ],
+    },
+    {
+        "collection": "orders",
+        "keys": [("OrderID", pymongo.ASCENDING)],
+        "options": {"unique": True, "sparse": True},
+        "covers": [
+            "mongodb.getOrderInfo: orders.find_one({$or: [..., {OrderID}]})",
+            "mongodb.updateDocument: orders.update_one({OrderID})",
+            "mongodb.deleteDocument: orders.delete_one({OrderID})",
+        ],
+    },
+    {
+        "collection": "orders",
+        "keys": [("ID", pymongo.ASCENDING)],
+        "options": {},
+        "covers": [
+            "OrderReference.create_order_reference: orders.find_one({ID})",
+            "OrderReference.create_order_reference: "
+            "orders.find_one_and_update({ID})",
+        ],
+    },
+    {
+        "collection": "orders",
+        "keys": [
+            ("CreationDate", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING),
+        ],
+        "options": {},
+        "covers": [
+            "mongodb.listOrders: orders.find().sort(CreationDate, _id) keyset pages",
+        ],
+    },
+    {
+        "collection": "orders",
+        "keys": [
+            ("CustomerID", pymongo.ASCENDING),
+            ("CreationDate", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING),
+        ],
+        "options": {},
+        "covers": [
+            "mongodb.listOrders: orders.find({CustomerID[, Status]}) keyset pages",
+        ],
+    },
+    {
+        "collection": "orders",
+        "keys": [
+            ("Status", pymongo.ASCENDING),
+            ("CreationDate", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING),
+        ],
+        "options": {},
+        "covers": [
+            "mongodb.listOrders: orders.find({Status}) keyset pages",
+        ],
+    },
+    {
+        "collection": "despatches",
+        "keys": [("ID", pymongo.ASCENDING)],
+        "options": {"unique": True, "sparse": True},
+        "covers": [
+            "despatchCreate.create_despatch_advice: despatches.insert_one "
+            "(rejects a reused ID, idGenerator retries)",
+            "despatchCreate.getDespatchAdvice: despatches.find_one("
+            "{$or: [{ID}, {DespatchID}]})",
+            "mongodb.updateDocument(s) / deleteDocument(s): despatches "
+            "by ID",
+        ],
+    },
+    {
+        "collection": "despatches",
+        "keys": [("DespatchID", pymongo.ASCENDING)],
+        "options": {"unique": True, "sparse": True},
+        "covers": [
+            "despatchCreate.getDespatchAdvice: the DespatchID branch of "
+            "its $or (older documents)",
+        ],
+    },
+    {
+        "collection": "despatches",
+        "keys": [("UUID", pymongo.ASCENDING)],
+        "options": {"unique": True, "sparse": True},
+        "covers": [
+            "despatchCreate.getDespatchAdvice: despatches.find_one({UUID}) "
+            "fallback",
+        ],
+    },
+    {
+        "collection": "despatches",
+        "keys": [("OrderID", pymongo.ASCENDING)],
+        "options": {},
+        "covers": [
+            "despatches for an order (despatch documents carry OrderID)",
+        ],
+    },
+    {
+        "collection": "despatches",
+        "keys": [
+            ("CreationDate", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING),
+        ],
+        "options": {},
+        "covers": [
+            "mongodb.listDespatches: despatches.find().sort(CreationDate, _id) keyset pages",
+        ],
+    },
+    {
+        "collection": "despatches",
+        "keys": [
+            ("CustomerID", pymongo.ASCENDING),
+            ("CreationDate", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING),
+        ],
+        "options": {},
+        "covers": [
+            "mongodb.listDespatches: despatches.find({CustomerID[, Status]}) keyset pages",
+        ],
+    },
+    {
+        "collection": "despatches",
+        "keys": [
+            ("Status", pymongo.ASCENDING),
+            ("CreationDate", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING),
+        ],
+        "options": {},
+        "covers": [
+            "mongodb.listDespatches: despatches.find({Status}) keyset pages",
+        ],
+    },
+    {
+        "collection": "shipments",
+        "keys": [("ID", pymongo.ASCENDING)],
+        "options": {"unique": True},
+        "covers": [
+            "shipment.create_shipment: shipments.find_one({ID})",
+            "shipment.generate_shipment_qr_code: shipments.find_one({ID})",
+        ],
+    },
+    {
+        "collection": "idempotency",
+        "keys": [("CreatedAt", pymongo.ASCENDING)],
+        "options": {"expireAfterSeconds": IDEMPOTENCY_TTL_SECONDS},
+        "covers": [
+            "idempotency.runOnce: stored responses expire after the TTL",
+        ],
+    },
+    {
+        "collection": "jobs",
+        "keys": [
+            ("Status", pymongo.ASCENDING),
+            ("CreatedAt", pymongo.ASCENDING),
+        ],
+        "options": {},
+        "covers": [
+            "jobQueue.claimJob: jobs.find_one_and_update({Status, ...}) "
+            "oldest first",
+        ],
+    },
+    {
+        "collection": "users",
+        "keys": [("google_id", pymongo.ASCENDING)],
+        "options": {"unique": True},
+        "covers": [
+            "google_auth_handler.lambda_handler: users.find_one({google_id})",
+        ],
+    },
+]
+
+# set once ensureIndexes has brought the indexes up to date
+_ensured = False
+# the running bootstrap task, and when a failed one may be retried
+_pending = None
+_retryAt = 0.0
+INDEX_RETRY_SECONDS = float(os.getenv("INDEX_RETRY_SECONDS", "60"))
+
+# createIndexes error codes: documents share a unique key, and an
+# index of that name exists with other options (or keys)
+DUPLICATE_KEY_CODES = (11000, 11001)
+OPTIONS_CONFLICT_CODES = (85, 86)
+
+
+def indexName(spec):
+    """Name MongoDB gives the index by default, e.g. UUID_1"""
+    return "_".join(f"{field}_{direction}" for field, direction in spec["keys"])
+
+
+def indexReport():
+    """
+    Describe every declared index and the queries it covers
+
+    Returns:
+        list: one dict per index with collection, name, keys,
+        options and covers
+    """
+    return [
+        {
+            "collection": spec["collection"],
+            "name": indexName(spec),
+            "keys": spec["keys"],
+            "options": spec["options"],
+            "covers": spec["covers"],
+        }
+        for spec in INDEXES
+    ]
+
+
+def selectIndexes(collections=None):
+    """Declared indexes, optionally limited to some collections"""
+    return [
+        spec for spec in INDEXES
+        if collections is None or spec["collection"] in collections
+    ]
+
+
+def buildResult(version, applied, failed, skipped=False, duplicates=()):
+    return {
+        "success": not failed,
+        "version": version,
+        "skipped": skipped,
+        "applied": applied,
+        "failed": failed,
+        "duplicates": list(duplicates),
+    }
+
+
+class IndexRun:
+    """
+    The driver-independent part of applyIndexes / applyIndexesSync:
+    what to create, what came of it and whether the version can be
+    recorded. The two functions only do the I/O.
+    """
+
+    def __init__(self, meta, force=False, collections=None):
+        self.stored = (meta or {}).get("version", 0)
+        self.skipped = self.stored >= INDEX_VERSION and not force
+        self.specs = [] if self.skipped else selectIndexes(collections)
+        self.partial = collections is not None
+        self.applied, self.failed, self.duplicates = [], [], []
+
+    def created(self, spec, name):
+        self.applied.append(f"{spec['collection']}.{name}")
+
+    def conflicting(self, spec, error):
+        """
+        The index exists with other options or keys: drop it and
+        create it again
+        """
+        if getattr(error, "code", None) not in OPTIONS_CONFLICT_CODES:
+            return False
+        logger.warning(f"Index {spec['collection']}.{indexName(spec)} "
+                       f"exists with other options, rebuilding it: "
+                       f"{error}")
+        return True
+
+    def failure(self, spec, error):
+        name = f"{spec['collection']}.{indexName(spec)}"
+        code = getattr(error, "code", None)
+        if code in DUPLICATE_KEY_CODES:
+            logger.error(f"Index {name} cannot be built, existing "
+                         f"documents share a value; remove the "
+                         f"duplicates and run python -m src.dbIndexes: "
+                         f"{error}")
+            self.duplicates.append(name)
+        else:
+            logger.error(f"Index {name} failed: {error}")
+        self.failed.append(f"{name}: {error}")
+
+    @property
+    def complete(self):
+        """Every index was applied, the version can be recorded"""
+        return not self.skipped and not self.failed and not self.partial
+
+    def recorded(self):
+        self.stored = INDEX_VERSION
+
+    def result(self):
+        return buildResult(self.stored, self.applied, self.failed,
+                           skipped=self.skipped, duplicates=self.duplicates)
+
+
+# find_one / update_one arguments of the stored version
+META_QUERY = {"_id": META_ID}
+META_UPDATE = {"$set": {"version": INDEX_VERSION}}
+
+
+# ===========================================
+# Purpose: Create any indexes the stored schema version
+# does not have yet and record the new version.
+
+# Arguments: motor db, force (re-apply even if up to date),
+# collections (limit to these collections, the version is
+# only recorded when every collection was applied)
+
+# Return: dict with success, version, applied and failed
+# ============================================
+async def applyIndexes(db, force=False, collections=None):
+    run = IndexRun(
+        await db[META_COLLECTION].find_one(META_QUERY), force, collections
+    )
+    for spec in run.specs:
+        collection = db[spec["collection"]]
+        try:
+            try:
+                name = await collection.create_index(
+                    spec["keys"], **spec["options"]
+                )
+            except pymongo.errors.OperationFailure as e:
+                if not run.conflicting(spec, e):
+                    raise
+                await collection.drop_index(indexName(spec))
+                name = await collection.create_index(
+                    spec["keys"], **spec["options"]
+                )
+            run.created(spec, name)
+        except Exception as e:
+            run.failure(spec, e)
+    if run.complete:
+        await db[META_COLLECTION].update_one(
+            META_QUERY, META_UPDATE, upsert=True
+        )
+        run.recorded()
+    return run.result()
+
+
+# ===========================================
+# Purpose: Same as applyIndexes for a synchronous
+# pymongo db (used by the auth Lambda).
+# ============================================
+def applyIndexesSync(db, force=False, collections=None):
+    run = IndexRun(
+        db[META_COLLECTION].find_one(META_QUERY), force, collections
+    )
+    for spec in run.specs:
+        collection = db[spec["collection"]]
+        try:
+            try:
+                name = collection.create_index(
+                    spec["keys"], **spec["options"]
+                )
+            except pymongo.errors.OperationFailure as e:
+                if not run.conflicting(spec, e):
+                    raise
+                collection.drop_index(indexName(spec))
+                name = collection.create_index(
+                    spec["keys"], **spec["options"]
+                )
+            run.created(spec, name)
+        except Exception as e:
+            run.failure(spec, e)
+    if run.complete:
+        db[META_COLLECTION].update_one(META_QUERY, META_UPDATE, upsert=True)
+        run.recorded()
+    return run.result()
+
+
+# ===========================================
+# Purpose: Startup hook. Starts applying the indexes in
+# a background task and returns straight away, so the
+# build time is not added to the request that triggered
+# it. Once a run succeeds later calls do nothing; after a
+# failure the next call retries, at most every
+# INDEX_RETRY_SECONDS, unless duplicates block a unique
+# index (then not before the next process start). Errors
+# are logged, never raised, so a read-only user can still
+# serve requests.
+
+# Argument: motor db
+
+# Return: the background task, None when nothing was
+# started
+# ============================================
+async def ensureIndexes(db):
+    global _pending
+    if _ensured or time.monotonic() < _retryAt:
+        return None
+    if _pending is not None and not _pending.done():
+        return None
+    # a fresh context: the build must not count against the
+    # triggering request's query budget or deadline
+    _pending = asyncio.create_task(
+        bootstrapIndexes(db), context=contextvars.Context()
+    )
+    return _pending
+
+
+async def bootstrapIndexes(db):
+    global _ensured, _retryAt
+    try:
+        result = await applyIndexes(db)
+    except Exception as e:
+        logger.error(f"Index bootstrap skipped: {e}")
+        _retryAt = time.monotonic() + INDEX_RETRY_SECONDS
+        return
+    if result.get("duplicates"):
+        # no retry can get past these until the data is cleaned up
+        logger.error(f"Indexes left below version {INDEX_VERSION}, "
+                     f"duplicates block {result['duplicates']}")
+        _retryAt = float("inf")
+        return
+    if not result["success"]:
+        logger.error(f"Indexes left below version {INDEX_VERSION}, "
+                     f"retrying in {INDEX_RETRY_SECONDS:g}s: "
+                     f"{result['failed']}")
+        _retryAt = time.monotonic() + INDEX_RETRY_SECONDS
+        return
+    _ensured = True
+    if not result["skipped"]:
+        logger.info(f"Indexes at version {result['version']}: "
+                    f"{result['applied']}")
+
+
+if __name__ == "__main__":
+    from src.mongodb import getDb, closeDbClients
+
+    async def main():
+        try:
+            result = await applyIndexes(getDb(), force=True)
+            print(f"Index version {result['version']}")
+            for line in result["applied"]:
+                print(f"  applied {line}")
+            for line in result["failed"]:
+                print(f"  FAILED  {line}")
+            for spec in indexReport():
+                print(f"{spec['collection']}.{spec['name']}")
+                for query in spec["covers"]:
+                    print(f"    covers {query}")
+        finally:
+            closeDbClients()
+
+    asyncio.run(main())
@@ -0,0 +1,249 @@
+# ================================================
+# MongoDB driver instrumentation.
+
+# getClient() registers the listeners below on every
+# Motor client. They record:
+#   - latency per command name (find, insert, ...)
+#   - how long callers waited to check a connection
+#     out of the pool, and failed checkouts
+#   - connections created / ready / closed and pool clears
+# dbMetricsSnapshot() returns all of it, together with
+# process CPU time, so a slow request can be put down to
+# Mongo itself, pool starvation or our own CPU.
+
+# The listeners run on driver threads, hence the locks.
+# ================================================
+
+import os
+import threading
+import time
+from collections import defaultdict
+
+from pymongo import monitoring
+
+
+METRICS_ENABLED = os.getenv("MONGO_METRICS", "1") != "0"
+
+# upper bounds (ms) of the histogram buckets, the last bucket is open
+BUCKET_BOUNDS_MS = (
+    0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (milliseconds)"""
+
+    def __init__(self, bounds=BUCKET_BOUNDS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        index = 0
+        while index < len(self.bounds) and ms > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucketCount in enumerate(self.counts):
+            seen += bucketCount
+            if seen >= rank:
+                bound = (self.bounds[index] if index < len(self.bounds)
+                         else self.max)
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        buckets = {
+            f"<={bound}": count
+            for bound, count in zip(self.bounds, self.counts)
+            if count
+        }
+        if self.counts[-1]:
+            buckets[f">{self.bounds[-1]}"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count else 0.0,
+            "max_ms": self.max,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": buckets,
+        }
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Latency and failures per command name"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latency = defaultdict(LatencyHistogram)
+            self.failures = defaultdict(int)
+            self.inFlight = 0
+
+    def started(self, event):
+        with self.lock:
+            self.inFlight += 1
+
+    def succeeded(self, event):
+        with self.lock:
+            self.inFlight -= 1
+            self.latency[event.command_name].record(
+                event.duration_micros / 1000
+            )
+
+    def failed(self, event):
+        with self.lock:
+            self.inFlight -= 1
+            self.latency[event.command_name].record(
+                event.duration_micros / 1000
+            )
+            self.failures[event.command_name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "in_flight": self.inFlight,
+                "commands": {
+                    name: dict(
+                        histogram.snapshot(),
+                        failures=self.failures.get(name, 0),
+                    )
+                    for name, histogram in sorted(self.latency.items())
+                },
+            }
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection checkout waits and connection lifecycle counts"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.checkoutWait = LatencyHistogram()
+            self.checkoutFailures = defaultdict(int)
+            self.waiting = 0
+            self.checkedOut = 0
+            self.created = 0
+            self.ready = 0
+            self.closed = defaultdict(int)
+            self.cleared = 0
+            self.connectionSetup = LatencyHistogram()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        with self.lock:
+            self.ready += 1
+            self.connectionSetup.record(event.duration * 1000)
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.closed[str(event.reason)] += 1
+
+    def connection_check_out_started(self, event):
+        with self.lock:
+            self.waiting += 1
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.waiting -= 1
+            self.checkoutWait.record(event.duration * 1000)
+            self.checkoutFailures[str(event.reason)] += 1
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.waiting -= 1
+            self.checkedOut += 1
+            self.checkoutWait.record(event.duration * 1000)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checkedOut -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "checkout_wait": self.checkoutWait.snapshot(),
+                "checkout_failures": dict(self.checkoutFailures),
+                "waiting": self.waiting,
+                "checked_out": self.checkedOut,
+                "connections_created": self.created,
+                "connections_ready": self.ready,
+                "connection_setup": self.connectionSetup.snapshot(),
+                "connections_closed": dict(self.closed),
+                "pool_cleared": self.cleared,
+            }
+
+
+class DbMetrics:
+    """The listeners getClient() registers, plus snapshot / reset"""
+
+    def __init__(self):
+        self.commands = CommandMetrics()
+        self.pool = PoolMetrics()
+        self.resetAt = time.monotonic()
+        self.cpuAtReset = time.process_time()
+
+    def listeners(self):
+        return [self.commands, self.pool] if METRICS_ENABLED else []
+
+    def snapshot(self):
+        return {
+            "commands": self.commands.snapshot(),
+            "pool": self.pool.snapshot(),
+            "process": {
+                "wall_seconds": time.monotonic() - self.resetAt,
+                "cpu_seconds": time.process_time() - self.cpuAtReset,
+            },
+        }
+
+    def reset(self):
+        self.commands.reset()
+        self.pool.reset()
+        self.resetAt = time.monotonic()
+        self.cpuAtReset = time.process_time()
+
+
+dbMetrics = DbMetrics()
+
+
+def dbMetricsSnapshot():
+    """Command latency, pool and process CPU metrics since the last reset"""
+    return dbMetrics.snapshot()
+
+
+def resetDbMetrics():
+    dbMetrics.reset()
@@ -1,8 +1,10 @@
 import motor.motor_asyncio
 from dotenv import load_dotenv
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import logging
+from src.mongodb import getClient
+from src.cache import orderCache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -35,8 +37,8 @@ class InvalidOrderReferenceError(Exception):
 
 async def get_db_connection() -> tuple[motor.motor_asyncio.
                                        AsyncIOMotorClient, Any]:
-    """Establish MongoDB connection."""
-    client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URI)
+    """Get the shared client for MONGODB_URI and check it responds."""
+    client = getClient(MONGODB_URI)
     db = client[DATABASE_NAME]
     try:
         await client.admin.command('ping')
@@ -50,7 +52,8 @@ async def get_db_connection() -> tuple[motor.motor_asyncio.
 async def create_order_reference(
     order_id: str,
     sales_order_id: str,
-    collection: motor.motor_asyncio.AsyncIOMotorCollection
+    collection: motor.motor_asyncio.AsyncIOMotorCollection,
+    order: Optional[Dict[str, Any]] = None
 ) -> Dict[str, Any]:
     """
     Creates/updates an OrderReference and returns the complete document.
@@ -59,6 +62,8 @@ async def create_order_reference(
         order_id: The order ID
         sales_order_id: The sales order ID
         collection: MongoDB collection instance
+        order: Already loaded order document. Skips the existence
+            lookup and updates that document directly.
 
     Returns:
         The complete order reference document
@@ -71,10 +76,16 @@ async def create_order_reference(
         raise InvalidOrderReferenceError("IDs must be strings")
 
     # Check if order exists
-    existing_order = await collection.find_one({"ID": order_id})
+    existing_order = order
+    if existing_order is None:
+        existing_order = await collection.find_one({"ID": order_id})
     if not existing_order:
         raise OrderNotFoundError(f"Order {order_id} not found")
 
+    query = {"ID": order_id}
+    if "_id" in existing_order:
+        query = {"_id": existing_order["_id"]}
+
     # Create update document
     update_data = {
         "$set": {
@@ -87,10 +98,13 @@ async def create_order_reference(
 
     # Perform upsert and return the document
     result = await collection.find_one_and_update(
-        {"ID": order_id},
+        query,
         update_data,
         upsert=True,
         return_document=True
     )
+    # cached copies of the order no longer match the stored one
+    orderCache.invalidateTag(order_id)
+    orderCache.invalidateTag(existing_order.get("UUID"))
 
     return result
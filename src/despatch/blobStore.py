@@ -0,0 +1,230 @@
+# ================================================
+# Blob storage for despatch artifacts too large to
+# keep inline (XML for despatches with thousands of
+# lines, rendered PDFs).
+
+# Anything above BLOB_THRESHOLD_BYTES is written to a
+# blob store and the despatch document keeps only a
+# small reference (XMLRef / PDFRef):
+#   {"store": "gridfs" | "local", "id": ..., "length": n,
+#    "compressed": bool}
+
+# GridFSBlobStore keeps blobs in MongoDB (GridFS bucket
+# despatch_blobs). LocalBlobStore writes them to a
+# directory, for the memory backend and local runs.
+# Reads stream the blob back chunk by chunk.
+# ================================================
+
+import asyncio
+import base64
+import os
+import uuid
+
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from src.despatch.xmlStorage import (
+    decode_xml,
+    encode_xml,
+    stream_decode_xml,
+)
+from src.mongodb import DB_BACKEND, getDb
+
+
+# inline payloads above this size (in stored bytes) are offloaded
+BLOB_THRESHOLD_BYTES = int(os.getenv("BLOB_THRESHOLD_BYTES", str(1024 * 1024)))
+BLOB_STORE = os.getenv(
+    "BLOB_STORE", "local" if DB_BACKEND == "memory" else "gridfs"
+).lower()
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join("/tmp", "despatch_blobs"))
+BLOB_BUCKET = os.getenv("BLOB_BUCKET", "despatch_blobs")
+BLOB_CHUNK_BYTES = int(os.getenv("BLOB_CHUNK_BYTES", str(255 * 1024)))
+
+
+class GridFSBlobStore:
+    """Blobs in a GridFS bucket on the given Motor database"""
+
+    name = "gridfs"
+
+    def __init__(self, db, bucket_name=BLOB_BUCKET,
+                 chunk_size=BLOB_CHUNK_BYTES):
+        self.bucket = AsyncIOMotorGridFSBucket(
+            db, bucket_name=bucket_name, chunk_size_bytes=chunk_size
+        )
+
+    async def put(self, data, filename, metadata=None):
+        """Store data, returning the id to reference it by"""
+        return await self.bucket.upload_from_stream(
+            filename, data, metadata=metadata or {}
+        )
+
+    async def stream(self, blob_id):
+        """Yield the blob one GridFS chunk at a time"""
+        grid_out = await self.bucket.open_download_stream(blob_id)
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            yield chunk
+
+    async def delete(self, blob_id):
+        await self.bucket.delete(blob_id)
+
+
+class LocalBlobStore:
+    """Blobs as files in a local directory"""
+
+    name = "local"
+
+    def __init__(self, root=BLOB_DIR, chunk_size=BLOB_CHUNK_BYTES):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def path(self, blob_id):
+        # ids are generated here, never taken from a request
+        return os.path.join(self.root, os.path.basename(blob_id))
+
+    def write(self, blob_id, data):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.path(blob_id), "wb") as blob:
+            blob.write(data)
+
+    async def put(self, data, filename, metadata=None):
+        blob_id = f"{uuid.uuid4().hex}-{os.path.basename(filename)}"
+        await asyncio.to_thread(self.write, blob_id, data)
+        return blob_id
+
+    async def stream(self, blob_id):
+        blob = await asyncio.to_thread(open, self.path(blob_id), "rb")
+        try:
+            while True:
+                chunk = await asyncio.to_thread(blob.read, self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            blob.close()
+
+    async def delete(self, blob_id):
+        try:
+            await asyncio.to_thread(os.remove, self.path(blob_id))
+        except FileNotFoundError:
+            pass
+
+
+def get_blob_store(store=None, db=None):
+    """
+    Blob store by name
+
+    Args:
+        store (str, optional): "gridfs" or "local", defaults to BLOB_STORE
+        db: Motor database for GridFS, defaults to the shared one
+
+    Returns:
+        GridFSBlobStore | LocalBlobStore
+    """
+    store = store or BLOB_STORE
+    if store == "local":
+        return LocalBlobStore()
+    if store == "gridfs":
+        return GridFSBlobStore(db if db is not None else getDb())
+    raise ValueError(f"Unknown blob store: {store}")
+
+
+async def offload(data, filename, compressed=False, metadata=None, db=None):
+    """
+    Write a payload to the blob store
+
+    Returns:
+        dict: Reference to keep in the despatch document
+    """
+    store = get_blob_store(db=db)
+    blob_id = await store.put(data, filename, metadata)
+    return {
+        "store": store.name,
+        "id": blob_id,
+        "length": len(data),
+        "compressed": compressed,
+    }
+
+
+async def stream_blob(ref, db=None):
+    """Yield the raw bytes of a referenced blob in chunks"""
+    store = get_blob_store(ref["store"], db)
+    async for chunk in store.stream(ref["id"]):
+        yield chunk
+
+
+async def read_blob(ref, db=None):
+    """Whole referenced blob as bytes"""
+    return b"".join([chunk async for chunk in stream_blob(ref, db)])
+
+
+async def delete_blob(ref, db=None):
+    if ref:
+        await get_blob_store(ref["store"], db).delete(ref["id"])
+
+
+async def store_xml(despatch_id, xml_string, db=None):
+    """
+    Fields to store for a despatch's XML: XMLData inline when it fits
+    under BLOB_THRESHOLD_BYTES, otherwise an XMLRef to the offloaded blob
+
+    Args:
+        despatch_id (str): Despatch the XML belongs to (blob file name)
+        xml_string (str): XML document
+        db: Motor database for GridFS, defaults to the shared one
+
+    Returns:
+        dict: {"XMLData": ..., "XMLRef": ...}
+    """
+    stored = encode_xml(xml_string)
+    compressed = not isinstance(stored, str)
+    data = bytes(stored) if compressed else stored.encode("utf-8")
+    if len(data) <= BLOB_THRESHOLD_BYTES:
+        return {"XMLData": stored, "XMLRef": None}
+
+    ref = await offload(
+        data, f"{despatch_id}.xml", compressed,
+        {"despatch_id": despatch_id, "kind": "xml"}, db,
+    )
+    return {"XMLData": None, "XMLRef": ref}
+
+
+async def stream_base64(ref, db=None):
+    """
+    Yield a referenced blob base64 encoded, one chunk at a time. Each
+    piece but the last encodes a multiple of 3 bytes, so the pieces
+    join into the encoding of the whole blob.
+    """
+    pending = b""
+    async for chunk in stream_blob(ref, db):
+        pending += chunk
+        whole = len(pending) - len(pending) % 3
+        if whole:
+            yield base64.b64encode(pending[:whole]).decode("ascii")
+            pending = pending[whole:]
+    if pending:
+        yield base64.b64encode(pending).decode("ascii")
+
+
+async def stream_despatch_xml(despatch, db=None):
+    """
+    Yield a despatch's XML as text chunks, streaming (and
+    decompressing) offloaded blobs. Only a caller that consumes the
+    chunks as they come avoids holding the whole document.
+    """
+    ref = despatch.get("XMLRef")
+    if not ref:
+        xml_data = decode_xml(despatch.get("XMLData", ""))
+        if xml_data:
+            yield xml_data
+        return
+
+    chunks = stream_blob(ref, db)
+    async for text in stream_decode_xml(chunks, ref.get("compressed", True)):
+        yield text
+
+
+async def load_despatch_xml(despatch, db=None):
+    """Full XML of a despatch, wherever it is stored, as one string"""
+    return "".join([text async for text in stream_despatch_xml(despatch, db)])
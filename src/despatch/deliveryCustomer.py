@@ -1,22 +1,36 @@
 import os
-from src.mongodb import getOrderInfo, dbConnect
+from src.mongodb import getOrderInfo, dbConnect, releaseClient
+
+# the only parts of the order deliveryCustomer reads
+CUSTOMER_PROJECTION = {
+    "DeliveryCustomerParty": 1,
+    "CustomerAssignedAccountID": 1,
+    "SupplierAssignedAccountID": 1,
+    "Party": 1,
+}
 
 dirPath = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "..")
 )
 
 
-async def deliveryCustomer(UUID):
+async def deliveryCustomer(UUID, order: dict = None):
+    mongoClient = None
     try:
-        mongoClient, db = await dbConnect()
+        if order is None:
+            mongoClient, db = await dbConnect()
     except Exception as e:
         raise ValueError(f"Database connection error: {e}")
 
     try:
-        orders = db["orders"]
+        data = order
+        if data is None:
+            orders = db["orders"]
 
-        # Retrieve the order document.
-        data = await getOrderInfo(UUID, orders)
+            # Retrieve the order document.
+            data = await getOrderInfo(
+                UUID, orders, projection=CUSTOMER_PROJECTION
+            )
 
         # is "DeliveryCustomerParty" present; otherwise,
         # assume the returned document is already the delivery data.
@@ -116,4 +130,5 @@ async def deliveryCustomer(UUID):
     except Exception as e:
         raise ValueError(f"Database connection error: {e}")
     finally:
-        mongoClient.close()
+        if mongoClient is not None:
+            releaseClient(mongoClient)
@@ -3,15 +3,36 @@ import uuid
 import datetime
 import json
 from lxml import etree
+from pymongo.errors import DuplicateKeyError
 from src.mongodb import (
     getOrderInfo,
     addOrder,
     dbConnect,
     updateDocument,
     deleteDocument,
+    getDb,
+    listDespatches,
+    releaseClient,
+    creationDate,
+    jsonDefault,
+    despatchQuery,
 )
+from src.admission import Overloaded, xmlLimiter
+from src.requestDeadline import DeadlineExceeded, withDeadline
+from src.despatch.listing import list_response
+from src.idGenerator import DESPATCH_PREFIX, withFreshId
+from src.cache import despatchCache, cacheNamespace, documentTags
 from src.despatch.xmlConversion import json_to_xml
 from src.despatch.xmlConversion import xml_to_pdf
+from src.despatch.blobStore import (
+    BLOB_THRESHOLD_BYTES,
+    delete_blob,
+    load_despatch_xml,
+    offload,
+    read_blob,
+    store_xml,
+    stream_base64,
+)
 
 
 async def addDespatchAdvice(data):
@@ -22,7 +43,7 @@ async def addDespatchAdvice(data):
             result = await addOrder(data, db)
             return result
         finally:
-            client.close()
+            releaseClient(client)
     except Exception as error:
         print(f"MongoDB request failed: {error}")
         return None
@@ -33,14 +54,24 @@ async def getDespatchAdvice(despatchId):
     try:
         client, db = await dbConnect()
         try:
-            # Try to find it by DespatchID first
-            result = await db.despatches.find_one({"DespatchID": despatchId})
-            if not result:
-                # Try by UUID as a fallback
-                result = await db.despatches.find_one({"UUID": despatchId})
-            return result
+            async def load():
+                # Try to find it by ID first (create_despatch_advice
+                # stores it as ID, older documents as DespatchID)
+                result = await db.despatches.find_one(
+                    despatchQuery(despatchId, ("ID", "DespatchID"))
+                )
+                if not result:
+                    # Try by UUID as a fallback
+                    result = await db.despatches.find_one({"UUID": despatchId})
+                return result
+
+            return await despatchCache.getOrLoad(
+                (cacheNamespace(db), despatchId),
+                load,
+                documentTags("DespatchID", "UUID", "ID"),
+            )
         finally:
-            client.close()
+            releaseClient(client)
     except Exception as error:
         print(f"MongoDB fetch failed: {error}")
         return None
@@ -76,13 +107,90 @@ def generate_initial_xml(despatch_id, issue_date):
 </DespatchAdvice>"""
 
 
-async def create_despatch_advice(event_body):
+async def build_despatch_document(despatch_id, order_id, order, body):
+    """
+    Build the despatch advice document and its XML
+
+    Args:
+        despatch_id (str): ID of the new despatch advice
+        order_id (str): ID of the order being despatched
+        order (dict): The order document
+        body (dict): Create request body
+
+    Returns:
+        tuple: (despatch document, XML string)
+    """
+    despatch_uuid = str(uuid.uuid4())
+    current_date = datetime.datetime.now().strftime("%Y-%m-%d")
+
+    # Get the initial XML structure
+    xml_content = generate_initial_xml(despatch_id, current_date)
+
+    # Extract all the components from the request body
+    supplier_info = body.get("supplier", {})
+    customer_info = body.get("customer", {})
+    order_reference = body.get("order_reference", {})
+    shipment_info = body.get("shipment", {})
+    despatch_line_info = body.get("despatch_line", {})
+
+    # Create a complete JSON structure for the despatch advice
+    complete_despatch_json = {
+        "ID": despatch_id,
+        "UUID": despatch_uuid,
+        "OrderID": order_id,
+        "CustomerID": order.get("CustomerID"),
+        "Status": "Initiated",
+        "SupplierInfo": supplier_info,
+        "CustomerInfo": customer_info,
+        "OrderReference": order_reference,
+        "Shipment": shipment_info.get(
+            "document"
+        ) if isinstance(
+            shipment_info, dict
+        ) and "document" in shipment_info else shipment_info,
+        "DespatchLine": despatch_line_info.get(
+            "DespatchLine"
+        ) if isinstance(
+            despatch_line_info, dict
+        ) and "DespatchLine" in despatch_line_info else
+        despatch_line_info,
+        "CreationDate": creationDate(),
+        "XMLData": xml_content,
+        "LastModified": datetime.datetime.now().isoformat(),
+    }
+
+    # If the components have enough data, generate a better XML
+    if (
+        supplier_info or
+        customer_info or
+        order_reference or
+        shipment_info or
+        despatch_line_info
+    ):
+        try:
+            # lxml rendering, off the event loop and admission limited
+            xml_content = await xmlLimiter.run(
+                json_to_xml, complete_despatch_json, "DespatchAdvice"
+            )
+            complete_despatch_json["XMLData"] = xml_content
+        except Overloaded:
+            raise
+        except Exception as xml_error:
+            # If XML generation fails, keep the initial basic XML
+            print(f"Failed to generate complex XML: {str(xml_error)}")
+
+    return complete_despatch_json, xml_content
+
+
+async def create_despatch_advice(event_body, order=None):
     """
     Create a new despatch advice document
 
     Args:
         event_body (dict): The JSON body of the request
         containing order_id, supplier, customer, and other optional components
+        order (dict, optional): Already loaded order document, skips the
+        order lookup
 
     Returns:
         dict: Response containing despatch_id, status, and xml_link
@@ -102,7 +210,8 @@ async def create_despatch_advice(event_body):
 
         client, db = await dbConnect()
         try:
-            order = await getOrderInfo(order_id, db)
+            if order is None:
+                order = await getOrderInfo(order_id, db)
 
             if not order:
                 return {
@@ -110,69 +219,27 @@ async def create_despatch_advice(event_body):
                     "body": json.dumps({"error": "Order does not exist"}),
                 }
 
-            # Generate a random hex string for despatch ID
-            random_hex = uuid.uuid4().hex[:8].upper()
-            despatch_id = f"D-{random_hex}"
-            despatch_uuid = str(uuid.uuid4())
-            current_date = datetime.datetime.now().strftime("%Y-%m-%d")
-
-            # Get the initial XML structure
-            xml_content = generate_initial_xml(despatch_id, current_date)
-
-            # Extract all the components from the request body
-            supplier_info = body.get("supplier", {})
-            customer_info = body.get("customer", {})
-            order_reference = body.get("order_reference", {})
-            shipment_info = body.get("shipment", {})
-            despatch_line_info = body.get("despatch_line", {})
-
-            # Create a complete JSON structure for the despatch advice
-            complete_despatch_json = {
-                "ID": despatch_id,
-                "UUID": despatch_uuid,
-                "OrderID": order_id,
-                "Status": "Initiated",
-                "SupplierInfo": supplier_info,
-                "CustomerInfo": customer_info,
-                "OrderReference": order_reference,
-                "Shipment": shipment_info.get(
-                    "document"
-                ) if isinstance(
-                    shipment_info, dict
-                ) and "document" in shipment_info else shipment_info,
-                "DespatchLine": despatch_line_info.get(
-                    "DespatchLine"
-                ) if isinstance(
-                    despatch_line_info, dict
-                ) and "DespatchLine" in despatch_line_info else
-                despatch_line_info,
-                "CreationDate": current_date,
-                "XMLData": xml_content,
-                "LastModified": datetime.datetime.now().isoformat(),
-            }
-
-            # If the components have enough data, generate a better XML
-            if (
-                supplier_info or
-                customer_info or
-                order_reference or
-                shipment_info or
-                despatch_line_info
-            ):
+            async def insert(despatch_id):
+                despatch, xml = await build_despatch_document(
+                    despatch_id, order_id, order, body
+                )
+                # Stored copy carries the compressed (or offloaded) XML,
+                # the response keeps the plain string (and no ObjectId _id)
+                stored_despatch = dict(
+                    despatch, **await store_xml(despatch_id, xml, db)
+                )
                 try:
-                    xml_content = json_to_xml(
-                        complete_despatch_json,
-                        "DespatchAdvice"
-                    )
-                    complete_despatch_json["XMLData"] = xml_content
-                except Exception as xml_error:
-                    # If XML generation fails, keep the initial basic XML
-                    print(f"Failed to generate complex XML: {str(xml_error)}")
-
-            # Use the despatches collection
-            inserted_id = await db.despatches.insert_one(
-                complete_despatch_json
+                    result = await db.despatches.insert_one(stored_despatch)
+                except DuplicateKeyError:
+                    await delete_blob(stored_despatch["XMLRef"], db)
+                    raise
+                return despatch, xml, result
+
+            # Time-ordered ID, a new one is drawn if it is already taken
+            complete_despatch_json, xml_content, inserted_id = (
+                await withFreshId(DESPATCH_PREFIX, insert, "ID")
             )
+            despatch_id = complete_despatch_json["ID"]
 
             if not inserted_id:
                 return {
@@ -192,11 +259,13 @@ async def create_despatch_advice(event_body):
 
             return {
                 "statusCode": 200,
-                "body": json.dumps(response_data),
+                "body": json.dumps(response_data, default=jsonDefault),
             }
         finally:
-            client.close()
+            releaseClient(client)
 
+    except Overloaded:
+        raise
     except Exception as e:
         print(f"Error creating despatch advice: {str(e)}")
         return {
@@ -224,12 +293,14 @@ async def validate_despatch_advice(despatch_id):
                 "body": json.dumps({"error": "Despatch Advice not found"}),
             }
 
-        xml_data = despatch.get("XMLData", "")
+        xml_data = await load_despatch_xml(despatch)
 
         validation_issues = []
 
         try:
-            root = etree.fromstring(xml_data.encode("utf-8"))
+            root = await xmlLimiter.run(
+                etree.fromstring, xml_data.encode("utf-8")
+            )
 
             required_elements = [".//cbc:ID", ".//cbc:IssueDate"]
 
@@ -265,7 +336,7 @@ async def validate_despatch_advice(despatch_id):
             validation_issues.append(f"XML syntax error: {str(e)}")
 
         response = {
-            "despatch_id": despatch.get("DespatchID"),
+            "despatch_id": despatch.get("ID") or despatch.get("DespatchID"),
             "validation_status": "Invalid" if validation_issues else "Valid",
         }
 
@@ -277,6 +348,8 @@ async def validate_despatch_advice(despatch_id):
 
         return {"statusCode": 200, "body": json.dumps(response)}
 
+    except Overloaded:
+        raise
     except Exception as e:
         print(f"Error validating despatch advice: {str(e)}")
         return {
@@ -304,7 +377,10 @@ async def get_despatch_xml(despatch_id):
                 "body": json.dumps({"error": "Despatch Advice not found"}),
             }
 
-        xml_data = despatch.get("XMLData", "")
+        # a Lambda body is one string, so the whole XML is joined
+        # here; callers that can consume chunks iterate
+        # stream_despatch_xml instead
+        xml_data = await load_despatch_xml(despatch)
 
         return {
             "statusCode": 200,
@@ -363,9 +439,11 @@ async def update_despatch_advice(despatch_id, event_body):
                     "body": json.dumps({"error": f"Invalid XML: {str(e)}"}),
                 }
 
-            # Update the despatch document with the new XML data
+            # Update the despatch document with the new XML data, any
+            # stored PDF was rendered from the old XML
             update_data = {
-                "XMLData": body["xml"],
+                **await store_xml(despatch_id, body["xml"], db),
+                "PDFRef": None,
                 "LastModified": datetime.datetime.now().isoformat(),
             }
 
@@ -377,11 +455,13 @@ async def update_despatch_advice(despatch_id, event_body):
             updated = await updateDocument(despatch_id, update_data, db)
 
             if not updated:
+                await delete_blob(update_data["XMLRef"], db)
                 return {
                     "statusCode": 500,
                     "body": json.dumps({"error":
                                         "Failed to update despatch advice"}),
                 }
+            await delete_stored_blobs(despatch, db)
 
             return {
                 "statusCode": 200,
@@ -390,7 +470,7 @@ async def update_despatch_advice(despatch_id, event_body):
             }
 
         finally:
-            client.close()
+            releaseClient(client)
 
     except Exception as e:
         print(f"Error updating despatch advice: {str(e)}")
@@ -400,6 +480,35 @@ async def update_despatch_advice(despatch_id, event_body):
         }
 
 
+async def list_despatches(query_params=None):
+    """
+    List despatch advices, newest first, one page at a time
+
+    Args:
+        query_params (dict, optional): customer_id, status, created_from
+        (inclusive), created_to (exclusive), limit and the cursor
+        returned with the previous page
+
+    Returns:
+        dict: Response containing despatches and next_cursor
+    """
+    return await list_response(
+        listDespatches, query_params, "despatches", despatch_summary
+    )
+
+
+def despatch_summary(despatch):
+    return {
+        "despatch_id": despatch.get("ID"),
+        "uuid": despatch.get("UUID"),
+        "order_id": despatch.get("OrderID"),
+        "customer_id": despatch.get("CustomerID"),
+        "status": despatch.get("Status"),
+        "creation_date": despatch.get("CreationDate"),
+        "last_modified": despatch.get("LastModified"),
+    }
+
+
 async def delete_despatch_advice(despatch_id):
     """
     Delete a despatch advice document
@@ -432,6 +541,7 @@ async def delete_despatch_advice(despatch_id):
                     "body": json.dumps({"error":
                                         "Failed to delete despatch advice"}),
                 }
+            await delete_stored_blobs(despatch, db)
 
             return {
                 "statusCode": 200,
@@ -440,7 +550,7 @@ async def delete_despatch_advice(despatch_id):
             }
 
         finally:
-            client.close()
+            releaseClient(client)
 
     except Exception as e:
         print(f"Error deleting despatch advice: {str(e)}")
@@ -450,6 +560,40 @@ async def delete_despatch_advice(despatch_id):
         }
 
 
+async def delete_stored_blobs(despatch, db):
+    """Remove the blobs a despatch document referenced"""
+    for field in ("XMLRef", "PDFRef"):
+        try:
+            await delete_blob(despatch.get(field), db)
+        except Exception as e:
+            print(f"Failed to delete {field} blob: {str(e)}")
+
+
+async def stored_or_rendered_pdf(despatch, xml_data):
+    """
+    PDF for a despatch: read from the blob store when an earlier
+    render was offloaded, otherwise rendered now. Renders larger than
+    BLOB_THRESHOLD_BYTES are offloaded and referenced by PDFRef.
+    """
+    pdf_ref = despatch.get("PDFRef")
+    if pdf_ref:
+        return await read_blob(pdf_ref)
+
+    pdf_data = await xml_to_pdf(xml_data)
+    if len(pdf_data) > BLOB_THRESHOLD_BYTES and "_id" in despatch:
+        despatch_id = despatch.get("ID") or despatch.get("DespatchID")
+        pdf_ref = await offload(
+            pdf_data, f"{despatch_id}.pdf",
+            metadata={"despatch_id": despatch_id, "kind": "pdf"},
+        )
+        await getDb().despatches.update_one(
+            {"_id": despatch["_id"]}, {"$set": {"PDFRef": pdf_ref}}
+        )
+        despatchCache.invalidateTag(despatch_id)
+    return pdf_data
+
+
+@withDeadline()
 async def generate_despatch_pdf(despatch_id):
     """
     Generate a PDF for a despatch advice
@@ -469,18 +613,25 @@ async def generate_despatch_pdf(despatch_id):
                 "body": json.dumps({"error": "Despatch Advice not found"}),
             }
 
-        xml_data = despatch.get("XMLData", "")
-        if not xml_data:
-            return {
-                "statusCode": 400,
-                "body": json.dumps({
-                    "error": "No XML data available for this despatch"
-                }),
-            }
+        pdf_ref = despatch.get("PDFRef")
+        if pdf_ref:
+            # an earlier render, base64 encoded chunk by chunk and
+            # joined into the (single string) body
+            pdf_b64 = "".join([
+                piece async for piece in stream_base64(pdf_ref)
+            ])
+        else:
+            xml_data = await load_despatch_xml(despatch)
+            if not xml_data:
+                return {
+                    "statusCode": 400,
+                    "body": json.dumps({
+                        "error": "No XML data available for this despatch"
+                    }),
+                }
 
-        # Generate PDF
-        pdf_data = await xml_to_pdf(xml_data)
-        pdf_b64 = base64.b64encode(pdf_data).decode('utf-8')
+            pdf_data = await stored_or_rendered_pdf(despatch, xml_data)
+            pdf_b64 = base64.b64encode(pdf_data).decode('utf-8')
 
         return {
             "statusCode": 200,
@@ -497,6 +648,11 @@ async def generate_despatch_pdf(despatch_id):
             }),
         }
 
+    except Overloaded as e:
+        return e.response()
+    except DeadlineExceeded:
+        # withDeadline turns it into a 504 naming the stage
+        raise
     except Exception as e:
         print(f"Error generating PDF: {str(e)}")
         return {
@@ -505,6 +661,7 @@ async def generate_despatch_pdf(despatch_id):
         }
 
 
+@withDeadline()
 async def send_despatch_notification(despatch_id, recipient_email=None):
     """
     Send an email notification for a despatch advice
@@ -531,8 +688,8 @@ async def send_despatch_notification(despatch_id, recipient_email=None):
             }
 
         # Generate PDF
-        xml_data = despatch.get("XMLData", "")
-        pdf_data = await xml_to_pdf(xml_data)
+        xml_data = await load_despatch_xml(despatch)
+        pdf_data = await stored_or_rendered_pdf(despatch, xml_data)
 
         # Determine recipient email
         if not recipient_email:
@@ -578,6 +735,11 @@ async def send_despatch_notification(despatch_id, recipient_email=None):
                 }),
             }
 
+    except Overloaded as e:
+        return e.response()
+    except DeadlineExceeded:
+        # withDeadline turns it into a 504 naming the stage
+        raise
     except Exception as e:
         print(f"Error sending notification: {str(e)}")
         return {
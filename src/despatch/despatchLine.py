@@ -1,7 +1,15 @@
 import os
 import sys
-from datetime import datetime
-from src.mongodb import dbConnect, getOrderInfo
+from src.mongodb import dbConnect, getDb, getOrderInfo, releaseClient
+from src.despatch.lineColumns import (
+    INSUFFICIENT_MESSAGE,
+    INVALID_MESSAGE,
+    NEEDED_KEYS,
+    parseExpiryDate,
+    parseLotNumber,
+    parseQuantity,
+    validateLineColumns,
+)
 import asyncio
 
 
@@ -13,126 +21,227 @@ import asyncio
 sys.path.append(os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "..")))
 
+# the only parts of the order a despatch line reads
+LINE_PROJECTION = {
+    "ID": 1,
+    "SalesOrderID": 1,
+    "UUID": 1,
+    "IssueDate": 1,
+    "OrderLine": 1,
+    "OrderID": 1,
+    "Items": 1,
+}
 
-def despatchLine(despatchLine: dict, UUID: str):
+
+class DespatchLineError(ValueError):
+    """
+    Invalid line specs; errors lists one message per bad line, report
+    is LineColumns.report() (bad fields per line) when there is one
+    """
+
+    def __init__(self, errors, report=None):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+        self.report = report
+
+
+def parseLineSpec(spec):
     """
-    Create a despatch line object with validation.
+    Validate and convert one line spec. Many lines at once go through
+    validateLineColumns instead.
 
     Args:
-        despatchLine (dict): Dictionary containing despatch line information
-        UUID (str): UUID of the corresponding order
+        spec (dict): Despatch line information, see despatchLine
 
     Returns:
-        dict: Formatted despatch line object
+        dict: The converted values
 
     Raises:
         ValueError: If required information is missing or invalid
     """
-    if despatchLine is None:
-        raise ValueError("Error: insufficient information entered.")
-
-    neededKeys = [
-        "DeliveredQuantity",
-        "BackOrderQuantity",
-        "ID",
-        "Note",
-        "BackOrderReason",
-        "LotNumber",
-        "ExpiryDate",
+    if not isinstance(spec, dict) or any(
+        key not in spec for key in NEEDED_KEYS
+    ):
+        raise ValueError(INSUFFICIENT_MESSAGE)
+    try:
+        return {
+            "ID": str(spec["ID"]),
+            "Note": str(spec["Note"]),
+            "DeliveredQuantity": parseQuantity(spec["DeliveredQuantity"]),
+            "BackOrderQuantity": parseQuantity(spec["BackOrderQuantity"]),
+            "BackOrderReason": str(spec["BackOrderReason"]),
+            "LotNumber": parseLotNumber(spec["LotNumber"]),
+            "ExpiryDate": parseExpiryDate(spec["ExpiryDate"]),
+            "LineID": spec.get("LineID"),
+        }
+    except (ValueError, TypeError, OverflowError):
+        raise ValueError(INVALID_MESSAGE)
+
+
+def orderLineItems(order):
+    """
+    The order's LineItems; OrderLine is one line or a list of them.
+    Orders stored by create_order have no OrderLine, only Items
+    (item_id, quantity, price): each becomes a LineItem numbered by
+    its position.
+    """
+    orderLines = order.get("OrderLine") or []
+    if isinstance(orderLines, dict):
+        orderLines = [orderLines]
+    if orderLines:
+        return [line.get("LineItem", {}) for line in orderLines]
+    return [
+        {
+            "ID": str(position + 1),
+            "Item": {
+                "SellersItemIdentification": {"ID": item.get("item_id")},
+            },
+        }
+        for position, item in enumerate(order.get("Items") or [])
+        if isinstance(item, dict)
     ]
 
-    for key in neededKeys:
-        if key not in despatchLine:
-            raise ValueError("Error: insufficient information entered.")
 
-    deliveredAmount = backOrderAmount = 0
-    iD = note = backOrderReason = date = ""
-    lotNum = 0
+def despatchLine(despatchLine: dict, UUID: str, order: dict = None):
+    """
+    Create a despatch line object with validation. A synchronous,
+    single-line wrapper over despatchLines kept for older callers: it
+    runs its own event loop, so async code must await despatchLines
+    instead.
 
-    try:
-        # type validations
-        deliveredAmount = int(float(despatchLine["DeliveredQuantity"]))
-        backOrderAmount = int(float(despatchLine["BackOrderQuantity"]))
-
-        # Handle LotNumber that might be a string with non-numeric characters
-        if isinstance(despatchLine["LotNumber"], str):
-            # Extract only digits if the string contains non-numeric characters
-            digits = "".join(filter(str.isdigit, despatchLine["LotNumber"]))
-            if digits:
-                lotNum = int(digits)
-            else:
-                raise ValueError("Invalid lot number format")
-        else:
-            lotNum = int(despatchLine["LotNumber"])
-
-        iD = str(despatchLine["ID"])
-        date = datetime.strptime(str(despatchLine["ExpiryDate"]), "%Y-%m-%d")
-        note = str(despatchLine["Note"])
-        backOrderReason = str(despatchLine["BackOrderReason"])
-    except (ValueError, TypeError):
-        # future fix here - change the string or refactor code
-        raise ValueError("Please re-enter an amount for quantity.")
-
-    # recursive call to apiEndpoint to restart the despatch creation
-    # with the backorder amounts
-    # if backOrderAmount > 0:
-    # future issue to be fixed - this will require another
-    # user arg/input for updated delivery date instead of recursion
+    Args:
+        despatchLine (dict): Dictionary containing despatch line information
+        UUID (str): UUID of the corresponding order
+        order (dict, optional): Already loaded order document. When given
+            the order is not fetched again.
 
+    Returns:
+        dict: Formatted despatch line object
+
+    Raises:
+        ValueError: If required information is missing or invalid
+        RuntimeError: If called while an event loop is running
+    """
     try:
-        mongoClient, db = asyncio.run(dbConnect())
-        orders = db["orders"]
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError(
+            "despatchLine cannot block a running event loop, "
+            "use await despatchLines([...], UUID) instead"
+        )
+
+    # checked here first for the single-line error messages
+    parseLineSpec(despatchLine)
+
+    async def build():
+        if order is not None:
+            return await despatchLines([despatchLine], UUID, order=order)
+        mongoClient, db = await dbConnect()
+        try:
+            return await despatchLines([despatchLine], UUID, db=db)
+        finally:
+            releaseClient(mongoClient)
 
-        data = asyncio.run(getOrderInfo(UUID, orders))
-        error = "Error: could not retrieve despatch supplier information."
-        if not data:
-            raise ValueError(error)
+    try:
+        lines = asyncio.run(build())
     except Exception as e:
+        if order is not None:
+            raise
         raise ValueError(f"Database error: {str(e)}")
-    finally:
-        if "mongoClient" in locals():
-            mongoClient.close()
+    return {"DespatchLine": lines["DespatchLine"][0]}
+
+
+async def despatchLines(lineSpecs, UUID, order=None, db=None):
+    """
+    Build the DespatchLine entries for any number of lines.
+
+    Every spec is validated before anything is built, and all the bad
+    lines are reported together. A spec may name the order line it
+    ships with "LineID" (the LineItem ID); otherwise lines pair up with
+    the order lines by position, falling back to the first one.
 
-    item = data["OrderLine"]["LineItem"]["Item"]
+    Args:
+        lineSpecs (list): Despatch line dicts, each with the keys
+            despatchLine needs
+        UUID (str): UUID of the corresponding order
+        order (dict, optional): Already loaded order document. When given
+            the order is not fetched again.
+        db (optional): Database to load the order from, the shared
+            client's by default
+
+    Returns:
+        dict: {"DespatchLine": [...]}, one entry per spec, in order
 
-    return {
-        "DespatchLine": {
-            "ID": iD,
-            "Note": note,
-            # another future fix here.add linestatuscode to body args
+    Raises:
+        DespatchLineError: If any spec is missing or invalid, with the
+            per-line report
+        ValueError: If the order cannot be found, or has neither
+            OrderLine nor Items
+    """
+    if not isinstance(lineSpecs, list) or not lineSpecs:
+        raise DespatchLineError([INSUFFICIENT_MESSAGE])
+
+    # all lines at once, column by column (src/despatch/lineColumns.py)
+    columns = validateLineColumns(lineSpecs)
+    if not columns.valid:
+        raise DespatchLineError(columns.messages(), columns.report())
+    parsed = columns.rows()
+
+    if order is None:
+        order = await getOrderInfo(
+            UUID, db if db is not None else getDb(),
+            projection=LINE_PROJECTION
+        )
+        if not order:
+            raise ValueError(
+                "Error: could not retrieve despatch supplier information."
+            )
+
+    lineItems = orderLineItems(order)
+    if not lineItems:
+        raise ValueError("Error: order has no order lines.")
+    itemsById = {str(item.get("ID")): item for item in lineItems}
+    orderReference = {
+        "ID": order.get("ID") or order.get("OrderID"),
+        "SalesOrderID": order.get("SalesOrderID"),
+        "UUID": order.get("UUID"),
+        "IssueDate": order.get("IssueDate"),
+    }
+
+    entries = []
+    for index, line in enumerate(parsed):
+        lineItem = itemsById.get(str(line["LineID"])) \
+            or (lineItems[index] if index < len(lineItems) else lineItems[0])
+        item = lineItem.get("Item", {})
+        entries.append({
+            "ID": line["ID"],
+            "Note": line["Note"],
             "LineStatusCode": "NoStatus",
-            # another future fix here - add metric to body args
-            # metric is missing "=KGM"
-            "DeliveredQuantity unitCode": deliveredAmount,
-            "BackOrderQuantity unitCode": backOrderAmount,
-            "BackOrderReason": backOrderReason,
+            "DeliveredQuantity unitCode": line["DeliveredQuantity"],
+            "BackOrderQuantity unitCode": line["BackOrderQuantity"],
+            "BackOrderReason": line["BackOrderReason"],
             "OrderLineReference": {
-                # another fix needed here
-                "LineID": 1,
-                # Another fix/issue
-                "SalesOrderLineID": "A",
-                "OrderReference": {
-                    "ID": data["ID"],
-                    "SalesOrderID": data["SalesOrderID"],
-                    "UUID": data["UUID"],
-                    "IssueDate": data["IssueDate"],
-                },
+                "LineID": lineItem.get("ID", 1),
+                "SalesOrderLineID": lineItem.get("SalesOrderID", "A"),
+                "OrderReference": orderReference,
             },
             "Item": {
-                "Description": item["Description"],
-                "Name": item["Name"],
+                "Description": item.get("Description"),
+                "Name": item.get("Name"),
                 "BuyersItemIdentification": {
-                    "ID": item["BuyersItemIdentification"]["ID"],
+                    "ID": item.get("BuyersItemIdentification", {}).get("ID"),
                 },
                 "SellersItemIdentification": {
-                    "ID": item["SellersItemIdentification"]["ID"],
+                    "ID": item.get("SellersItemIdentification", {}).get("ID"),
                 },
                 "ItemInstance": {
                     "LotIdentification": {
-                        "LotNumberID": lotNum,
-                        "ExpiryDate": date,
+                        "LotNumberID": line["LotNumber"],
+                        "ExpiryDate": line["ExpiryDate"],
                     }
                 },
             },
-        }
-    }
+        })
+    return {"DespatchLine": entries}
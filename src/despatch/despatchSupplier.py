@@ -1,5 +1,5 @@
 import os
-from src.mongodb import getOrderInfo, dbConnect
+from src.mongodb import getOrderInfo, dbConnect, releaseClient
 import copy
 
 
@@ -8,27 +8,32 @@ dirPath = os.path.abspath(os.path.abspath(os.path.join(
 
 
 # ==================================
-# Purpose
+# Purpose: Build the DespatchSupplierParty for an order
 
-# Arguments
+# Arguments: order UUID, and optionally the already
+# loaded order document (skips the db lookup)
 
-# Returns
+# Returns: DespatchSupplierParty dict
 # ==================================
 
 
-async def despatchSupplier(UUID: str):
-    mongoClient, db = await dbConnect()
-    orders = db["orders"]
+async def despatchSupplier(UUID: str, order: dict = None):
+    data = order
+    if data is None:
+        mongoClient, db = await dbConnect()
+        orders = db["orders"]
+
+        data = await getOrderInfo(
+            UUID, orders, projection={"SellerSupplierParty": 1}
+        )
+        releaseClient(mongoClient)
 
-    data = await getOrderInfo(UUID, orders)
     error = "Error: could not retrieve despatch supplier information."
     if not data:
-        mongoClient.close()
         raise ValueError(error)
 
     # assumes that seller = despatch. Logic to be added
     # Recursive O(n) copy
     DespatchSupplierParty = copy.deepcopy(data["SellerSupplierParty"])
 
-    mongoClient.close()
     return DespatchSupplierParty
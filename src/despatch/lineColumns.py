@@ -0,0 +1,281 @@
+# ================================================
+# Column-wise validation of despatch line specs.
+
+# despatchLines() used to convert every line on its own:
+# int(float(...)) on both quantities, digit filtering of
+# LotNumber and a strptime per ExpiryDate. For despatches
+# with thousands of lines validateLineColumns() pulls each
+# field out into a column and converts the column at once:
+#   - quantities become int64 columns, an array("q"),
+#     or with LINE_COLUMNS_NUMPY=1 (and NumPy installed,
+#     it is not in requirements.txt) one astype for a
+#     numeric column; quantities outside int64 are
+#     rejected, by parseQuantity too
+#   - lot numbers and expiry dates repeat a lot between
+#     lines, so each distinct value is parsed once
+# The result keeps the conversion rules of despatchLine
+# and reports the bad lines compactly, by line number
+# and the fields that are missing or invalid.
+# ================================================
+
+import os
+from array import array
+from datetime import datetime
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# opt-in: NumPy is an optional dependency
+LINE_COLUMNS_NUMPY = os.getenv("LINE_COLUMNS_NUMPY", "0") == "1"
+
+NEEDED_KEYS = (
+    "DeliveredQuantity",
+    "BackOrderQuantity",
+    "ID",
+    "Note",
+    "BackOrderReason",
+    "LotNumber",
+    "ExpiryDate",
+)
+NEEDED_KEY_SET = frozenset(NEEDED_KEYS)
+EXPIRY_DATE_FORMAT = "%Y-%m-%d"
+
+INSUFFICIENT_MESSAGE = "Error: insufficient information entered."
+INVALID_MESSAGE = "Please re-enter an amount for quantity."
+
+# quantities are stored as int64
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def parseQuantity(quantity):
+    """int(float(quantity)), OverflowError outside int64"""
+    value = int(float(quantity))
+    if not INT64_MIN <= value <= INT64_MAX:
+        raise OverflowError(f"Quantity out of range: {quantity}")
+    return value
+
+
+def parseLotNumber(lotNumber):
+    """Lot number as an int, digits only for strings like LOT-123"""
+    if isinstance(lotNumber, str):
+        digits = "".join(filter(str.isdigit, lotNumber))
+        if not digits:
+            raise ValueError("Invalid lot number format")
+        return int(digits)
+    return int(lotNumber)
+
+
+def parseExpiryDate(expiryDate):
+    return datetime.strptime(str(expiryDate), EXPIRY_DATE_FORMAT)
+
+
+def useNumpy():
+    return numpy is not None and LINE_COLUMNS_NUMPY
+
+
+class LineColumns:
+    """
+    Converted line specs, one column per field. Rows listed in
+    errors hold placeholder values.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.ids = []
+        self.notes = []
+        self.reasons = []
+        self.lineIds = []
+        self.delivered = None
+        self.backOrder = None
+        self.lotNumber = None
+        self.expiry = []
+        # row index -> {"missing": [fields]} or {"invalid": [fields]}
+        self.errors = {}
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    def fail(self, rows, field):
+        for row in rows:
+            self.errors.setdefault(row, {"invalid": []})["invalid"].append(
+                field
+            )
+
+    def report(self):
+        """Compact error report: counts and the bad fields per line"""
+        return {
+            "lines": self.count,
+            "valid": self.count - len(self.errors),
+            "invalid": len(self.errors),
+            "errors": [
+                dict(line=row + 1, **fields)
+                for row, fields in sorted(self.errors.items())
+            ],
+        }
+
+    def messages(self):
+        """despatchLine's error message per bad line"""
+        return [
+            f"Line {row + 1}: " + (
+                INSUFFICIENT_MESSAGE if "missing" in fields
+                else INVALID_MESSAGE
+            )
+            for row, fields in sorted(self.errors.items())
+        ]
+
+    def rows(self):
+        """The lines as dicts, as parseLineSpec returns them"""
+        return [
+            {
+                "ID": lineId,
+                "Note": note,
+                "DeliveredQuantity": delivered,
+                "BackOrderQuantity": backOrder,
+                "BackOrderReason": reason,
+                "LotNumber": lotNumber,
+                "ExpiryDate": expiry,
+                "LineID": orderLineId,
+            }
+            for lineId, note, delivered, backOrder, reason, lotNumber,
+            expiry, orderLineId in zip(
+                self.ids, self.notes, self.delivered.tolist(),
+                self.backOrder.tolist(), self.reasons,
+                self.lotNumber, self.expiry, self.lineIds,
+            )
+        ]
+
+
+def intColumn(values):
+    """
+    int(float(value)) of every value as an int64 column, and the
+    rows that do not convert
+    """
+    if useNumpy():
+        floats = numpy.asarray(values)
+        # strings and mixed columns convert faster value by value
+        if floats.dtype.kind not in "biuf":
+            floats = None
+        else:
+            floats = floats.astype(numpy.float64)
+        if floats is not None:
+            # int() refuses nan / inf; astype truncates like int()
+            # INT64_MAX rounds up to 2.0 ** 63 as a float
+            usable = numpy.isfinite(floats) \
+                & (floats >= -2.0 ** 63) & (floats < 2.0 ** 63)
+            column = numpy.zeros(len(values), dtype=numpy.int64)
+            column[usable] = floats[usable].astype(numpy.int64)
+            return column, numpy.flatnonzero(~usable).tolist()
+
+    converted, bad = distinctColumn(values, lambda value: int(float(value)))
+    try:
+        return array("q", [value or 0 for value in converted]), bad
+    except OverflowError:
+        column = array("q", bytes(8 * len(values)))
+        for row, value in enumerate(converted):
+            try:
+                column[row] = value or 0
+            except OverflowError:
+                bad.append(row)
+        return column, sorted(bad)
+
+
+def distinctColumn(values, convert):
+    """
+    convert(value) of every value, each distinct value converted
+    once (None where it fails), and the rows that do not convert.
+    Equal values (1, 1.0, True) share a conversion, which holds for
+    the converters used here.
+    """
+    try:
+        distinct = set(values)
+    except TypeError:
+        # unhashable values (lists, dicts), one at a time
+        distinct = None
+    if distinct is None:
+        column, bad = [], []
+        for row, value in enumerate(values):
+            try:
+                column.append(convert(value))
+            except (TypeError, ValueError, OverflowError):
+                column.append(None)
+                bad.append(row)
+        return column, bad
+
+    converted = {}
+    failed = set()
+    for value in distinct:
+        try:
+            converted[value] = convert(value)
+        except (TypeError, ValueError, OverflowError):
+            failed.add(value)
+    column = list(map(converted.get, values))
+    bad = [
+        row for row, value in enumerate(values) if value in failed
+    ] if failed else []
+    return column, bad
+
+
+# ===========================================
+# Purpose: Validate and convert many despatch line specs
+# at once, with the rules of despatchLine.
+
+# Argument: list of line spec dicts
+
+# Return: LineColumns; report() lists the bad lines with
+# their missing or invalid fields (a spec that is not a
+# dict misses them all)
+# ============================================
+def validateLineColumns(lineSpecs):
+    count = len(lineSpecs)
+    columns = LineColumns(count)
+    complete = []
+    for row, spec in enumerate(lineSpecs):
+        if not isinstance(spec, dict):
+            columns.errors[row] = {"missing": list(NEEDED_KEYS)}
+        elif NEEDED_KEY_SET <= spec.keys():
+            complete.append(spec)
+            continue
+        else:
+            columns.errors[row] = {
+                "missing": [key for key in NEEDED_KEYS if key not in spec]
+            }
+        # incomplete rows get placeholders that always convert
+        complete.append(None)
+
+    def column(key, placeholder):
+        if not columns.errors:
+            return list(map(itemgetter(key), complete))
+        return [
+            spec[key] if spec is not None else placeholder
+            for spec in complete
+        ]
+
+    columns.ids = list(map(str, column("ID", "")))
+    columns.notes = list(map(str, column("Note", "")))
+    columns.reasons = list(map(str, column("BackOrderReason", "")))
+    columns.lineIds = [
+        spec.get("LineID") if spec is not None else None
+        for spec in complete
+    ]
+
+    columns.delivered, bad = intColumn(column("DeliveredQuantity", 0))
+    columns.fail(bad, "DeliveredQuantity")
+    columns.backOrder, bad = intColumn(column("BackOrderQuantity", 0))
+    columns.fail(bad, "BackOrderQuantity")
+
+    columns.lotNumber, bad = distinctColumn(
+        column("LotNumber", 0), parseLotNumber
+    )
+    columns.fail(bad, "LotNumber")
+
+    columns.expiry, bad = distinctColumn(
+        column("ExpiryDate", "1970-01-01"), parseExpiryDate
+    )
+    columns.fail(bad, "ExpiryDate")
+    return columns
@@ -0,0 +1,86 @@
+import json
+from src.mongodb import dbConnect, releaseClient, jsonDefault
+
+
+# query string parameter -> listDocuments filter
+LIST_FILTERS = {
+    "customer_id": "customerId",
+    "status": "status",
+    "created_from": "createdFrom",
+    "created_to": "createdTo",
+}
+
+
+def parse_list_params(query_params):
+    """
+    Read listing options from API Gateway query string parameters
+
+    Args:
+        query_params (dict): Query string parameters, may be None
+
+    Returns:
+        tuple: (limit, cursor, filters)
+
+    Raises:
+        ValueError: If limit is not a positive integer
+    """
+    params = query_params or {}
+    limit = params.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise ValueError("limit must be an integer.")
+        if limit < 1:
+            raise ValueError("limit must be at least 1.")
+
+    filters = {
+        name: params[param]
+        for param, name in LIST_FILTERS.items()
+        if params.get(param) not in (None, "")
+    }
+    return limit, params.get("cursor") or None, filters
+
+
+async def list_response(list_page, query_params, key, summarise):
+    """
+    Lambda-style response for one page of a listing
+
+    Args:
+        list_page: listOrders or listDespatches
+        query_params (dict): Query string parameters
+        key (str): Name of the list in the response body
+        summarise: Function turning a stored summary into the response
+        shape
+
+    Returns:
+        dict: 200 with the page and next_cursor, 400 for bad parameters
+    """
+    try:
+        limit, cursor, filters = parse_list_params(query_params)
+    except ValueError as e:
+        return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
+
+    try:
+        client, db = await dbConnect()
+        try:
+            page = await list_page(db, limit=limit, cursor=cursor, **filters)
+        finally:
+            releaseClient(client)
+    except ValueError as e:
+        return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
+    except Exception as e:
+        print(f"Error listing {key}: {str(e)}")
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": f"Server error: {str(e)}"}),
+        }
+
+    return {
+        "statusCode": 200,
+        # CreationDate is a datetime, see mongodb.creationDate
+        "body": json.dumps({
+            key: [summarise(document) for document in page["items"]],
+            "next_cursor": page["next_cursor"],
+        }, default=jsonDefault),
+    }
@@ -0,0 +1,55 @@
+from src.mongodb import getOrderInfo
+
+
+class OrderContext:
+    """
+    Holds the order document for a single endpointFunc request.
+
+    The order is read from MongoDB once and then handed to every
+    pipeline stage, so supplier, customer, order reference, despatch
+    line and despatch creation all work from memory instead of each
+    repeating the UUID/OrderID lookup.
+
+    Attributes:
+        order_id (str): ID the order was loaded by
+        order (dict): The order document, None if it was not found
+    """
+
+    def __init__(self, order_id, order=None):
+        self.order_id = order_id
+        self.order = order
+
+    @classmethod
+    async def load(cls, order_id, db):
+        """
+        Create a context and fetch its order
+
+        Args:
+            order_id (str): OrderID or UUID of the order
+            db: Database connection
+
+        Returns:
+            OrderContext: Context holding the fetched order
+        """
+        context = cls(order_id)
+        await context.refresh(db)
+        return context
+
+    async def refresh(self, db):
+        """Re-read the order from the database"""
+        self.order = await getOrderInfo(self.order_id, db)
+        return self.order
+
+    def update(self, document):
+        """
+        Replace the in-memory order with a newer copy returned by a
+        write (e.g. find_one_and_update), saving a re-read.
+        """
+        if document:
+            self.order = document
+
+    def get(self, key, default=None):
+        """Read a top level field of the order"""
+        if not self.order:
+            return default
+        return self.order.get(key, default)
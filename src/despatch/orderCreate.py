@@ -1,7 +1,13 @@
 import uuid
 import datetime
 import json
-from src.mongodb import addOrder, getOrderInfo, dbConnect
+from src.mongodb import (
+    addOrder, addOrders, getOrderInfo, dbConnect, listOrders, releaseClient,
+    creationDate, jsonDefault,
+)
+from src.admission import Overloaded, xmlLimiter
+from src.despatch.listing import list_response
+from src.idGenerator import ORDER_PREFIX, newId, withFreshId
 from src.despatch.xmlConversion import xml_to_json
 
 
@@ -23,7 +29,12 @@ async def validate_order_document(document, format_type="json"):
         # Convert XML to JSON if needed
         if format_type.lower() == "xml":
             try:
-                converted_document = xml_to_json(document)
+                # lxml parsing, off the event loop and admission limited
+                converted_document = await xmlLimiter.run(
+                    xml_to_json, document
+                )
+            except Overloaded:
+                raise
             except Exception as e:
                 validation_issues.append(f"XML parsing error: {str(e)}")
                 return False, validation_issues, None
@@ -70,11 +81,41 @@ async def validate_order_document(document, format_type="json"):
             converted_document
         )
 
+    except Overloaded:
+        raise
     except Exception as e:
         validation_issues.append(f"Validation error: {str(e)}")
         return False, validation_issues, None
 
 
+def build_order_data(body):
+    """
+    Build the order document stored for a create request
+
+    Args:
+        body (dict): Request body with customer_id and items
+
+    Returns:
+        dict: Order document with freshly generated OrderID and UUID
+    """
+    # Time-ordered ID, see src/idGenerator.py
+    order_id = newId(ORDER_PREFIX)
+
+    # Generate a new UUID as a string
+    order_uuid = str(uuid.uuid4())
+
+    current_time = datetime.datetime.now().isoformat()
+    return {
+        "OrderID": order_id,
+        "UUID": order_uuid,
+        "CustomerID": body["customer_id"],
+        "Items": body["items"],
+        "Status": "Created",
+        "CreationDate": creationDate(),
+        "LastModified": current_time,
+    }
+
+
 async def create_order(event_body):
     """
     Create a new order in the database
@@ -100,27 +141,17 @@ async def create_order(event_body):
                 ),
             }
 
-        # Generate a random ID for the order
-        random_hex = uuid.uuid4().hex[:8].upper()
-        order_id = f"ORD-{random_hex}"
-
-        # Generate a new UUID as a string
-        order_uuid = str(uuid.uuid4())
-
-        current_time = datetime.datetime.now().isoformat()
-        order_data = {
-            "OrderID": order_id,
-            "UUID": order_uuid,
-            "CustomerID": body["customer_id"],
-            "Items": body["items"],
-            "Status": "Created",
-            "CreationDate": current_time,
-            "LastModified": current_time,
-        }
+        order_data = build_order_data(body)
 
         client, db = await dbConnect()
         try:
-            inserted_id = await addOrder(order_data, db)
+            async def insert(order_id):
+                order_data["OrderID"] = order_id
+                return await addOrder(order_data, db)
+
+            inserted_id = await withFreshId(ORDER_PREFIX, insert, "OrderID")
+            order_id = order_data["OrderID"]
+            order_uuid = order_data["UUID"]
 
             if not inserted_id:
                 return {
@@ -139,7 +170,7 @@ async def create_order(event_body):
                 ),
             }
         finally:
-            client.close()
+            releaseClient(client)
 
     except Exception as e:
         print(f"Error creating order: {str(e)}")
@@ -149,6 +180,117 @@ async def create_order(event_body):
         }
 
 
+async def insert_orders(event_bodies, db=None, chunk_size=None):
+    """
+    Build and bulk insert the orders for a list of request bodies
+
+    Args:
+        event_bodies (list): Request bodies, each with customer_id
+        and items
+        db (optional): Database connection, one is opened if omitted
+        chunk_size (int, optional): Orders per insert_many batch
+
+    Returns:
+        tuple: (results, documents), both in input order. results
+        holds one create_orders_bulk result per body; documents the
+        stored order document, or None where the body failed
+    """
+    results = [None] * len(event_bodies)
+    documents, positions = [], []
+    for index, body in enumerate(event_bodies):
+        if (
+            not isinstance(body, dict)
+            or "customer_id" not in body
+            or "items" not in body
+        ):
+            results[index] = {
+                "index": index,
+                "status": "Failed",
+                "error": "Invalid request format: "
+                "missing required fields",
+            }
+            continue
+        documents.append(build_order_data(body))
+        positions.append(index)
+
+    stored = [None] * len(event_bodies)
+    if documents:
+        client = None
+        if db is None:
+            client, db = await dbConnect()
+        try:
+            kwargs = {"chunkSize": chunk_size} if chunk_size else {}
+            inserted = await addOrders(documents, db, **kwargs)
+        finally:
+            if client is not None:
+                releaseClient(client)
+
+        for position, document, outcome in zip(
+            positions, documents, inserted
+        ):
+            result = {
+                "index": position,
+                "order_id": document["OrderID"],
+                "uuid": document["UUID"],
+                "status": "Order Created",
+            }
+            if outcome["error"]:
+                result["status"] = "Failed"
+                result["error"] = (
+                    "Duplicate order" if outcome["duplicate"]
+                    else outcome["error"]
+                )
+            else:
+                stored[position] = document
+            results[position] = result
+    return results, stored
+
+
+async def create_orders_bulk(event_bodies, chunk_size=None):
+    """
+    Create many orders at once, e.g. for a nightly UBL import
+
+    Args:
+        event_bodies (list): Request bodies, each with customer_id
+        and items
+        chunk_size (int, optional): Orders per insert_many batch
+
+    Returns:
+        dict: Response with one result per body (in input order)
+        and created/failed counts. A failing order, including a
+        duplicate key, is reported in its own result and does not
+        fail the others.
+    """
+    try:
+        if not isinstance(event_bodies, list):
+            return {
+                "statusCode": 400,
+                "body": json.dumps(
+                    {"error": "Invalid request format: expected a list"}
+                ),
+            }
+
+        results, _ = await insert_orders(event_bodies, chunk_size=chunk_size)
+        created = sum(r["status"] == "Order Created" for r in results)
+        return {
+            "statusCode": 200,
+            "body": json.dumps(
+                {
+                    "created": created,
+                    "failed": len(results) - created,
+                    "results": results,
+                }
+            ),
+        }
+
+    except Exception as e:
+        print(f"Error creating orders: {str(e)}")
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": f"Server error: {str(e)}"}),
+        }
+
+
 async def validate_order(order_id):
     """
     Validate required fields in an order
@@ -213,7 +355,7 @@ async def validate_order(order_id):
                     ),
                 }
         finally:
-            client.close()
+            releaseClient(client)
 
     except Exception as e:
         print(f"Error validating order: {str(e)}")
@@ -251,11 +393,12 @@ async def get_order(order_id):
                         "order_id": order.get("OrderID"),
                         "customer_id": order.get("CustomerID"),
                         "items": order.get("Items"),
-                    }
+                    },
+                    default=jsonDefault,
                 ),
             }
         finally:
-            client.close()
+            releaseClient(client)
 
     except Exception as e:
         print(f"Error retrieving order: {str(e)}")
@@ -265,6 +408,34 @@ async def get_order(order_id):
         }
 
 
+async def list_orders(query_params=None):
+    """
+    List orders, newest first, one page at a time
+
+    Args:
+        query_params (dict, optional): customer_id, status, created_from
+        (inclusive), created_to (exclusive), limit and the cursor
+        returned with the previous page
+
+    Returns:
+        dict: Response containing orders and next_cursor
+    """
+    return await list_response(
+        listOrders, query_params, "orders", order_summary
+    )
+
+
+def order_summary(order):
+    return {
+        "order_id": order.get("OrderID"),
+        "uuid": order.get("UUID"),
+        "customer_id": order.get("CustomerID"),
+        "status": order.get("Status"),
+        "creation_date": order.get("CreationDate"),
+        "last_modified": order.get("LastModified"),
+    }
+
+
 async def check_stock(order_id):
     """
     Check stock availability for items in an order
@@ -324,7 +495,7 @@ async def check_stock(order_id):
                 ),
             }
         finally:
-            client.close()
+            releaseClient(client)
 
     except Exception as e:
         print(f"Error checking stock: {str(e)}")
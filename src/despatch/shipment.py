@@ -1,7 +1,10 @@
 import datetime
-from src.mongodb import dbConnect
+from src.mongodb import dbConnect, releaseClient
+from src.dbIndexes import applyIndexes
+from src.idGenerator import ULID_PATTERN
 import re
 import logging
+from pymongo.errors import DuplicateKeyError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,16 +21,18 @@ logger = logging.getLogger(__name__)
 async def setup_indexes():
     """Ensure a unique index on the shipment ID field."""
     mongoClient, db = await dbConnect()
-    shipments = db["shipments"]
 
     try:
-        # Create a unique index on the "ID" field and get the result
-        result = await shipments.create_index("ID", unique=True)
+        # The index itself is declared in src/dbIndexes.py
+        result = await applyIndexes(db, force=True, collections=["shipments"])
+        if not result["success"]:
+            raise RuntimeError("; ".join(result["failed"]))
+
         logger.info(f"Created unique index on 'ID' field. Result: {result}")
         return {
             "success": True,
             "index_name": "ID",
-            "operation_result": result,
+            "operation_result": result["applied"],
             "message": "Successfully created unique index on 'ID' field"
         }
     except Exception as e:
@@ -39,7 +44,17 @@ async def setup_indexes():
         }
     finally:
         # Close the MongoDB connection
-        mongoClient.close()
+        releaseClient(mongoClient)
+
+
+def duplicate_shipment_error(shipment_id):
+    """DuplicateKeyError as the unique index on shipments.ID raises it"""
+    return DuplicateKeyError(
+        f"E11000 duplicate key error collection: shipments index: ID_1 "
+        f"dup key: {{ ID: {shipment_id!r} }}",
+        11000,
+        {"keyPattern": {"ID": 1}, "keyValue": {"ID": shipment_id}},
+    )
 
 
 # ==================================
@@ -47,16 +62,20 @@ async def setup_indexes():
 # Arguments:
 #   - shipment_id (str): The unique ID of the shipment.
 #   - data (dict): The shipment data to be inserted.
+#   - raise_duplicate (bool): Raise DuplicateKeyError for a
+#     taken ID instead of reporting it, so withFreshId can
+#     retry with a new one
 # Returns:
 #   - dict: Contains success status, inserted document
 # ==================================
-async def create_shipment(shipment_id: str, data: dict):
+async def create_shipment(shipment_id: str, data: dict,
+                          raise_duplicate: bool = False):
     # Validate types of shipment_id and data
     if not isinstance(shipment_id, str):
         raise TypeError("Shipment ID must be a string")
 
     # Validate shipment ID format using regex
-    if not re.match(r"^SHIP-\d{6}$", shipment_id):
+    if not re.match(rf"^SHIP-(\d{{6}}|{ULID_PATTERN})$", shipment_id):
         raise ValueError("Invalid shipment ID format'.")
 
     if not isinstance(data, dict):
@@ -85,6 +104,8 @@ async def create_shipment(shipment_id: str, data: dict):
         existing_shipment = await shipments.find_one({"ID": shipment_id})
         if existing_shipment:
             logger.error(f"Duplicate shipment ID: {shipment_id}")
+            if raise_duplicate:
+                raise duplicate_shipment_error(shipment_id)
             return {
                 "success": False,
                 "error": "Duplicate shipment ID",
@@ -110,6 +131,15 @@ async def create_shipment(shipment_id: str, data: dict):
             }
         }
 
+    except DuplicateKeyError:
+        if raise_duplicate:
+            raise
+        logger.error(f"Duplicate shipment ID: {shipment_id}")
+        return {
+            "success": False,
+            "error": "Duplicate shipment ID",
+            "attempted_data": data
+        }
     except Exception as e:
         logger.error(f"An error occurred while creating shipment: {e}")
         return {
@@ -119,7 +149,7 @@ async def create_shipment(shipment_id: str, data: dict):
         }
     finally:
         # Close the MongoDB connection
-        mongoClient.close()
+        releaseClient(mongoClient)
 
 
 async def generate_shipment_qr_code(shipment_id, additional_info=None):
@@ -195,7 +225,7 @@ async def generate_shipment_qr_code(shipment_id, additional_info=None):
             }
 
         finally:
-            mongoClient.close()
+            releaseClient(mongoClient)
 
     except Exception as e:
         logger.error(f"Error generating shipment QR code: {str(e)}")
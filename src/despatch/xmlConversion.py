@@ -5,6 +5,7 @@
 
 import datetime
 from lxml import etree
+from src.admission import pdfLimiter
 from src.utils.constants import cacSchema, cbcSchema
 
 
@@ -502,7 +503,11 @@ async def xml_to_pdf(xml_string, file_path=None):
         temp.flush()
 
     try:
-        pdf_document = HTML(temp_path).write_pdf()
+        # weasyprint is CPU bound: render on a worker thread, at most
+        # ADMISSION_PDF_LIMIT at a time
+        pdf_document = await pdfLimiter.run(
+            lambda: HTML(temp_path).write_pdf()
+        )
 
         # Save to file if path is provided
         if file_path:
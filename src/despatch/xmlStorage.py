@@ -0,0 +1,141 @@
+# ================================================
+# Compressed storage for the XML kept in despatch
+# documents (XMLData).
+
+# XML is stored as BSON binary holding a zstd frame
+# (when the zstandard package is installed) or a zlib
+# stream. Both formats identify themselves by their
+# leading bytes, so documents need no extra field and
+# plain-string XMLData from older documents still reads.
+# ================================================
+
+import codecs
+import os
+import zlib
+
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# payloads shorter than this are left as plain strings
+XML_COMPRESS_MIN_BYTES = int(os.getenv("XML_COMPRESS_MIN_BYTES", "512"))
+XML_COMPRESSION = os.getenv(
+    "XML_COMPRESSION", "zstd" if zstandard else "zlib"
+).lower()
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def compress_xml(xml_string, method=None):
+    """
+    Compress XML for storage
+
+    Args:
+        xml_string (str): XML document
+        method (str, optional): "zstd", "zlib" or "none", defaults to
+        XML_COMPRESSION
+
+    Returns:
+        bytes | str: Compressed bytes, or the string unchanged when it is
+        short, already encoded or compression would not shrink it
+    """
+    if not isinstance(xml_string, str):
+        return xml_string
+
+    method = method or XML_COMPRESSION
+    raw = xml_string.encode("utf-8")
+    if method == "none" or len(raw) < XML_COMPRESS_MIN_BYTES:
+        return xml_string
+
+    if method == "zstd" and zstandard is not None:
+        packed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    else:
+        packed = zlib.compress(raw, ZLIB_LEVEL)
+
+    if len(packed) >= len(raw):
+        return xml_string
+    return packed
+
+
+def encode_xml(xml_string, method=None):
+    """
+    Value to store in XMLData: BSON binary for compressed XML,
+    the plain string otherwise
+    """
+    packed = compress_xml(xml_string, method)
+    if isinstance(packed, bytes):
+        return Binary(packed, USER_DEFINED_SUBTYPE)
+    return packed
+
+
+def decode_xml(value):
+    """
+    Read an XMLData value written by any version of the service
+
+    Args:
+        value (str | bytes | Binary | None): Stored XMLData
+
+    Returns:
+        str: The XML document ("" when value is empty)
+
+    Raises:
+        ValueError: If the bytes are neither zstd nor zlib data
+    """
+    if not value:
+        return ""
+    if isinstance(value, str):
+        return value
+
+    data = bytes(value)
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError(
+                "XMLData is zstd compressed but zstandard is not installed"
+            )
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    try:
+        return zlib.decompress(data).decode("utf-8")
+    except zlib.error as e:
+        raise ValueError(f"Unrecognised XMLData encoding: {e}")
+
+
+async def stream_decode_xml(chunks, compressed=True):
+    """
+    Decode XML from an async iterable of stored byte chunks without
+    holding the whole payload
+
+    Args:
+        chunks: Async iterable of bytes (e.g. blob store chunks)
+        compressed (bool): False when the chunks are plain UTF-8
+
+    Yields:
+        str: Pieces of the XML document
+    """
+    text = codecs.getincrementaldecoder("utf-8")()
+    decompressor = None
+    async for chunk in chunks:
+        if compressed and decompressor is None:
+            if chunk.startswith(ZSTD_MAGIC):
+                if zstandard is None:
+                    raise ValueError(
+                        "XMLData is zstd compressed but zstandard is not "
+                        "installed"
+                    )
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+            else:
+                decompressor = zlib.decompressobj()
+        data = decompressor.decompress(chunk) if compressed else chunk
+        piece = text.decode(data)
+        if piece:
+            yield piece
+
+    tail = decompressor.flush() if compressed and decompressor else b""
+    piece = text.decode(tail, final=True)
+    if piece:
+        yield piece
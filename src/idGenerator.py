@@ -0,0 +1,124 @@
+# ================================================
+# Document IDs for orders, despatches and shipments.
+
+# IDs are the usual prefix plus a ULID: 48 bits of
+# millisecond timestamp and 80 random bits, written as
+# 26 Crockford base32 characters, e.g.
+#   ORD-01JQ7Z8K3M4N5P6Q7R8S9T0V1W
+# They sort by creation time, so new keys land at the
+# right-hand edge of the unique indexes instead of on
+# random B-tree pages. Within one millisecond the random
+# part is incremented, so IDs from one process are
+# strictly increasing and never repeat.
+# ================================================
+
+import os
+import re
+import threading
+import time
+
+import pymongo.errors
+
+ORDER_PREFIX = "ORD-"
+DESPATCH_PREFIX = "D-"
+SHIPMENT_PREFIX = "SHIP-"
+JOB_PREFIX = "JOB-"
+
+# attempts before a duplicate key error is passed on
+ID_ATTEMPTS = int(os.getenv("ID_ATTEMPTS", "5"))
+# index named in a duplicate key error message
+DUPLICATE_INDEX = re.compile(r"index: (\S+) dup key")
+
+CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+ULID_PATTERN = r"[0-7][0-9A-HJKMNP-TV-Z]{25}"
+_RANDOM_BITS = 80
+_RANDOM_MAX = (1 << _RANDOM_BITS) - 1
+
+_lock = threading.Lock()
+_lastMs = -1
+_lastRandom = 0
+
+
+def encodeBase32(value: int, length: int):
+    chars = []
+    for _ in range(length):
+        chars.append(CROCKFORD[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+# ===========================================
+# Purpose: Next ULID of this process. Monotonic: when
+# the clock has not moved (or went backwards) the random
+# part of the previous ULID is incremented instead.
+
+# Argument: optional millisecond timestamp (tests)
+
+# Return: 26 character ULID string
+# ============================================
+def newUlid(nowMs: int = None):
+    global _lastMs, _lastRandom
+    nowMs = time.time_ns() // 1_000_000 if nowMs is None else nowMs
+    with _lock:
+        if nowMs <= _lastMs:
+            nowMs = _lastMs
+            random = _lastRandom + 1
+            if random > _RANDOM_MAX:
+                # 2^80 IDs in one millisecond, borrow the next one
+                nowMs += 1
+                random = int.from_bytes(os.urandom(10), "big")
+        else:
+            random = int.from_bytes(os.urandom(10), "big")
+        _lastMs, _lastRandom = nowMs, random
+    return encodeBase32((nowMs << _RANDOM_BITS) | random, 26)
+
+
+def newId(prefix: str):
+    """New ID with the given prefix, e.g. newId(ORDER_PREFIX)"""
+    return f"{prefix}{newUlid()}"
+
+
+def isGeneratedId(value, prefix: str):
+    return isinstance(value, str) and bool(
+        re.fullmatch(re.escape(prefix) + ULID_PATTERN, value)
+    )
+
+
+def idTimestamp(value: str):
+    """Creation time (seconds since the epoch) encoded in an ID"""
+    ulid = value[-26:]
+    ms = 0
+    for char in ulid[:10]:
+        ms = ms * 32 + CROCKFORD.index(char)
+    return ms / 1000
+
+
+def isIdConflict(error: pymongo.errors.DuplicateKeyError, field: str):
+    """True if a duplicate key error was raised by the index on field"""
+    details = error.details or {}
+    keyPattern = details.get("keyPattern") or details.get("keyValue")
+    if keyPattern:
+        return list(keyPattern) == [field]
+    # no key pattern: compare the whole index name, OrderID_1 is not
+    # a conflict on ID
+    match = DUPLICATE_INDEX.search(details.get("errmsg") or str(error))
+    return match is not None and match.group(1) == f"{field}_1"
+
+
+# ===========================================
+# Purpose: Insert with a freshly generated ID, retrying
+# with a new one if the unique index reports it as taken.
+
+# Argument: prefix, insert (coroutine function taking the
+# new ID), field the ID is stored in, attempts
+
+# Return: whatever insert returned
+# ============================================
+async def withFreshId(prefix: str, insert, field: str,
+                      attempts: int = ID_ATTEMPTS):
+    for attempt in range(attempts):
+        try:
+            return await insert(newId(prefix))
+        except pymongo.errors.DuplicateKeyError as error:
+            if attempt == attempts - 1 or not isIdConflict(error, field):
+                raise
@@ -0,0 +1,233 @@
+# ================================================
+# Replay protection for endpointFunc submissions.
+
+# A retried request (client timeout, API Gateway retry)
+# would otherwise create another order, shipment and
+# despatch. Each submission gets a key: the caller's
+# Idempotency-Key, or, with IDEMPOTENCY_CONTENT_HASH=1, a
+# SHA-256 of the canonical JSON of its inputs (off by
+# default: two identical orders sent on purpose would
+# otherwise become one). The first request with a key
+# claims it in the idempotency collection, runs, and
+# stores its response there; repeats get the stored
+# response back without any work. A repeat that arrives
+# while the first is still running gets a 409 with
+# Retry-After. A claim holds a lease of the request's
+# deadline plus PENDING_LEASE_MARGIN; once it has passed
+# the claimant is taken to have died (Lambda killed or
+# timed out before releasing) and the next caller takes
+# the key over. The caller can pass compact/expand to
+# store a smaller form of the response (references
+# instead of documents) and rebuild it on replay.
+
+# Failures (5xx, 429 from admission control, exceptions)
+# release the claim so the client can retry for real. If
+# the store itself cannot be reached the request runs
+# without deduplication. Records expire through the TTL
+# index on CreatedAt (IDEMPOTENCY_TTL_SECONDS, see
+# src/dbIndexes.py) and are also ignored once past it,
+# as the TTL monitor only runs every minute.
+# ================================================
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+import pymongo.errors
+
+from src.admission import Overloaded
+from src.dbIndexes import IDEMPOTENCY_TTL_SECONDS
+from src.mongodb import getDb
+from src.requestDeadline import REQUEST_DEADLINE_SECONDS, remaining
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "1") != "0"
+# derive a key from the request content when the caller sent none
+IDEMPOTENCY_CONTENT_HASH = os.getenv("IDEMPOTENCY_CONTENT_HASH", "0") == "1"
+IDEMPOTENCY_COLLECTION = "idempotency"
+# seconds a client should wait before retrying an in-flight request
+IN_PROGRESS_RETRY_AFTER = 2
+# seconds a pending claim outlives the request deadline before
+# another caller may take it over
+PENDING_LEASE_MARGIN = float(os.getenv("PENDING_LEASE_MARGIN", "5"))
+
+PENDING = "pending"
+COMPLETED = "completed"
+
+
+def contentHash(*parts):
+    """SHA-256 of the canonical JSON (sorted keys, no spaces) of parts"""
+    canonical = json.dumps(
+        parts, sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# ===========================================
+# Purpose: Key and fingerprint of one submission
+
+# Argument: the caller's idempotency key (or None), the
+# request inputs
+
+# Return: (key, fingerprint), (None, None) when the
+# submission should not be deduplicated
+# ============================================
+def requestKey(idempotencyKey, *parts):
+    if not IDEMPOTENCY_ENABLED:
+        return None, None
+    fingerprint = contentHash(*parts)
+    if idempotencyKey:
+        return f"key:{idempotencyKey}", fingerprint
+    if IDEMPOTENCY_CONTENT_HASH:
+        return f"content:{fingerprint}", fingerprint
+    return None, None
+
+
+def asUtc(value):
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def isExpired(record, now):
+    createdAt = asUtc(record.get("CreatedAt"))
+    if createdAt is None:
+        return False
+    return (now - createdAt).total_seconds() > IDEMPOTENCY_TTL_SECONDS
+
+
+def isAbandoned(record, now):
+    """A pending claim whose lease has passed"""
+    leaseUntil = asUtc(record.get("LeaseUntil"))
+    return record.get("Status") == PENDING and leaseUntil is not None \
+        and now > leaseUntil
+
+
+async def replayed(record, expand=None):
+    response = dict(record["Response"])
+    if expand is not None:
+        try:
+            response = await expand(response)
+        except LookupError as e:
+            # what the stored response pointed at has been deleted
+            return errorResponse(
+                410, f"Stored response is no longer available: {e}"
+            )
+        except Overloaded as e:
+            # re-rendering the XML was turned away, nothing replayed
+            return e.response()
+    response["headers"] = dict(
+        response.get("headers") or {}, **{"Idempotent-Replayed": "true"}
+    )
+    return response
+
+
+def errorResponse(statusCode, message, headers=None):
+    response = {
+        "statusCode": statusCode,
+        "body": json.dumps({"error": message}),
+    }
+    if headers:
+        response["headers"] = headers
+    return response
+
+
+# ===========================================
+# Purpose: Run a submission at most once per key. The
+# first caller claims the key and runs; later callers
+# get its stored response (or a 409 while it runs, a 422
+# if the key was used for different content).
+
+# Argument: key and fingerprint from requestKey(), run
+# (coroutine function returning the response), db,
+# compact (response -> form to store) and expand
+# (coroutine function, stored form -> response; raises
+# LookupError when it cannot be rebuilt)
+
+# Return: the Lambda-style response
+# ============================================
+async def runOnce(key, fingerprint, run, db=None, compact=None,
+                  expand=None):
+    if key is None:
+        return await run()
+    records = (db if db is not None else getDb())[IDEMPOTENCY_COLLECTION]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # the run is cancelled once its deadline passes (longer for jobs)
+    budget = remaining()
+    if budget is None:
+        budget = REQUEST_DEADLINE_SECONDS
+
+    try:
+        await records.insert_one({
+            "_id": key,
+            "Fingerprint": fingerprint,
+            "Status": PENDING,
+            "CreatedAt": now,
+            "LeaseUntil": now + datetime.timedelta(
+                seconds=budget + PENDING_LEASE_MARGIN
+            ),
+        })
+    except pymongo.errors.DuplicateKeyError:
+        record = await records.find_one({"_id": key})
+        if record is None or isExpired(record, now) \
+                or isAbandoned(record, now):
+            # expired, abandoned by a crashed claimant (or just
+            # released): take the key over. The guard keeps a claim
+            # that completed or was retaken meanwhile.
+            if record is not None:
+                await records.delete_one({
+                    "_id": key,
+                    "CreatedAt": record["CreatedAt"],
+                    "Status": record.get("Status"),
+                })
+            return await runOnce(key, fingerprint, run, db=records.database,
+                                 compact=compact, expand=expand)
+        if record.get("Fingerprint") != fingerprint:
+            return errorResponse(
+                422, "Idempotency key was already used for another request"
+            )
+        if record.get("Status") == COMPLETED:
+            return await replayed(record, expand)
+        return errorResponse(
+            409, "A request with this idempotency key is in progress",
+            {"Retry-After": str(IN_PROGRESS_RETRY_AFTER)},
+        )
+    except pymongo.errors.PyMongoError as e:
+        # the store being down must not take the endpoint with it
+        logger.error(f"Idempotency store unavailable, running {key}: {e}")
+        return await run()
+
+    try:
+        response = await run()
+    except BaseException:
+        await release(records, key)
+        raise
+
+    statusCode = response.get("statusCode", 500) \
+        if isinstance(response, dict) else 500
+    if statusCode >= 500 or statusCode == 429:
+        # nothing to replay, let the client try again
+        await release(records, key)
+        return response
+    try:
+        await records.update_one(
+            {"_id": key},
+            {"$set": {
+                "Status": COMPLETED,
+                "Response": compact(response) if compact else response,
+            }},
+        )
+    except Exception as e:
+        logger.error(f"Could not store response for {key}: {e}")
+        await release(records, key)
+    return response
+
+
+async def release(records, key):
+    try:
+        await records.delete_one({"_id": key, "Status": PENDING})
+    except Exception as e:
+        logger.error(f"Could not release idempotency key {key}: {e}")
@@ -0,0 +1,380 @@
+# ================================================
+# MongoDB-backed work queue for long running requests.
+
+#   jobId = await submitJob("despatch", payload)
+#   pool = JobWorkerPool({"despatch": handler}); pool.start()
+#   await jobStatus(jobId)  ->  {"status": "running", ...}
+
+# A job is one document in the jobs collection. Workers
+# claim the oldest queued job with a single
+# find_one_and_update that also sets a lease (owner and
+# expiry), so two workers never get the same job. While a
+# job runs its lease is renewed every JOB_LEASE_SECONDS / 3
+# together with the stages finished so far (the job runs
+# inside a StageTimer, see src/stageTiming.py). A worker
+# that dies leaves a lease that expires, and the job is
+# claimed again, up to JOB_MAX_ATTEMPTS times.
+
+# Handlers return Lambda-style responses. A 5xx or 429
+# response or an exception is retried while attempts
+# remain; anything else is final and stored as the job's
+# result. If recording the outcome fails too, the worker
+# logs it and moves on; the job's lease expires and it is
+# claimed again. A handler can read the ID of the job it
+# runs for with currentJobId(), e.g. to key its writes so a
+# retried attempt does not repeat them.
+
+# Workers run either as a long lived pool (start/stop) on
+# a container, or for a bounded time with drain(), e.g.
+# from the scheduled src/lambda/job_worker_handler.py.
+# ================================================
+
+import asyncio
+import contextvars
+import datetime
+import logging
+import os
+import socket
+
+import pymongo
+
+from src.idGenerator import JOB_PREFIX, newId
+from src.mongodb import getDb
+from src.stageTiming import StageTimer
+
+logger = logging.getLogger(__name__)
+
+JOB_COLLECTION = "jobs"
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# seconds an idle worker waits before looking for jobs again
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+_currentJob = contextvars.ContextVar("currentJob", default=None)
+
+
+def utcNow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def currentJobId():
+    """ID of the job the calling handler runs for, None outside one"""
+    return _currentJob.get()
+
+
+def jobsCollection(db=None):
+    return (db if db is not None else getDb())[JOB_COLLECTION]
+
+
+# ===========================================
+# Purpose: Queue a job
+
+# Argument: kind (selects the handler), payload (passed
+# to the handler), db, maxAttempts
+
+# Return: the new job ID
+# ============================================
+async def submitJob(kind, payload, db=None, maxAttempts=JOB_MAX_ATTEMPTS):
+    jobId = newId(JOB_PREFIX)
+    await jobsCollection(db).insert_one({
+        "_id": jobId,
+        "Kind": kind,
+        "Status": QUEUED,
+        "Payload": payload,
+        "Attempts": 0,
+        "AttemptsLeft": maxAttempts,
+        "MaxAttempts": maxAttempts,
+        "Progress": [],
+        "CreatedAt": utcNow(),
+    })
+    return jobId
+
+
+# ===========================================
+# Purpose: Atomically take the oldest claimable job: a
+# queued one, or a running one whose lease has expired
+# (its worker died) with attempts left.
+
+# Argument: worker name, db, kinds the worker handles
+
+# Return: the claimed job document, None if there is none
+# ============================================
+async def claimJob(owner, db=None, kinds=None):
+    now = utcNow()
+    query = {
+        "$or": [
+            {"Status": QUEUED},
+            {"Status": RUNNING, "LeaseExpiresAt": {"$lt": now}},
+        ],
+        "AttemptsLeft": {"$gt": 0},
+    }
+    if kinds:
+        query["Kind"] = {"$in": list(kinds)}
+    return await jobsCollection(db).find_one_and_update(
+        query,
+        {
+            "$set": {
+                "Status": RUNNING,
+                "LeaseOwner": owner,
+                "LeaseExpiresAt": now + datetime.timedelta(
+                    seconds=JOB_LEASE_SECONDS
+                ),
+                "StartedAt": now,
+            },
+            "$inc": {"Attempts": 1, "AttemptsLeft": -1},
+        },
+        sort=[("CreatedAt", pymongo.ASCENDING)],
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+
+
+async def renewLease(jobId, owner, progress, db=None):
+    """Extend the lease, False if this worker no longer holds it"""
+    result = await jobsCollection(db).update_one(
+        {"_id": jobId, "LeaseOwner": owner, "Status": RUNNING},
+        {"$set": {
+            "LeaseExpiresAt": utcNow() + datetime.timedelta(
+                seconds=JOB_LEASE_SECONDS
+            ),
+            "Progress": progress,
+        }},
+    )
+    return result.matched_count > 0
+
+
+# ===========================================
+# Purpose: Record the outcome of a claimed job. Only the
+# lease holder can do so.
+
+# Argument: the job, worker name, response (or None),
+# error message (or None), db, stages done (or None)
+
+# Return: the job's new status, None if the lease was lost
+# ============================================
+async def finishJob(job, owner, response=None, error=None, db=None,
+                    progress=None):
+    statusCode = response.get("statusCode", 500) \
+        if isinstance(response, dict) else 500
+    retry = (statusCode >= 500 or statusCode == 429) \
+        and job["AttemptsLeft"] > 0
+    if retry:
+        status = QUEUED
+    else:
+        status = SUCCEEDED if statusCode < 400 else FAILED
+    update = {
+        "Status": status,
+        "Result": response,
+        "Error": error,
+        "LeaseOwner": None,
+        "LeaseExpiresAt": None,
+    }
+    if not retry:
+        update["FinishedAt"] = utcNow()
+    if progress is not None:
+        update["Progress"] = progress
+    result = await jobsCollection(db).update_one(
+        {"_id": job["_id"], "LeaseOwner": owner},
+        {"$set": update},
+    )
+    if not result.matched_count:
+        logger.warning(f"Lost the lease on {job['_id']}, result dropped")
+        return None
+    return status
+
+
+# ===========================================
+# Purpose: Poll a job. A running job whose lease ran out
+# on its last attempt is reported as failed.
+
+# Argument: job ID, db
+
+# Return: dict with job_id, kind, status, attempts,
+# progress (stages done), timestamps and, once finished,
+# the result; None for an unknown job
+# ============================================
+async def jobStatus(jobId, db=None):
+    job = await jobsCollection(db).find_one({"_id": jobId})
+    if job is None:
+        return None
+    status = job["Status"]
+    leaseExpiresAt = job.get("LeaseExpiresAt")
+    if status == RUNNING and leaseExpiresAt is not None:
+        if leaseExpiresAt.tzinfo is None:
+            leaseExpiresAt = leaseExpiresAt.replace(
+                tzinfo=datetime.timezone.utc
+            )
+        if leaseExpiresAt < utcNow() and job["AttemptsLeft"] <= 0:
+            status = FAILED
+
+    def isoformat(value):
+        return value.isoformat() if value is not None else None
+
+    report = {
+        "job_id": job["_id"],
+        "kind": job["Kind"],
+        "status": status,
+        "attempts": job["Attempts"],
+        "progress": job.get("Progress", []),
+        "created_at": isoformat(job.get("CreatedAt")),
+        "started_at": isoformat(job.get("StartedAt")),
+        "finished_at": isoformat(job.get("FinishedAt")),
+    }
+    if status in (SUCCEEDED, FAILED):
+        report["result"] = job.get("Result")
+        report["error"] = job.get("Error")
+    return report
+
+
+class JobWorkerPool:
+    """
+    asyncio workers that claim and run jobs. handlers maps a job
+    kind to a coroutine function taking the payload and returning
+    a Lambda-style response.
+    """
+
+    def __init__(self, handlers, size=JOB_WORKERS, db=None,
+                 pollInterval=JOB_POLL_INTERVAL, name=None):
+        self.handlers = handlers
+        self.size = size
+        self.db = db
+        self.pollInterval = pollInterval
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.tasks = []
+        self.wakeUp = asyncio.Event()
+        self.stopping = False
+
+    def start(self):
+        self.stopping = False
+        self.tasks = [
+            asyncio.create_task(self.work(f"{self.name}:{number}"))
+            for number in range(self.size)
+        ]
+        return self
+
+    def notify(self):
+        """Wake idle workers, e.g. right after submitting a job"""
+        self.wakeUp.set()
+
+    async def stop(self):
+        """Stop claiming; jobs being run are cancelled (their leases
+        expire and another worker picks them up)"""
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def work(self, owner):
+        while not self.stopping:
+            try:
+                job = await claimJob(owner, self.db, self.handlers)
+            except Exception as e:
+                logger.error(f"{owner} could not claim a job: {e}")
+                job = None
+            if job is None:
+                self.wakeUp.clear()
+                try:
+                    await asyncio.wait_for(
+                        self.wakeUp.wait(), self.pollInterval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.runClaimed(job, owner)
+
+    async def drain(self, seconds):
+        """
+        Run jobs with size workers until the queue is empty, claiming
+        new ones for at most seconds; returns the number of jobs run.
+        A job claimed just before the end still runs to completion.
+        """
+        stopClaimingAt = asyncio.get_running_loop().time() + seconds
+        done = 0
+
+        async def work(owner):
+            nonlocal done
+            while asyncio.get_running_loop().time() < stopClaimingAt:
+                try:
+                    job = await claimJob(owner, self.db, self.handlers)
+                except Exception as e:
+                    logger.error(f"{owner} could not claim a job: {e}")
+                    return
+                if job is None:
+                    return
+                await self.runClaimed(job, owner)
+                done += 1
+
+        await asyncio.gather(*(
+            work(f"{self.name}:{number}") for number in range(self.size)
+        ))
+        return done
+
+    async def runOnce(self, owner=None):
+        """Claim and run a single job, False if there was none"""
+        owner = owner or f"{self.name}:once"
+        job = await claimJob(owner, self.db, self.handlers)
+        if job is None:
+            return False
+        await self.runClaimed(job, owner)
+        return True
+
+    async def runClaimed(self, job, owner):
+        """runJob, logging instead of raising: the worker goes on
+        with the next job and this one is claimed again once its
+        lease expires"""
+        try:
+            await self.runJob(job, owner)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"{owner} could not run job {job.get('_id')}: {e}")
+
+    async def runJob(self, job, owner):
+        handler = self.handlers[job["Kind"]]
+        timer = StageTimer(f"job:{job['Kind']}")
+        token = _currentJob.set(job["_id"])
+        try:
+            with timer:
+                task = asyncio.create_task(handler(job["Payload"]))
+        finally:
+            _currentJob.reset(token)
+        heartbeat = asyncio.create_task(
+            self.heartbeat(job["_id"], owner, timer, task)
+        )
+        response, error = None, None
+        try:
+            response = await task
+        except asyncio.CancelledError:
+            if self.stopping or not task.cancelled():
+                raise
+            # the heartbeat found another worker holds the job now
+            error = "Lease lost"
+        except Exception as e:
+            logger.error(f"Job {job['_id']} failed: {e}")
+            error = str(e)
+        finally:
+            heartbeat.cancel()
+        timer.finish(response)
+        await finishJob(
+            job, owner, response, error, self.db, list(timer.timings)
+        )
+
+    async def heartbeat(self, jobId, owner, timer, task):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                held = await renewLease(
+                    jobId, owner, list(timer.timings), self.db
+                )
+            except Exception as e:
+                logger.error(f"Could not renew the lease on {jobId}: {e}")
+                continue
+            if not held:
+                task.cancel()
+                return
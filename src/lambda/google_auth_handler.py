@@ -3,22 +3,37 @@ import os
 from datetime import datetime, timedelta
 from pymongo import MongoClient
 from src.despatch.authUtils import verify_google_token, create_access_token
+from src.dbIndexes import applyIndexesSync
+
+
+# reused across warm invocations of the same container
+_client = None
+_indexes_checked = False
 
 
 def get_db():
+    global _client
     uri = os.getenv("MDB_URI")
     db_name = os.getenv("MONGO_DB_NAME", "ubl_docs")
-    client = MongoClient(uri)
-    return client, client[db_name]
+    if _client is None:
+        _client = MongoClient(uri)
+    return _client, _client[db_name]
 
 
 def init_user_collection(db):
-    users = db["users"]
-    try:
-        users.create_index("google_id", unique=True)
-    except Exception as e:
-        print(f"Index creation skipped or failed: {e}")
-    return users
+    # the users index is declared in src/dbIndexes.py and only needs
+    # checking once per container, not on every login. The other
+    # collections are left to ensureIndexes (src/dbIndexes.py).
+    global _indexes_checked
+    if not _indexes_checked:
+        try:
+            # checked again on the next login until a run succeeds
+            _indexes_checked = applyIndexesSync(
+                db, force=True, collections=["users"]
+            )["success"]
+        except Exception as e:
+            print(f"Index creation skipped or failed: {e}")
+    return db["users"]
 
 
 def register_user(google_user, users):
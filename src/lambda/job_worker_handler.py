@@ -0,0 +1,36 @@
+import asyncio
+import os
+
+from src.apiEndpoint import DESPATCH_JOB_DEADLINE, despatch_worker_pool
+
+
+# Runs the workers for submit_despatch_job. Trigger it on a
+# schedule (e.g. an EventBridge rule every minute) and/or from an
+# SQS queue that submit_despatch_job's callers notify; the event
+# itself is ignored, each invocation drains the jobs collection.
+# The function timeout must exceed DESPATCH_JOB_DEADLINE: jobs are
+# only claimed while one more can still finish in time. A long
+# running process can instead start() despatch_worker_pool().
+
+# seconds kept back at the end of an invocation for finishing up
+WORKER_MARGIN_SECONDS = float(os.getenv("WORKER_MARGIN_SECONDS", "10"))
+# used when there is no Lambda context (local runs)
+WORKER_RUN_SECONDS = float(os.getenv("WORKER_RUN_SECONDS", "60"))
+
+
+def claim_window(context):
+    """Seconds during which new jobs may be claimed"""
+    if context is None:
+        return WORKER_RUN_SECONDS
+    remaining = context.get_remaining_time_in_millis() / 1000
+    return max(0.0, remaining - DESPATCH_JOB_DEADLINE - WORKER_MARGIN_SECONDS)
+
+
+def lambda_handler(event, context):
+    window = claim_window(context)
+    if window <= 0:
+        print("Function timeout is shorter than DESPATCH_JOB_DEADLINE, "
+              "no jobs claimed")
+        return {"jobs_run": 0}
+    jobs_run = asyncio.run(despatch_worker_pool().drain(window))
+    return {"jobs_run": jobs_run}
@@ -1,3 +1,5 @@
+import asyncio
+import io
 import json
 from xml.dom.minidom import parseString
 import xml.etree.ElementTree as ET
@@ -11,6 +13,8 @@ CORS_HEADERS = {
     "Access-Control-Allow-Headers": "Content-Type"
 }
 
+NDJSON_HEADERS = {**CORS_HEADERS, "Content-Type": "application/x-ndjson"}
+
 
 def lambda_handler(event, context):
     try:
@@ -34,6 +38,89 @@ def lambda_handler(event, context):
         }
 
 
+def batch_lambda_handler(event, context):
+    """
+    Convert many order documents ({"xmlDocs": [...]}) in one call.
+    The body is newline-delimited JSON, one line per document in
+    document order; see convert_orders_to_despatch_stream.
+
+    The Python runtime returns buffered responses only, so the whole
+    body is built before it is returned. Behind a streaming front end
+    (e.g. the Lambda Web Adapter) use stream_batch_lambda_handler,
+    which writes each line as soon as it is ready.
+    """
+    out = io.StringIO()
+    response = stream_batch_lambda_handler(event, out)
+    if response is None:
+        response = {
+            "statusCode": 200,
+            "headers": NDJSON_HEADERS,
+            "body": out.getvalue()
+        }
+    return response
+
+
+def stream_batch_lambda_handler(event, out):
+    """
+    Streaming form of batch_lambda_handler: writes the NDJSON lines
+    to out (any object with write(), flushed after every line when it
+    has flush()) as each document is done, so memory stays flat and
+    the first line goes out as soon as the first document is done.
+
+    Returns None once every line is written, or the error response
+    when the request itself is invalid (nothing is written then).
+    """
+    try:
+        body = json.loads(event.get("body") or "{}")
+        order_xmls = body.get("xmlDocs")
+
+        if not isinstance(order_xmls, list):
+            return {
+                "statusCode": 400,
+                "headers": CORS_HEADERS,
+                "body": json.dumps({"error": "Missing 'xmlDocs' list in request"})
+            }
+
+        async def write_lines():
+            async for line in convert_orders_to_despatch_stream(order_xmls):
+                out.write(line)
+                if hasattr(out, "flush"):
+                    out.flush()
+
+        asyncio.run(write_lines())
+        return None
+
+    except Exception as e:
+        return {
+            "statusCode": 500,
+            "headers": CORS_HEADERS,
+            "body": json.dumps({"error": f"Server error: {str(e)}"})
+        }
+
+
+async def convert_orders_to_despatch_stream(order_xmls):
+    """
+    Async generator of NDJSON lines, one per order document, each
+    {"index", "statusCode", "body"} as returned by
+    convert_order_to_despatch, yielded as soon as its document is
+    done. The conversion is CPU-bound ElementTree work that never
+    waits on I/O, so it runs inline: worker threads would only take
+    turns on the GIL.
+    """
+    for index, order_xml in enumerate(order_xmls):
+        if not isinstance(order_xml, str) or not order_xml:
+            response = {"statusCode": 400, "body": json.dumps({"error": "Missing order XML"})}
+        else:
+            response = convert_order_to_despatch(order_xml)
+        yield json.dumps({
+            "index": index,
+            "statusCode": response["statusCode"],
+            "body": json.loads(response["body"])
+        }) + "\n"
+        # let a streaming consumer on the same loop send the line
+        await asyncio.sleep(0)
+
+
 def convert_order_to_despatch(order_xml: str) -> dict:
     try:
         root = ET.fromstring(order_xml)
@@ -0,0 +1,989 @@
+# ================================================
+# In-memory storage backend with the subset of the
+# Motor client / database / collection API this code
+# base uses. Select it with DB_BACKEND=memory and every
+# dbConnect() / getClient() caller gets a MemoryClient
+# instead of a Motor client, no other code changes.
+
+# Documents live in per-collection dicts keyed by _id.
+# create_index() builds hash indexes (value -> _ids) that
+# serve equality, $in and $or lookups and enforce unique /
+# sparse like MongoDB does. Everything else is a scan.
+
+# Meant for profiling and dry runs: nothing is persisted
+# and there are no transactions.
+# ================================================
+
+import copy
+import functools
+import re
+from collections import Counter
+
+import pymongo
+import pymongo.errors
+from bson import ObjectId
+from pymongo.operations import (
+    DeleteMany,
+    DeleteOne,
+    InsertOne,
+    ReplaceOne,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+
+from src.queryBudget import recordCommand
+
+_MISSING = object()
+
+# order MongoDB sorts mixed types in
+_TYPE_ORDER = (
+    (type(None), 1),
+    (bool, 8),
+    ((int, float), 2),
+    (str, 3),
+    (dict, 4),
+    (list, 5),
+    (bytes, 6),
+    (ObjectId, 7),
+)
+
+
+def serverCommand(name):
+    """Count each call as one server command named name, as Motor would"""
+    def decorate(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            recordCommand(name)
+            return await method(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def getPath(document, path):
+    """Value at a dotted path, _MISSING if any part is absent"""
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            index = int(part)
+            value = value[index] if index < len(value) else _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def setPath(document, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def unsetPath(document, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+def sortKey(value):
+    if value is _MISSING:
+        value = None
+    for types, rank in _TYPE_ORDER:
+        if isinstance(value, types):
+            if isinstance(value, (dict, list)):
+                return (rank, repr(value))
+            return (rank, value)
+    return (9, value)
+
+
+def freeze(value):
+    """Hashable stand-in for a document value (index key)"""
+    if isinstance(value, dict):
+        return tuple((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return ("__list__",) + tuple(freeze(item) for item in value)
+    return value
+
+
+def compare(value, operator, operand):
+    if value is _MISSING:
+        return False
+    try:
+        if operator == "$gt":
+            return value > operand
+        if operator == "$gte":
+            return value >= operand
+        if operator == "$lt":
+            return value < operand
+        return value <= operand
+    except TypeError:
+        return False
+
+
+def valueEquals(value, expected):
+    if value is _MISSING:
+        return expected is None
+    if value == expected:
+        return True
+    # a scalar matches any element of an array field
+    return isinstance(value, list) and expected in value
+
+
+def matchOperators(value, conditions):
+    for operator, operand in conditions.items():
+        if operator == "$eq":
+            matched = valueEquals(value, operand)
+        elif operator == "$ne":
+            matched = not valueEquals(value, operand)
+        elif operator in ("$gt", "$gte", "$lt", "$lte"):
+            candidates = value if isinstance(value, list) else [value]
+            matched = any(
+                compare(item, operator, operand) for item in candidates
+            )
+        elif operator == "$in":
+            matched = any(valueEquals(value, item) for item in operand)
+        elif operator == "$nin":
+            matched = not any(valueEquals(value, item) for item in operand)
+        elif operator == "$exists":
+            matched = (value is not _MISSING) == bool(operand)
+        elif operator == "$regex":
+            pattern = re.compile(operand, _regexFlags(conditions))
+            matched = isinstance(value, str) and bool(pattern.search(value))
+        elif operator == "$options":
+            matched = True
+        elif operator == "$not":
+            matched = not matchOperators(value, operand)
+        else:
+            raise pymongo.errors.OperationFailure(
+                f"unknown operator: {operator}"
+            )
+        if not matched:
+            return False
+    return True
+
+
+def _regexFlags(conditions):
+    flags = 0
+    for option in conditions.get("$options", ""):
+        flags |= {"i": re.I, "m": re.M, "s": re.S, "x": re.X}.get(option, 0)
+    return flags
+
+
+def matches(document, query):
+    """True if document satisfies the (subset of a) MongoDB query"""
+    for field, condition in (query or {}).items():
+        if field == "$and":
+            if not all(matches(document, part) for part in condition):
+                return False
+        elif field == "$or":
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif field == "$nor":
+            if any(matches(document, part) for part in condition):
+                return False
+        else:
+            value = getPath(document, field)
+            isOperators = isinstance(condition, dict) and condition and all(
+                key.startswith("$") for key in condition
+            )
+            if isOperators:
+                if not matchOperators(value, condition):
+                    return False
+            elif not valueEquals(value, condition):
+                return False
+    return True
+
+
+def project(document, projection):
+    """Apply an inclusion or exclusion projection to a copy"""
+    if not projection:
+        return copy.deepcopy(document)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+
+    fields = {key: value for key, value in projection.items() if key != "_id"}
+    includeId = bool(projection.get("_id", 1))
+    if fields and all(fields.values()):
+        result = {}
+        if includeId and "_id" in document:
+            result["_id"] = document["_id"]
+        for field in fields:
+            value = getPath(document, field)
+            if value is not _MISSING:
+                setPath(result, field, copy.deepcopy(value))
+        return result
+
+    result = copy.deepcopy(document)
+    for field, include in fields.items():
+        if not include:
+            unsetPath(result, field)
+    if not includeId:
+        result.pop("_id", None)
+    return result
+
+
+def applyUpdate(document, update, inserting=False):
+    """Apply update operators to document in place"""
+    if not any(key.startswith("$") for key in update):
+        raise ValueError("update only works with $ operators")
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == "$set":
+                setPath(document, path, copy.deepcopy(value))
+            elif operator == "$setOnInsert":
+                if inserting:
+                    setPath(document, path, copy.deepcopy(value))
+            elif operator == "$unset":
+                unsetPath(document, path)
+            elif operator == "$inc":
+                current = getPath(document, path)
+                setPath(document, path,
+                        (0 if current is _MISSING else current) + value)
+            elif operator == "$push":
+                current = getPath(document, path)
+                items = [] if current is _MISSING else current
+                if isinstance(value, dict) and "$each" in value:
+                    items.extend(copy.deepcopy(value["$each"]))
+                else:
+                    items.append(copy.deepcopy(value))
+                setPath(document, path, items)
+            elif operator == "$min" or operator == "$max":
+                current = getPath(document, path)
+                better = current is _MISSING or (
+                    value < current if operator == "$min" else value > current
+                )
+                if better:
+                    setPath(document, path, value)
+            else:
+                raise pymongo.errors.OperationFailure(
+                    f"unknown update operator: {operator}"
+                )
+
+
+def upsertSeed(query):
+    """Fields an upsert copies from its equality filter"""
+    document = {}
+    for field, condition in (query or {}).items():
+        if field.startswith("$"):
+            continue
+        if isinstance(condition, dict) and any(
+            key.startswith("$") for key in condition
+        ):
+            if "$eq" in condition:
+                setPath(document, field, copy.deepcopy(condition["$eq"]))
+            continue
+        setPath(document, field, copy.deepcopy(condition))
+    return document
+
+
+def normaliseSort(sort, direction=None):
+    if sort is None:
+        return []
+    if isinstance(sort, str):
+        return [(sort, direction or pymongo.ASCENDING)]
+    if isinstance(sort, dict):
+        return list(sort.items())
+    return list(sort)
+
+
+class MemoryIndex:
+    """Hash index over one or more fields"""
+
+    def __init__(self, name, keys, unique=False, sparse=False):
+        self.name = name
+        self.fields = tuple(field for field, _ in keys)
+        self.keys = list(keys)
+        self.unique = unique
+        self.sparse = sparse
+        # index key -> set of _id
+        self.entries = {}
+
+    def keysFor(self, document):
+        values = [getPath(document, field) for field in self.fields]
+        if self.sparse and all(value is _MISSING for value in values):
+            return []
+        values = [None if value is _MISSING else value for value in values]
+        if len(values) == 1 and isinstance(values[0], list):
+            # multikey: one entry per element plus the whole array
+            return list({freeze(item) for item in values[0]}
+                        | {freeze(values[0])})
+        return [tuple(freeze(value) for value in values)
+                if len(values) > 1 else freeze(values[0])]
+
+    def conflict(self, document, documentId):
+        if not self.unique:
+            return None
+        for key in self.keysFor(document):
+            others = self.entries.get(key, set()) - {documentId}
+            if others:
+                return key
+        return None
+
+    def add(self, document):
+        for key in self.keysFor(document):
+            self.entries.setdefault(key, set()).add(document["_id"])
+
+    def remove(self, document):
+        for key in self.keysFor(document):
+            ids = self.entries.get(key)
+            if ids is not None:
+                ids.discard(document["_id"])
+                if not ids:
+                    del self.entries[key]
+
+    def lookup(self, value):
+        try:
+            return self.entries.get(freeze(value), set())
+        except TypeError:
+            return None
+
+
+class MemoryCursor:
+    """Lazy result of MemoryCollection.find"""
+
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sortSpec = []
+        self.skipCount = 0
+        self.limitCount = 0
+        self.results = None
+
+    def sort(self, key, direction=None):
+        self.sortSpec = normaliseSort(key, direction)
+        return self
+
+    def skip(self, count):
+        self.skipCount = count
+        return self
+
+    def limit(self, count):
+        self.limitCount = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def evaluate(self):
+        if self.results is None:
+            recordCommand("find")
+            documents = self.collection.select(self.query, self.sortSpec)
+            documents = documents[self.skipCount:]
+            if self.limitCount:
+                documents = documents[:self.limitCount]
+            self.results = [
+                project(document, self.projection) for document in documents
+            ]
+        return self.results
+
+    async def to_list(self, length=None):
+        results = self.evaluate()
+        taken = results if length is None else results[:length]
+        self.results = results[len(taken):]
+        return taken
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        results = self.evaluate()
+        if not results:
+            raise StopAsyncIteration
+        return results.pop(0)
+
+
+class MemoryCollection:
+    """Motor-compatible collection backed by a dict"""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self.documents = {}
+        self.indexes = {}
+        self.subCollections = {}
+
+    def __getattr__(self, name):
+        # coll.sub is the collection "coll.sub", as with Motor
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __iter__(self):
+        # any name is an item, so iterating (or "in") would never end;
+        # pymongo refuses both the same way
+        raise TypeError("'Collection' object is not iterable")
+
+    def __getitem__(self, name):
+        fullName = f"{self.name}.{name}"
+        return self.database[fullName]
+
+    def record(self, operation, indexed=None):
+        self.database.client.record(self.name, operation, indexed)
+
+    # ---------------------------------------------- queries
+
+    def candidates(self, query):
+        """_ids an index narrows the query to, None means scan"""
+        query = query or {}
+        if "_id" in query and not isinstance(query["_id"], dict):
+            return {query["_id"]} if query["_id"] in self.documents else set()
+        for field, condition in query.items():
+            if field == "$or":
+                found = set()
+                for part in condition:
+                    ids = self.candidates(part)
+                    if ids is None:
+                        break
+                    found |= ids
+                else:
+                    return found
+                continue
+            if field == "$and":
+                for part in condition:
+                    ids = self.candidates(part)
+                    if ids is not None:
+                        return ids
+                continue
+            index = self.singleFieldIndex(field)
+            if index is None:
+                continue
+            if isinstance(condition, dict) and any(
+                key.startswith("$") for key in condition
+            ):
+                if "$eq" in condition:
+                    values = [condition["$eq"]]
+                elif "$in" in condition:
+                    values = condition["$in"]
+                else:
+                    continue
+            else:
+                values = [condition]
+            if any(value is None for value in values) and index.sparse:
+                # missing fields are not in a sparse index
+                continue
+            found = set()
+            for value in values:
+                ids = index.lookup(value)
+                if ids is None:
+                    break
+                found |= ids
+            else:
+                return found
+        return None
+
+    def singleFieldIndex(self, field):
+        for index in self.indexes.values():
+            if index.fields == (field,):
+                return index
+        return None
+
+    def select(self, query, sort=None, operation="find"):
+        ids = self.candidates(query)
+        self.record(operation, indexed=ids is not None)
+        pool = (
+            self.documents.values() if ids is None
+            else (self.documents[i] for i in ids if i in self.documents)
+        )
+        found = [document for document in pool if matches(document, query)]
+        if ids is not None and not sort:
+            # index lookups lose insertion order, restore it
+            order = {key: position
+                     for position, key in enumerate(self.documents)}
+            found.sort(key=lambda document: order[document["_id"]])
+        for field, direction in reversed(normaliseSort(sort)):
+            found.sort(
+                key=lambda document: sortKey(getPath(document, field)),
+                reverse=direction == pymongo.DESCENDING,
+            )
+        return found
+
+    def first(self, query, sort=None, operation="find"):
+        found = self.select(query, sort, operation)
+        return found[0] if found else None
+
+    def find(self, filter=None, projection=None, sort=None, skip=0,
+             limit=0, **kwargs):
+        cursor = MemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    @serverCommand("find")
+    async def find_one(self, filter=None, projection=None, sort=None,
+                       **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        document = self.first(filter, sort)
+        return None if document is None else project(document, projection)
+
+    @serverCommand("aggregate")
+    async def count_documents(self, filter=None, **kwargs):
+        return len(self.select(filter, operation="count"))
+
+    @serverCommand("count")
+    async def estimated_document_count(self, **kwargs):
+        return len(self.documents)
+
+    @serverCommand("distinct")
+    async def distinct(self, key, filter=None, **kwargs):
+        values = []
+        for document in self.select(filter, operation="distinct"):
+            value = getPath(document, key)
+            if value is _MISSING:
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                if item not in values:
+                    values.append(item)
+        return values
+
+    # ---------------------------------------------- writes
+
+    def checkUnique(self, document, documentId):
+        for index in self.indexes.values():
+            key = index.conflict(document, documentId)
+            if key is not None:
+                message = (
+                    f"E11000 duplicate key error collection: "
+                    f"{self.full_name} index: {index.name} dup key: {key!r}"
+                )
+                raise pymongo.errors.DuplicateKeyError(
+                    message, 11000, {"code": 11000, "errmsg": message}
+                )
+
+    def store(self, document):
+        """Insert an (already copied) document, enforcing indexes"""
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        if document["_id"] in self.documents:
+            message = (
+                f"E11000 duplicate key error collection: {self.full_name} "
+                f"index: _id_ dup key: {document['_id']!r}"
+            )
+            raise pymongo.errors.DuplicateKeyError(
+                message, 11000, {"code": 11000, "errmsg": message}
+            )
+        self.checkUnique(document, document["_id"])
+        self.documents[document["_id"]] = document
+        for index in self.indexes.values():
+            index.add(document)
+        return document["_id"]
+
+    def replace(self, old, new):
+        self.checkUnique(new, old["_id"])
+        for index in self.indexes.values():
+            index.remove(old)
+        self.documents[old["_id"]] = new
+        for index in self.indexes.values():
+            index.add(new)
+
+    def remove(self, document):
+        for index in self.indexes.values():
+            index.remove(document)
+        del self.documents[document["_id"]]
+
+    def insertDocument(self, document):
+        # pymongo adds the generated _id to the caller's document
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        return self.store(copy.deepcopy(document))
+
+    def updateDocuments(self, filter, update, upsert=False, many=False,
+                        sort=None):
+        """Returns (matched, modified, upserted_id, last updated doc)"""
+        targets = self.select(filter, sort, "update")
+        if not many:
+            targets = targets[:1]
+        if not targets:
+            if not upsert:
+                return 0, 0, None, None
+            document = upsertSeed(filter)
+            applyUpdate(document, update, inserting=True)
+            upsertedId = self.store(document)
+            return 0, 0, upsertedId, document
+
+        modified = 0
+        updated = None
+        for target in targets:
+            updated = copy.deepcopy(target)
+            applyUpdate(updated, update)
+            if updated.get("_id") != target["_id"]:
+                raise pymongo.errors.WriteError(
+                    "Performing an update on the path '_id' would modify "
+                    "the immutable field '_id'", 66
+                )
+            if updated != target:
+                self.replace(target, updated)
+                modified += 1
+        return len(targets), modified, None, updated
+
+    @serverCommand("insert")
+    async def insert_one(self, document, **kwargs):
+        self.record("insert")
+        return InsertOneResult(self.insertDocument(document), True)
+
+    @serverCommand("insert")
+    async def insert_many(self, documents, ordered=True, **kwargs):
+        self.record("insert")
+        insertedIds = []
+        writeErrors = []
+        for index, document in enumerate(documents):
+            try:
+                insertedIds.append(self.insertDocument(document))
+            except pymongo.errors.DuplicateKeyError as error:
+                writeErrors.append({
+                    "index": index,
+                    "code": error.code,
+                    "errmsg": str(error),
+                    "op": document,
+                })
+                if ordered:
+                    break
+        if writeErrors:
+            raise pymongo.errors.BulkWriteError({
+                "writeErrors": writeErrors,
+                "writeConcernErrors": [],
+                "nInserted": len(insertedIds),
+                "nUpserted": 0,
+                "nMatched": 0,
+                "nModified": 0,
+                "nRemoved": 0,
+                "upserted": [],
+            })
+        return InsertManyResult(insertedIds, True)
+
+    @serverCommand("update")
+    async def update_one(self, filter, update, upsert=False, sort=None,
+                         **kwargs):
+        matched, modified, upsertedId, _ = self.updateDocuments(
+            filter, update, upsert, sort=sort
+        )
+        return updateResult(matched, modified, upsertedId)
+
+    @serverCommand("update")
+    async def update_many(self, filter, update, upsert=False, **kwargs):
+        matched, modified, upsertedId, _ = self.updateDocuments(
+            filter, update, upsert, many=True
+        )
+        return updateResult(matched, modified, upsertedId)
+
+    @serverCommand("update")
+    async def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        target = self.first(filter, operation="update")
+        if target is None:
+            if not upsert:
+                return updateResult(0, 0, None)
+            return updateResult(
+                0, 0, self.store(copy.deepcopy(replacement))
+            )
+        document = copy.deepcopy(replacement)
+        document["_id"] = target["_id"]
+        self.replace(target, document)
+        return updateResult(1, int(document != target), None)
+
+    @serverCommand("findAndModify")
+    async def find_one_and_update(self, filter, update, projection=None,
+                                  sort=None, upsert=False,
+                                  return_document=False, **kwargs):
+        before = self.first(filter, sort, "update")
+        before = copy.deepcopy(before)
+        _, _, _, after = self.updateDocuments(filter, update, upsert,
+                                              sort=sort)
+        document = after if return_document else before
+        return None if document is None else project(document, projection)
+
+    @serverCommand("findAndModify")
+    async def find_one_and_delete(self, filter, projection=None, sort=None,
+                                  **kwargs):
+        document = self.first(filter, sort, "delete")
+        if document is None:
+            return None
+        self.remove(document)
+        return project(document, projection)
+
+    @serverCommand("delete")
+    async def delete_one(self, filter, **kwargs):
+        document = self.first(filter, operation="delete")
+        if document is not None:
+            self.remove(document)
+        return DeleteResult({"n": int(document is not None)}, True)
+
+    @serverCommand("delete")
+    async def delete_many(self, filter, **kwargs):
+        documents = self.select(filter, operation="delete")
+        for document in documents:
+            self.remove(document)
+        return DeleteResult({"n": len(documents)}, True)
+
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        self.record("bulk_write")
+        for name in bulkCommands(requests, ordered):
+            recordCommand(name)
+        result = {
+            "writeErrors": [],
+            "writeConcernErrors": [],
+            "nInserted": 0,
+            "nUpserted": 0,
+            "nMatched": 0,
+            "nModified": 0,
+            "nRemoved": 0,
+            "upserted": [],
+        }
+        for index, request in enumerate(requests):
+            try:
+                self.applyRequest(request, index, result)
+            except (pymongo.errors.DuplicateKeyError,
+                    pymongo.errors.WriteError) as error:
+                result["writeErrors"].append({
+                    "index": index,
+                    "code": error.code,
+                    "errmsg": str(error),
+                })
+                if ordered:
+                    break
+        if result["writeErrors"]:
+            raise pymongo.errors.BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def applyRequest(self, request, index, result):
+        if isinstance(request, InsertOne):
+            self.insertDocument(request._doc)
+            result["nInserted"] += 1
+        elif isinstance(request, (UpdateOne, UpdateMany)):
+            matched, modified, upsertedId, _ = self.updateDocuments(
+                request._filter, request._doc, request._upsert,
+                many=isinstance(request, UpdateMany),
+            )
+            result["nMatched"] += matched
+            result["nModified"] += modified
+            if upsertedId is not None:
+                result["nUpserted"] += 1
+                result["upserted"].append({"index": index, "_id": upsertedId})
+        elif isinstance(request, ReplaceOne):
+            target = self.first(request._filter, operation="update")
+            if target is not None:
+                document = copy.deepcopy(request._doc)
+                document["_id"] = target["_id"]
+                self.replace(target, document)
+                result["nMatched"] += 1
+                result["nModified"] += int(document != target)
+            elif request._upsert:
+                upsertedId = self.store(copy.deepcopy(request._doc))
+                result["nUpserted"] += 1
+                result["upserted"].append({"index": index, "_id": upsertedId})
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            documents = self.select(request._filter, operation="delete")
+            if isinstance(request, DeleteOne):
+                documents = documents[:1]
+            for document in documents:
+                self.remove(document)
+            result["nRemoved"] += len(documents)
+        else:
+            raise TypeError(f"{request!r} is not a valid request")
+
+    # ---------------------------------------------- indexes
+
+    @serverCommand("createIndexes")
+    async def create_index(self, keys, unique=False, sparse=False,
+                           name=None, **kwargs):
+        keys = normaliseSort(keys, pymongo.ASCENDING)
+        name = name or "_".join(f"{field}_{direction}"
+                                for field, direction in keys)
+        existing = self.indexes.get(name)
+        if existing is not None:
+            if (existing.keys, existing.unique, existing.sparse) \
+                    != (list(keys), unique, sparse):
+                raise pymongo.errors.OperationFailure(
+                    f"An existing index has the same name as the "
+                    f"requested index: {name}", 86
+                )
+            return name
+        index = MemoryIndex(name, keys, unique=unique, sparse=sparse)
+        for document in self.documents.values():
+            key = index.conflict(document, document["_id"]) \
+                if index.unique else None
+            if key is not None:
+                raise pymongo.errors.DuplicateKeyError(
+                    f"E11000 duplicate key error collection: "
+                    f"{self.full_name} index: {name} dup key: {key!r}",
+                    11000,
+                )
+            index.add(document)
+        self.indexes[name] = index
+        return name
+
+    @serverCommand("listIndexes")
+    async def index_information(self):
+        information = {"_id_": {"key": [("_id", 1)]}}
+        for name, index in self.indexes.items():
+            information[name] = {"key": index.keys}
+            if index.unique:
+                information[name]["unique"] = True
+            if index.sparse:
+                information[name]["sparse"] = True
+        return information
+
+    @serverCommand("dropIndexes")
+    async def drop_index(self, name):
+        if self.indexes.pop(name, None) is None:
+            raise pymongo.errors.OperationFailure(f"index not found: {name}")
+
+    @serverCommand("drop")
+    async def drop(self):
+        self.database.collections.pop(self.name, None)
+
+
+def bulkCommands(requests, ordered):
+    """
+    Commands the driver splits a bulk write into: one per run of
+    inserts / updates / deletes when ordered, one per kind otherwise
+    """
+    kinds = []
+    for request in requests:
+        if isinstance(request, InsertOne):
+            kind = "insert"
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            kind = "delete"
+        else:
+            kind = "update"
+        if ordered and kinds and kinds[-1] == kind:
+            continue
+        if not ordered and kind in kinds:
+            continue
+        kinds.append(kind)
+    return kinds
+
+
+def updateResult(matched, modified, upsertedId):
+    raw = {"n": matched or int(upsertedId is not None),
+           "nModified": modified}
+    if upsertedId is not None:
+        raw["upserted"] = upsertedId
+    return UpdateResult(raw, True)
+
+
+class MemoryDatabase:
+    """Motor-compatible database holding MemoryCollections"""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __iter__(self):
+        raise TypeError("'Database' object is not iterable")
+
+    def __getitem__(self, name):
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = MemoryCollection(self, name)
+            self.collections[name] = collection
+        return collection
+
+    def get_collection(self, name, **kwargs):
+        return self[name]
+
+    @serverCommand("listCollections")
+    async def list_collection_names(self, **kwargs):
+        return list(self.collections)
+
+    @serverCommand("drop")
+    async def drop_collection(self, name):
+        self.collections.pop(getattr(name, "name", name), None)
+
+    async def command(self, command, *args, **kwargs):
+        name = command if isinstance(command, str) else next(iter(command))
+        recordCommand(name)
+        if name in ("ping", "hello", "isMaster", "ismaster"):
+            return {"ok": 1.0}
+        raise pymongo.errors.OperationFailure(
+            f"command {name} is not supported by the memory backend"
+        )
+
+
+class MemoryClient:
+    """
+    Motor-compatible client. It holds no connections, so close()
+    keeps the data and callers that close after every request still
+    share one store; shutdown() drops everything.
+
+    operations counts calls per (collection, operation) and
+    scans / indexedReads show how many reads an index served.
+    """
+
+    def __init__(self, uri=None, **kwargs):
+        self.uri = uri
+        self.databases = {}
+        self.operations = Counter()
+        self.indexedReads = 0
+        self.scans = 0
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __iter__(self):
+        raise TypeError("'MongoClient' object is not iterable")
+
+    def __getitem__(self, name):
+        database = self.databases.get(name)
+        if database is None:
+            database = MemoryDatabase(self, name)
+            self.databases[name] = database
+        return database
+
+    def get_database(self, name, **kwargs):
+        return self[name]
+
+    async def drop_database(self, name):
+        self.databases.pop(getattr(name, "name", name), None)
+
+    def record(self, collection, operation, indexed=None):
+        self.operations[(collection, operation)] += 1
+        if indexed is True:
+            self.indexedReads += 1
+        elif indexed is False:
+            self.scans += 1
+
+    def stats(self):
+        """Operation counters, for comparing runs"""
+        return {
+            "operations": {
+                f"{collection}.{operation}": count
+                for (collection, operation), count
+                in sorted(self.operations.items())
+            },
+            "indexed_reads": self.indexedReads,
+            "scans": self.scans,
+            "documents": {
+                collection.full_name: len(collection.documents)
+                for database in self.databases.values()
+                for collection in database.collections.values()
+            },
+        }
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        self.databases.clear()
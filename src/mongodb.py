@@ -1,10 +1,22 @@
-import motor.motor_asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 from motor.motor_asyncio import AsyncIOMotorCollection
 import asyncio
+import atexit
+import base64
+import binascii
+import datetime
+from bson import json_util
 from dotenv import load_dotenv
 import os
+import pymongo
 import pymongo.errors
+from src.dbIndexes import ensureIndexes
+from src.memoryStore import MemoryClient
+from src.dbMetrics import dbMetrics
+from src.queryBudget import budgetListener
+from src.cache import (
+    orderCache, despatchCache, cacheNamespace, documentTags
+)
 
 
 load_dotenv(
@@ -26,6 +38,54 @@ uri = next(
 )
 
 
+# Pool settings for the shared client. Defaults suit a single Lambda
+# container / API process; override through the environment.
+DB_NAME = os.getenv("MONGO_DB_NAME", "ubl_docs")
+MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zlib")
+# page sizes for listOrders / listDespatches
+LIST_DEFAULT_LIMIT = int(os.getenv("LIST_DEFAULT_LIMIT", "20"))
+LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", "100"))
+# documents per insert_many call for bulk loads
+BULK_CHUNK_SIZE = int(os.getenv("MONGO_BULK_CHUNK_SIZE", "1000"))
+# apply src/dbIndexes.py, in the background, from the first dbConnect()
+ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "1") != "0"
+# "mongo" (Motor) or "memory" (src/memoryStore.py, no server needed)
+DB_BACKEND = os.getenv("DB_BACKEND", "mongo").lower()
+
+# one client per (uri, event loop), created on first use and shared by
+# every caller on that loop. Motor clients are bound to the loop they
+# first ran on, so each asyncio.run() (warm Lambda invocations, test
+# cases) gets its own.
+_clients = {}
+
+
+class PooledMotorClient(AsyncIOMotorClient):
+    """
+    Shared Motor client. Callers hand it back with releaseClient(),
+    which keeps the pool open; shutdown() / close() close it.
+    """
+
+    def shutdown(self):
+        self.close()
+
+
+def runningLoop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def dropClosedLoopClients():
+    """Close the clients left over from event loops that have ended"""
+    for key in [key for key in _clients
+                if key[1] is not None and key[1].is_closed()]:
+        _clients.pop(key).shutdown()
+
+
 # Connection test on startup
 async def connectToMongo(db):
     try:
@@ -37,25 +97,107 @@ async def connectToMongo(db):
 
 
 # ===========================================
-# Purpose: Database function to import.
-# Creates a new instance of a db connection
+# Purpose: Fetch the shared client for a uri on the
+# running event loop, creating it (and its connection
+# pool) on first use. With DB_BACKEND=memory this is an
+# in-process MemoryClient holding its data in dicts
+# instead; it holds no loop state, so one is shared by
+# every loop.
 
-# Argument: nil
+# Argument: mongo uri, defaults to the configured one
 
-# Return: db (dictionary) containing all data
+# Return: PooledMotorClient or MemoryClient
 # ============================================
-async def dbConnect():
-    client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+def getClient(mongoUri: str = None):
+    mongoUri = mongoUri or uri
+    if DB_BACKEND == "memory":
+        key = (mongoUri, None)
+    else:
+        dropClosedLoopClients()
+        key = (mongoUri, runningLoop())
+    client = _clients.get(key)
+    if client is None and DB_BACKEND == "memory":
+        client = MemoryClient(mongoUri)
+        _clients[key] = client
+    elif client is None:
+        client = PooledMotorClient(
+            mongoUri,
+            maxPoolSize=MAX_POOL_SIZE,
+            minPoolSize=MIN_POOL_SIZE,
+            maxIdleTimeMS=MAX_IDLE_TIME_MS,
+            compressors=COMPRESSORS,
+            # command latency / pool metrics, see src/dbMetrics.py
+            event_listeners=dbMetrics.listeners() + [budgetListener],
+        )
+        _clients[key] = client
+    return client
 
-    # name of the collection inside the mongodb
-    db = client["ubl_docs"]
 
-    # Ensure the client is properly closed when done
-    try:
-        return client, db
-    except Exception as e:
+# ===========================================
+# Purpose: Hand a client from dbConnect() / getClient()
+# back when done with it. Shared clients stay open for
+# the next caller (closeDbClients() closes them), any
+# other client is closed.
+
+# Argument: client
+
+# Return: nil
+# ============================================
+def releaseClient(client):
+    if client is None:
+        return
+    if not any(client is shared for shared in _clients.values()):
         client.close()
-        raise e
+
+
+# ===========================================
+# Purpose: Database handle on the shared client.
+# No new connection is made.
+
+# Argument: database name, defaults to ubl_docs
+
+# Return: AsyncIOMotorDatabase
+# ============================================
+def getDb(name: str = DB_NAME, mongoUri: str = None):
+    return getClient(mongoUri)[name]
+
+
+# ===========================================
+# Purpose: Shutdown hook. Closes every shared client
+# and drops it from the registry, the next getClient()
+# call starts a fresh pool.
+
+# Argument: nil
+
+# Return: nil
+# ============================================
+def closeDbClients():
+    while _clients:
+        _, client = _clients.popitem()
+        client.shutdown()
+
+
+atexit.register(closeDbClients)
+
+
+# ===========================================
+# Purpose: Database function to import.
+# Returns the shared client and the ubl_docs db.
+# Hand the client back with releaseClient(), the pool
+# is kept for the next caller. The first call in a process
+# also starts bringing the indexes up to date, in the
+# background (see ensureIndexes).
+
+# Argument: nil
+
+# Return: client, db
+# ============================================
+async def dbConnect():
+    client = getClient()
+    db = client[DB_NAME]
+    if ENSURE_INDEXES:
+        await ensureIndexes(db)
+    return client, db
 
 
 # ===========================================
@@ -75,22 +217,118 @@ async def addOrder(data: dict, db: AsyncIOMotorCollection):
         raise error
 
 
+ORDER_LOOKUP_KEYS = ("UUID", "OrderID")
+# IDs a cached order is invalidated by
+ORDER_TAG_FIELDS = ("UUID", "OrderID", "ID")
+# create_despatch_advice stores a despatch under ID, older
+# documents carry DespatchID; UUID is the last resort
+DESPATCH_LOOKUP_KEYS = ("ID", "DespatchID", "UUID")
+
+
 # ===========================================
-# Purpose: Database function to import. Fetch order doc.
-# Argument: order UUID string
+# Purpose: Database function to import. Bulk version of
+# addOrder. Inserts in unordered insert_many batches, so
+# one bad document (e.g. a duplicate UUID) does not stop
+# the rest of the batch.
 
-# Return: fetched order object
+# Argument: list of order objects, db, documents per batch
+
+# Return: list with one result per input document, in
+# input order: index, inserted_id (None if it failed),
+# error, code and duplicate (True for duplicate keys)
+# ============================================
+async def addOrders(data: list, db, chunkSize: int = BULK_CHUNK_SIZE):
+    if chunkSize < 1:
+        raise ValueError("chunkSize must be at least 1.")
+
+    results = []
+    for start in range(0, len(data), chunkSize):
+        chunk = data[start:start + chunkSize]
+        failed = {}
+        try:
+            await db.orders.insert_many(chunk, ordered=False)
+        except pymongo.errors.BulkWriteError as error:
+            failed = {
+                writeError["index"]: writeError
+                for writeError in error.details.get("writeErrors", [])
+            }
+
+        # insert_many sets _id on each document before sending it
+        for offset, document in enumerate(chunk):
+            writeError = failed.get(offset)
+            results.append({
+                "index": start + offset,
+                "inserted_id": None if writeError else document.get("_id"),
+                "error": writeError["errmsg"] if writeError else None,
+                "code": writeError["code"] if writeError else None,
+                "duplicate": bool(writeError) and writeError["code"] == 11000,
+            })
+    return results
+
+
+# ===========================================
+# Purpose: Filter for an order lookup. With a key only
+# that field is matched, otherwise UUID and OrderID are
+# matched in a single $or query.
+
+# Argument: order UUID or OrderID string, optional key
+
+# Return: query dict
+# ============================================
+def orderQuery(orderUUID: str, key: str = None):
+    if key is not None:
+        if key not in ORDER_LOOKUP_KEYS:
+            raise ValueError(f"Cannot look orders up by {key}.")
+        return {key: orderUUID}
+    # OrderID is also accepted, as some tests might be using this
+    return {"$or": [{lookup: orderUUID} for lookup in ORDER_LOOKUP_KEYS]}
+
+
+# ===========================================
+# Purpose: Filter for a despatch lookup, matching the ID
+# fields in a single $or query
+
+# Argument: despatch ID string, the fields to match
+# (DESPATCH_LOOKUP_KEYS by default)
+
+# Return: query dict
 # ============================================
+def despatchQuery(despatchId: str, keys=DESPATCH_LOOKUP_KEYS):
+    return {"$or": [{lookup: despatchId} for lookup in keys]}
 
 
-async def getOrderInfo(orderUUID: str, db: AsyncIOMotorCollection):
+# ===========================================
+# Purpose: Database function to import. Fetch order doc.
+# Argument: order UUID or OrderID string, optional
+# projection (only fetch these fields) and optional key
+# ("UUID" or "OrderID") when the caller knows which one
+# it holds
+
+# Return: fetched order object
+# ============================================
+async def getOrderInfo(
+    orderUUID: str,
+    db: AsyncIOMotorCollection,
+    projection: dict = None,
+    key: str = None,
+):
     try:
-        res = await db.orders.find_one({"UUID": orderUUID})
+        async def load(fields=None):
+            return await db.orders.find_one(
+                orderQuery(orderUUID, key), fields
+            )
+
+        cacheKey = (cacheNamespace(db), orderUUID, key)
+        if projection is None:
+            res = await orderCache.getOrLoad(
+                cacheKey, load, documentTags(*ORDER_TAG_FIELDS)
+            )
+        else:
+            # a cached full document covers any projection, the
+            # projected result itself is never cached
+            res = orderCache.peek(cacheKey) or await load(projection)
         if not res:
-            # Try looking up by OrderID too, as some tests might be using this
-            res = await db.orders.find_one({"OrderID": orderUUID})
-            if not res:
-                raise ValueError(f"{orderUUID} not found.")
+            raise ValueError(f"{orderUUID} not found.")
         return res
     except Exception as e:
         print(f"Error retrieving order: {str(e)}")
@@ -105,6 +343,7 @@ async def getOrderInfo(orderUUID: str, db: AsyncIOMotorCollection):
 # ============================================
 async def deleteOrder(orderUUID, db: AsyncIOMotorCollection):
     response = await db.orders.delete_many({"UUID": orderUUID})
+    orderCache.invalidateTag(orderUUID)
     return response.deleted_count > 0
 
 
@@ -116,6 +355,40 @@ async def deleteOrder(orderUUID, db: AsyncIOMotorCollection):
 # ============================================
 async def clearDb(mongoDb: AsyncIOMotorClient):
     await mongoDb.orders.delete_many({})
+    orderCache.clear()
+    despatchCache.clear()
+
+
+def invalidateDocument(document_id):
+    """Drop a document from the read-through caches after a write"""
+    if document_id.startswith("ORD-"):
+        orderCache.invalidateTag(document_id)
+    else:
+        despatchCache.invalidateTag(document_id)
+
+
+def documentRoute(document_id):
+    """
+    Work out where a document lives from its ID
+
+    Args:
+        document_id (str): Order (ORD-...) or despatch ID
+
+    Returns:
+        tuple: (collection name, ID fields to match)
+    """
+    # Orders use the ORD- prefix, everything else is a despatch,
+    # matched on the same fields getDespatchAdvice reads it by
+    if document_id.startswith("ORD-"):
+        return "orders", ("OrderID",)
+    return "despatches", DESPATCH_LOOKUP_KEYS
+
+
+def routeQuery(fields, document_id):
+    """Filter matching document_id on any of fields"""
+    if len(fields) == 1:
+        return {fields[0]: document_id}
+    return despatchQuery(document_id, fields)
 
 
 async def updateDocument(document_id, update_data, db):
@@ -131,16 +404,11 @@ async def updateDocument(document_id, update_data, db):
         bool: True if updated successfully, False otherwise
     """
     try:
-        # Try to update in orders collection first
-        if document_id.startswith("ORD-"):
-            result = await db.orders.update_one(
-                {"OrderID": document_id}, {"$set": update_data}
-            )
-        # Otherwise try in despatches collection
-        else:
-            result = await db.despatches.update_one(
-                {"DespatchID": document_id}, {"$set": update_data}
-            )
+        collection, fields = documentRoute(document_id)
+        result = await db[collection].update_one(
+            routeQuery(fields, document_id), {"$set": update_data}
+        )
+        invalidateDocument(document_id)
 
         # Check if the update was successful
         return result.modified_count > 0
@@ -162,13 +430,11 @@ async def deleteDocument(document_id, db):
         bool: True if deleted successfully, False otherwise
     """
     try:
-        # Try to delete from orders collection first
-        if document_id.startswith("ORD-"):
-            result = await db.orders.delete_one({"OrderID": document_id})
-        # Otherwise try in despatches collection
-        else:
-            result = await db.despatches.delete_one({"DespatchID":
-                                                     document_id})
+        collection, fields = documentRoute(document_id)
+        result = await db[collection].delete_one(
+            routeQuery(fields, document_id)
+        )
+        invalidateDocument(document_id)
 
         # Check if the deletion was successful
         return result.deleted_count > 0
@@ -178,14 +444,321 @@ async def deleteDocument(document_id, db):
         return False
 
 
+async def bulkWriteDocuments(items, db, makeOperation):
+    """
+    Shared part of updateDocuments / deleteDocuments. Groups the
+    items by collection, checks which IDs exist with one $in query
+    per collection, then sends one unordered bulk_write per
+    collection.
+
+    Args:
+        items (list): (document_id, payload) pairs
+        db: Database connection
+        makeOperation (callable): builds the write for
+        (id_filter, payload)
+
+    Returns:
+        list: {"id", "success", "error"} per item, in input order
+    """
+    outcomes = [
+        {"id": document_id, "success": False, "error": None}
+        for document_id, _ in items
+    ]
+
+    groups = {}
+    for position, (document_id, payload) in enumerate(items):
+        try:
+            route = documentRoute(document_id)
+        except Exception as e:
+            outcomes[position]["error"] = f"Invalid document ID: {str(e)}"
+            continue
+        groups.setdefault(route, []).append((position, document_id, payload))
+
+    for (collection, fields), group in groups.items():
+        try:
+            ids = list({document_id for _, document_id, _ in group})
+            cursor = db[collection].find(
+                {"$or": [{field: {"$in": ids}} for field in fields]},
+                {field: 1 for field in fields},
+            )
+            found = {
+                doc.get(field)
+                for doc in await cursor.to_list(length=None)
+                for field in fields
+            }
+
+            operations, positions = [], []
+            for position, document_id, payload in group:
+                if document_id not in found:
+                    outcomes[position]["error"] = "Document not found"
+                    continue
+                operations.append(
+                    makeOperation(routeQuery(fields, document_id), payload)
+                )
+                positions.append(position)
+
+            if not operations:
+                continue
+
+            failed = {}
+            try:
+                await db[collection].bulk_write(operations, ordered=False)
+            except pymongo.errors.BulkWriteError as error:
+                failed = {
+                    writeError["index"]: writeError["errmsg"]
+                    for writeError in error.details.get("writeErrors", [])
+                }
+            finally:
+                for document_id in ids:
+                    invalidateDocument(document_id)
+
+            for index, position in enumerate(positions):
+                outcomes[position]["success"] = index not in failed
+                outcomes[position]["error"] = failed.get(index)
+
+        except Exception as e:
+            print(f"Error in bulk write on {collection}: {str(e)}")
+            for position, _, _ in group:
+                if outcomes[position]["error"] is None:
+                    outcomes[position]["error"] = str(e)
+
+    return outcomes
+
+
+async def updateDocuments(updates, db):
+    """
+    Update many documents, batched per collection with bulk_write
+
+    Args:
+        updates (list): (document_id, update_data) pairs, routed the
+        same way as updateDocument
+        db: Database connection
+
+    Returns:
+        list: {"id", "success", "error"} per update, in input order.
+        success is True when the document exists and the write was
+        accepted (even if nothing changed).
+    """
+    return await bulkWriteDocuments(
+        list(updates),
+        db,
+        lambda query, update_data: pymongo.UpdateOne(
+            query, {"$set": update_data}
+        ),
+    )
+
+
+async def deleteDocuments(document_ids, db):
+    """
+    Delete many documents, batched per collection with bulk_write
+
+    Args:
+        document_ids (list): IDs, routed the same way as deleteDocument
+        db: Database connection
+
+    Returns:
+        list: {"id", "success", "error"} per ID, in input order
+    """
+    return await bulkWriteDocuments(
+        [(document_id, None) for document_id in document_ids],
+        db,
+        lambda query, _: pymongo.DeleteOne(query),
+    )
+
+
+# Summary fields returned by the listings. Large fields (Items,
+# XMLData, the party blocks) are never read.
+ORDER_SUMMARY_FIELDS = (
+    "OrderID", "UUID", "CustomerID", "Status", "CreationDate",
+    "LastModified",
+)
+DESPATCH_SUMMARY_FIELDS = (
+    "ID", "UUID", "OrderID", "CustomerID", "Status", "CreationDate",
+    "LastModified",
+)
+# newest first; _id breaks ties between equal CreationDates
+LIST_SORT = [("CreationDate", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+
+
+# ===========================================
+# Purpose: CreationDate of a new order or despatch. Both
+# collections store a BSON datetime (UTC), so the listing
+# filters and the keyset sort treat them the same.
+
+# Argument: nil
+
+# Return: timezone-aware datetime
+# ============================================
+def creationDate():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def parseCreationDate(value):
+    """
+    createdFrom / createdTo filter value as a UTC datetime. Accepts a
+    datetime or an ISO 8601 string, either may leave out the time and
+    the offset (UTC is assumed).
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Invalid date: {value}.")
+    elif isinstance(value, datetime.date) and \
+            not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if not isinstance(value, datetime.datetime):
+        raise ValueError(f"Invalid date: {value}.")
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def jsonDefault(value):
+    """json.dumps default for stored documents: ISO 8601 datetimes"""
+    isoformat = getattr(value, "isoformat", None)
+    return isoformat() if callable(isoformat) else str(value)
+
+
+# ===========================================
+# Purpose: Opaque page cursor holding the sort key
+# (CreationDate, _id) of the last document on a page.
+
+# Argument: last document / cursor string
+
+# Return: cursor string / (CreationDate, _id)
+# ============================================
+# dates come back timezone-aware, like the ones creationDate() stores
+CURSOR_JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS.with_options(
+    tz_aware=True, tzinfo=datetime.timezone.utc
+)
+
+
+def encodeListCursor(document):
+    key = json_util.dumps([document.get("CreationDate"), document["_id"]])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decodeListCursor(cursor: str):
+    try:
+        key = json_util.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")),
+            json_options=CURSOR_JSON_OPTIONS,
+        )
+        creationDate, documentId = key
+    except (ValueError, TypeError, binascii.Error):
+        raise ValueError("Invalid cursor.")
+    return creationDate, documentId
+
+
+# ===========================================
+# Purpose: Keyset condition "sorts after the cursor" in
+# LIST_SORT order. Null / missing CreationDates sort
+# after every date, and strings (documents stored before
+# CreationDate became a datetime) after every datetime,
+# so neither is skipped by a $lt on the date.
+
+# Argument: CreationDate and _id of the cursor
+
+# Return: query dict
+# ============================================
+def sortsAfter(creationDate, documentId):
+    same = {"CreationDate": creationDate, "_id": {"$lt": documentId}}
+    if creationDate is None:
+        return same
+    later = [{"CreationDate": {"$lt": creationDate}}, {"CreationDate": None}]
+    if isinstance(creationDate, datetime.datetime):
+        # every string, strings sort below dates
+        later.append({"CreationDate": {"$gte": ""}})
+    return {"$or": later + [same]}
+
+
+# ===========================================
+# Purpose: Filter for a listing page. Equality on
+# CustomerID / Status, CreationDate range (from is
+# inclusive, to is exclusive) and, after the first page,
+# the keyset condition "sorts after the cursor".
+
+# Argument: filter values, cursor string
+
+# Return: query dict
+# ============================================
+def listQuery(customerId=None, status=None, createdFrom=None,
+              createdTo=None, cursor=None):
+    query = {}
+    if customerId is not None:
+        query["CustomerID"] = customerId
+    if status is not None:
+        query["Status"] = status
+    created = {}
+    if createdFrom is not None:
+        created["$gte"] = parseCreationDate(createdFrom)
+    if createdTo is not None:
+        created["$lt"] = parseCreationDate(createdTo)
+    if created:
+        query["CreationDate"] = created
+
+    if cursor:
+        after = sortsAfter(*decodeListCursor(cursor))
+        query = {"$and": [query, after]} if query else after
+    return query
+
+
+# ===========================================
+# Purpose: One keyset-paginated page of a collection.
+# Each page is a bounded index range scan from the cursor,
+# so its cost does not depend on how deep the page is or
+# how many documents match.
+
+# Argument: collection name, db, summary fields, filters,
+# limit (capped at LIST_MAX_LIMIT) and cursor from the
+# previous page
+
+# Return: {"items": [summary docs], "next_cursor": str or
+# None when this is the last page}
+# ============================================
+async def listDocuments(collection: str, db, fields, limit=None,
+                        cursor=None, **filters):
+    limit = LIST_DEFAULT_LIMIT if limit is None else int(limit)
+    if limit < 1:
+        raise ValueError("limit must be at least 1.")
+    limit = min(limit, LIST_MAX_LIMIT)
+
+    projection = {field: 1 for field in fields}
+    projection["CreationDate"] = 1
+    # one extra document tells us whether there is another page
+    page = await db[collection].find(
+        listQuery(cursor=cursor, **filters), projection
+    ).sort(LIST_SORT).limit(limit + 1).to_list(length=limit + 1)
+
+    nextCursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        nextCursor = encodeListCursor(page[-1])
+    return {"items": page, "next_cursor": nextCursor}
+
+
+async def listOrders(db, limit=None, cursor=None, **filters):
+    """Page of order summaries, see listDocuments"""
+    return await listDocuments(
+        "orders", db, ORDER_SUMMARY_FIELDS, limit, cursor, **filters
+    )
+
+
+async def listDespatches(db, limit=None, cursor=None, **filters):
+    """Page of despatch summaries, see listDocuments"""
+    return await listDocuments(
+        "despatches", db, DESPATCH_SUMMARY_FIELDS, limit, cursor, **filters
+    )
+
+
 # Only run this if called directly
 if __name__ == "__main__":
 
     async def main():
-        client, db = await dbConnect()
         try:
-            await connectToMongo(db)
+            await connectToMongo(getClient())
         finally:
-            client.close()
+            closeDbClients()
 
     asyncio.run(main())
@@ -0,0 +1,167 @@
+# ================================================
+# Per-request count of MongoDB commands.
+
+#   with QueryBudget(limit=6, strict=True, name="endpointFunc") as budget:
+#       ...
+#   budget.report()  ->  {"count": 5, "commands": {"find": 3, ...}}
+
+# The active budget lives in a context variable, so it
+# follows the request through awaits and into the driver
+# threads Motor runs commands on (Motor copies the
+# context). Every command the client sends is counted by
+# BudgetListener, which getClient() registers; the
+# in-memory backend counts its operations the same way.
+
+# A command listener cannot fail the command it observes,
+# so a strict budget raises QueryBudgetExceeded when the
+# block exits, or earlier from budget.check(). Code that
+# commits a response (e.g. stores it for idempotent
+# replay) calls budget.settle() first, so an over-budget
+# response is never committed.
+# ================================================
+
+import contextvars
+import functools
+import os
+import threading
+from collections import Counter
+
+from pymongo import monitoring
+
+
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "0") == "1"
+
+# commands one endpointFunc call may issue, 0 = count only
+ENDPOINT_QUERY_BUDGET = int(os.getenv("ENDPOINT_QUERY_BUDGET", "0")) or None
+
+# driver housekeeping, not queries the request asked for
+IGNORED_COMMANDS = frozenset({"endSessions", "hello", "isMaster", "ismaster"})
+
+_current = contextvars.ContextVar("queryBudget", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    """A strict QueryBudget saw more commands than its limit"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        super().__init__(
+            f"{budget.name or 'request'} issued {budget.count} MongoDB "
+            f"commands, budget is {budget.limit}: {dict(budget.commands)}"
+        )
+
+
+class QueryBudget:
+    """
+    Counts the MongoDB commands issued inside a with block. limit=None
+    only counts; strict (default QUERY_BUDGET_STRICT) raises on exit
+    once the limit is exceeded. Budgets nest: a command counts towards
+    every enclosing budget.
+    """
+
+    def __init__(self, limit=None, strict=None, name=None):
+        self.limit = limit
+        self.strict = QUERY_BUDGET_STRICT if strict is None else strict
+        self.name = name
+        self.commands = Counter()
+        self.parent = None
+        self.token = None
+        self.settled = False
+        self.lock = threading.Lock()
+
+    @property
+    def count(self):
+        return sum(self.commands.values())
+
+    @property
+    def exceeded(self):
+        return self.limit is not None and self.count > self.limit
+
+    def record(self, commandName):
+        budget = self
+        while budget is not None:
+            with budget.lock:
+                budget.commands[commandName] += 1
+            budget = budget.parent
+
+    def check(self):
+        """Raise now if a strict budget is already exceeded"""
+        if self.strict and self.exceeded:
+            raise QueryBudgetExceeded(self)
+
+    def settle(self):
+        """
+        Final check, before the result is committed. Commands after it
+        (bookkeeping) are still counted but no longer fail the block.
+        """
+        self.check()
+        self.settled = True
+
+    def report(self):
+        return {
+            "name": self.name,
+            "count": self.count,
+            "limit": self.limit,
+            "exceeded": self.exceeded,
+            "commands": dict(self.commands),
+        }
+
+    def __enter__(self):
+        self.parent = _current.get()
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        _current.reset(self.token)
+        self.token = None
+        if excType is None and not self.settled:
+            self.check()
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, excType, exc, traceback):
+        return self.__exit__(excType, exc, traceback)
+
+
+def queryBudget(name=None, limit=None, strict=None):
+    """
+    Decorator running each call of an async function in its own
+    QueryBudget; the function can read it through currentBudget()
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with QueryBudget(limit, strict, name or function.__name__):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def currentBudget():
+    """The innermost active QueryBudget, or None"""
+    return _current.get()
+
+
+def recordCommand(commandName):
+    """Count a command against the active budget(s), if any"""
+    budget = _current.get()
+    if budget is not None and commandName not in IGNORED_COMMANDS:
+        budget.record(commandName)
+
+
+class BudgetListener(monitoring.CommandListener):
+    """Feeds every command the driver sends into the active budget"""
+
+    def started(self, event):
+        recordCommand(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+budgetListener = BudgetListener()
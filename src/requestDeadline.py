@@ -0,0 +1,166 @@
+# ================================================
+# Per-request deadlines.
+
+#   @withDeadline()
+#   async def generate_despatch_pdf(despatch_id):
+#       ...
+
+# The entry point sets the deadline once. It lives in a
+# context variable, so every await below it (TaskGroup
+# tasks, asyncio.to_thread and Motor's executor threads
+# included) sees the same budget:
+#   - Mongo operations run under pymongo.timeout(), which
+#     sends the remaining time as maxTimeMS and caps
+#     server selection, connection checkout and socket
+#     reads with it
+#   - admission queues, renders and SMTP use remaining() /
+#     timeoutFor() for their own timeouts
+#   - the entry point itself is cancelled when the
+#     deadline passes and answers 504, as does any 5xx
+#     produced after it passed
+# ================================================
+
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import time
+
+import pymongo
+import pymongo.errors
+
+
+# API Gateway gives up on a request after 29 seconds
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "25"))
+# shortest budget handed to pymongo.timeout(), which treats 0 as no limit
+MIN_MONGO_TIMEOUT = 0.001
+# the driver gives up a round trip before the deadline, so a 5xx
+# this close to it is counted as a timeout
+TIMEOUT_MARGIN = 0.05
+
+_expiresAt = contextvars.ContextVar("requestDeadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time"""
+
+    def __init__(self, stage=None):
+        super().__init__(
+            f"Deadline exceeded during {stage}" if stage
+            else "Deadline exceeded"
+        )
+        self.stage = stage
+
+    def response(self):
+        """Lambda-style 504 response"""
+        return timeoutResponse(self.stage)
+
+
+def timeoutResponse(stage=None):
+    body = {"error": "Request timed out"}
+    if stage:
+        body["stage"] = stage
+    return {"statusCode": 504, "body": json.dumps(body)}
+
+
+class RequestDeadline:
+    """
+    Context manager setting the deadline `seconds` from now. A
+    nested deadline can only shorten the enclosing one.
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = REQUEST_DEADLINE_SECONDS if seconds is None \
+            else seconds
+        self.token = None
+
+    def __enter__(self):
+        expiresAt = time.monotonic() + self.seconds
+        outer = _expiresAt.get()
+        if outer is not None:
+            expiresAt = min(expiresAt, outer)
+        self.mongoTimeout = pymongo.timeout(
+            max(expiresAt - time.monotonic(), MIN_MONGO_TIMEOUT)
+        )
+        self.mongoTimeout.__enter__()
+        self.token = _expiresAt.set(expiresAt)
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        _expiresAt.reset(self.token)
+        self.mongoTimeout.__exit__(excType, exc, traceback)
+        return False
+
+
+def remaining():
+    """Seconds left before the deadline, None without one"""
+    expiresAt = _expiresAt.get()
+    if expiresAt is None:
+        return None
+    return max(0.0, expiresAt - time.monotonic())
+
+
+def expired(margin=0.0):
+    """True once the deadline (less margin seconds) has passed"""
+    left = remaining()
+    return left is not None and left <= margin
+
+
+def checkDeadline(stage=None):
+    """Raise DeadlineExceeded once the deadline has passed"""
+    if expired():
+        raise DeadlineExceeded(stage)
+
+
+def timeoutFor(default):
+    """default, capped by the time left"""
+    left = remaining()
+    return default if left is None else min(default, left)
+
+
+def isTimeout(exc):
+    """A deadline or Mongo timeout (maxTimeMS, CSOT, network)"""
+    return isinstance(exc, (DeadlineExceeded, asyncio.TimeoutError)) or (
+        isinstance(exc, pymongo.errors.PyMongoError) and exc.timeout
+    )
+
+
+async def withinDeadline(awaitable, stage=None):
+    """Await awaitable, cancelling it when the deadline passes"""
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(stage) from None
+
+
+# ===========================================
+# Purpose: Decorator for entry points returning
+# Lambda-style responses: run under a RequestDeadline and
+# turn running out of time into a 504.
+
+# Argument: seconds (REQUEST_DEADLINE_SECONDS by default);
+# a `deadline` keyword argument of the call overrides it
+
+# Return: the decorated coroutine function
+# ============================================
+def withDeadline(seconds=None):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with RequestDeadline(kwargs.get("deadline") or seconds):
+                try:
+                    response = await withinDeadline(func(*args, **kwargs))
+                except DeadlineExceeded as e:
+                    return e.response()
+                statusCode = response.get("statusCode", 200) \
+                    if isinstance(response, dict) else 200
+                if statusCode >= 500 and expired(TIMEOUT_MARGIN):
+                    # a timeout surfaced as a stage's own 500
+                    return timeoutResponse()
+                return response
+        return wrapper
+    return decorator
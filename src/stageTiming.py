@@ -0,0 +1,171 @@
+# ================================================
+# Per-request stage timings.
+
+#   timer = StageTimer("endpointFunc")
+#   with timer:
+#       with stage("validate_order"):
+#           ...
+#       order = await timed("create_order", create_order(...))
+#   return timer.finish(response)
+
+# The active timer lives in a context variable, so stages
+# started in TaskGroup tasks land in the same request. A
+# stage that runs twice adds up, and stages of a nested
+# timer are passed on to the enclosing one. finish() adds a
+# Server-Timing header to the Lambda-style response
+# (optionally a "timings" field in its body too) and feeds
+# the process-wide histograms behind stageStatsSnapshot().
+# ================================================
+
+import contextvars
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from src.dbMetrics import LatencyHistogram
+
+
+_current = contextvars.ContextVar("stageTimer", default=None)
+
+
+class StageTimer:
+    """Elapsed milliseconds per named stage of one request"""
+
+    def __init__(self, name="request"):
+        self.name = name
+        self.timings = {}
+        self.startedAt = None
+        self.totalMs = None
+        self.parent = None
+        self.token = None
+
+    def add(self, stageName, ms):
+        self.timings[stageName] = self.timings.get(stageName, 0.0) + ms
+        if self.parent is not None:
+            self.parent.add(stageName, ms)
+
+    def serverTiming(self):
+        """Server-Timing header value, total last"""
+        entries = [
+            f"{stageName};dur={ms:.1f}"
+            for stageName, ms in self.timings.items()
+        ]
+        if self.totalMs is not None:
+            entries.append(f"total;dur={self.totalMs:.1f}")
+        return ", ".join(entries)
+
+    def report(self):
+        return dict(
+            {stageName: round(ms, 3)
+             for stageName, ms in self.timings.items()},
+            total=round(self.totalMs or 0.0, 3),
+        )
+
+    # ===========================================
+    # Purpose: Stop the clock, record the request in the
+    # process-wide stage histograms and annotate the response
+    # with a Server-Timing header (and a "timings" body field
+    # when asked for; only JSON object bodies get one).
+
+    # Argument: Lambda-style response dict, include_timings
+
+    # Return: the same response
+    # ============================================
+    def finish(self, response, include_timings=False):
+        if self.totalMs is None:
+            self.totalMs = (time.perf_counter() - self.startedAt) * 1000
+            stageStats.record(self)
+        if not isinstance(response, dict):
+            return response
+        headers = dict(response.get("headers") or {})
+        headers["Server-Timing"] = self.serverTiming()
+        response["headers"] = headers
+        if include_timings:
+            try:
+                body = json.loads(response.get("body") or "{}")
+            except (TypeError, ValueError):
+                body = None
+            if isinstance(body, dict):
+                body["timings"] = self.report()
+                response["body"] = json.dumps(body)
+        return response
+
+    def __enter__(self):
+        self.startedAt = time.perf_counter()
+        self.parent = _current.get()
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        _current.reset(self.token)
+        self.token = None
+        return False
+
+
+@contextmanager
+def stage(stageName):
+    """Time the block as stageName of the active StageTimer, if any"""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    startedAt = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(stageName, (time.perf_counter() - startedAt) * 1000)
+
+
+async def timed(stageName, awaitable):
+    """Await awaitable as stageName of the active StageTimer"""
+    with stage(stageName):
+        return await awaitable
+
+
+def currentTimer():
+    return _current.get()
+
+
+class StageStats:
+    """Process-wide latency histograms per timer and stage"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = defaultdict(
+                lambda: defaultdict(LatencyHistogram)
+            )
+
+    def record(self, timer):
+        with self.lock:
+            histograms = self.histograms[timer.name]
+            for stageName, ms in timer.timings.items():
+                histograms[stageName].record(ms)
+            histograms["total"].record(timer.totalMs)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: {
+                    stageName: histogram.snapshot()
+                    for stageName, histogram in stages.items()
+                }
+                for name, stages in sorted(self.histograms.items())
+            }
+
+
+stageStats = StageStats()
+
+
+def stageStatsSnapshot():
+    """p50 / p95 / p99 per stage since the last reset"""
+    return stageStats.snapshot()
+
+
+def resetStageStats():
+    stageStats.reset()
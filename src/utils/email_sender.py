@@ -3,6 +3,7 @@ import os
 import logging
 import base64
 import smtplib
+from src.requestDeadline import DeadlineExceeded, checkDeadline, timeoutFor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
@@ -35,6 +36,7 @@ async def send_despatch_email(recipient_email, subject, body, attachment=None):
     try:
         if not SENDER_EMAIL or not SENDER_PASSWORD:
             raise ValueError("Missing sender email/password environment variables")
+        checkDeadline("smtp")
 
         message = MIMEMultipart()
         message["From"] = f"BoostXchange <{SENDER_EMAIL}>"
@@ -56,12 +58,16 @@ async def send_despatch_email(recipient_email, subject, body, attachment=None):
             username=SENDER_EMAIL,
             password=SENDER_PASSWORD,
             start_tls=True,
-            timeout=15
+            # whatever is left of the request deadline
+            timeout=timeoutFor(15)
         )
 
         logger.info(f"Email sent to {recipient_email}")
         return True
 
+    except DeadlineExceeded:
+        # the entry point answers 504, not a failed send
+        raise
     except Exception as e:
         logger.error(f"Email sending error: {str(e)}")
         return False
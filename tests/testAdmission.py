@@ -0,0 +1,152 @@
+import asyncio
+import json
+import threading
+import unittest
+
+from src.admission import AdmissionLimiter, Overloaded, admissionSnapshot
+from src.stageTiming import StageTimer
+
+
+class TestAdmissionLimiter(unittest.IsolatedAsyncioTestCase):
+    async def hold(self, limiter, release, order=None, label=None):
+        async with limiter.slot():
+            if order is not None:
+                order.append(label)
+            await release.wait()
+
+    async def testQueuesBeyondLimitInOrder(self):
+        limiter = AdmissionLimiter("test", 1, queueSize=4, maxWait=1)
+        release = asyncio.Event()
+        order = []
+        holders = [
+            asyncio.create_task(self.hold(limiter, release, order, n))
+            for n in range(3)
+        ]
+        await asyncio.sleep(0)
+
+        self.assertEqual(order, [0])
+        self.assertEqual(limiter.snapshot()["queued"], 2)
+
+        release.set()
+        await asyncio.gather(*holders)
+        self.assertEqual(order, [0, 1, 2])
+        snapshot = limiter.snapshot()
+        self.assertEqual((snapshot["active"], snapshot["queued"]), (0, 0))
+        self.assertEqual(snapshot["admitted"], 3)
+        self.assertEqual(snapshot["max_queued"], 2)
+
+    async def testFullQueueIsRejectedAtOnce(self):
+        limiter = AdmissionLimiter("test", 1, queueSize=1, maxWait=1)
+        release = asyncio.Event()
+        holders = [
+            asyncio.create_task(self.hold(limiter, release))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+
+        with self.assertRaises(Overloaded) as raised:
+            await limiter.acquire()
+
+        response = raised.exception.response()
+        self.assertEqual(response["statusCode"], 429)
+        self.assertGreaterEqual(int(response["headers"]["Retry-After"]), 1)
+        self.assertEqual(json.loads(response["body"])["limiter"], "test")
+        self.assertEqual(limiter.snapshot()["rejected_queue_full"], 1)
+        release.set()
+        await asyncio.gather(*holders)
+
+    async def testLongWaitTimesOut(self):
+        limiter = AdmissionLimiter("test", 1, queueSize=4, maxWait=0.01)
+        release = asyncio.Event()
+        holder = asyncio.create_task(self.hold(limiter, release))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(Overloaded) as raised:
+            await limiter.acquire()
+
+        self.assertEqual(raised.exception.statusCode, 503)
+        self.assertEqual(limiter.snapshot()["queued"], 0)
+        release.set()
+        await holder
+        self.assertEqual(limiter.snapshot()["active"], 0)
+
+    async def testCancelledWaiterLeavesQueue(self):
+        limiter = AdmissionLimiter("test", 1, queueSize=4, maxWait=1)
+        release = asyncio.Event()
+        holder = asyncio.create_task(self.hold(limiter, release))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        release.set()
+        await holder
+
+        snapshot = limiter.snapshot()
+        self.assertEqual((snapshot["active"], snapshot["queued"]), (0, 0))
+
+    async def testWaitIsTimedAsStage(self):
+        limiter = AdmissionLimiter("test", 1, queueSize=4, maxWait=1)
+        release = asyncio.Event()
+        holder = asyncio.create_task(self.hold(limiter, release))
+        await asyncio.sleep(0)
+
+        timer = StageTimer()
+        with timer:
+            waiter = asyncio.create_task(self.hold(limiter, release))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(holder, waiter)
+
+        self.assertIn("test_queue", timer.timings)
+
+    async def testRunUsesWorkerThread(self):
+        limiter = AdmissionLimiter("test", 2)
+        thread = await limiter.run(threading.get_ident)
+        self.assertNotEqual(thread, threading.get_ident())
+        self.assertEqual(limiter.snapshot()["active"], 0)
+
+    async def testDisabledLimiterAdmitsEverything(self):
+        limiter = AdmissionLimiter("test", 1, queueSize=0, enabled=False)
+        async with limiter.slot():
+            async with limiter.slot():
+                pass
+        self.assertEqual(limiter.snapshot()["admitted"], 0)
+
+    def testSnapshotCoversEveryLimiter(self):
+        self.assertEqual(set(admissionSnapshot()), {"db", "xml", "pdf"})
+
+
+class TestLimiterAcrossLoops(unittest.TestCase):
+    """A module level limiter used by one asyncio.run after another"""
+
+    def testEachLoopGetsItsOwnQueue(self):
+        limiter = AdmissionLimiter("test", 1, queueSize=4, maxWait=1)
+
+        async def abandoned():
+            # the loop ends with a slot held and a caller queued
+            await limiter.acquire()
+            asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            self.assertEqual(limiter.snapshot()["queued"], 1)
+
+        async def admitted():
+            async with limiter.slot():
+                waiter = asyncio.create_task(limiter.acquire())
+                await asyncio.sleep(0)
+                self.assertEqual(limiter.snapshot()["queued"], 1)
+            await waiter
+            limiter.release()
+
+        asyncio.run(abandoned())
+        asyncio.run(admitted())
+
+        self.assertEqual(len(limiter.queues), 1)
+        snapshot = limiter.snapshot()
+        self.assertEqual((snapshot["active"], snapshot["queued"]), (0, 0))
+        self.assertEqual(snapshot["admitted"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
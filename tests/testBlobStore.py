@@ -0,0 +1,125 @@
+import base64
+import json
+import tempfile
+import unittest
+from unittest.mock import patch, AsyncMock
+
+import src.despatch.blobStore as blobStore
+from src.despatch.blobStore import (
+    LocalBlobStore,
+    load_despatch_xml,
+    read_blob,
+    store_xml,
+    stream_despatch_xml,
+)
+from src.despatch.despatchCreate import (
+    generate_despatch_pdf,
+    get_despatch_xml,
+)
+from src.despatch.xmlStorage import encode_xml
+
+
+class TestBlobStore(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = LocalBlobStore(self.tmp.name, chunk_size=64)
+        patcher = patch.object(
+            blobStore, "get_blob_store", return_value=self.store
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+        line = "  <cac:DespatchLine><cbc:ID>{}</cbc:ID></cac:DespatchLine>\n"
+        self.xml = "<DespatchAdvice>\n{}</DespatchAdvice>".format(
+            "".join(line.format(number) for number in range(2000))
+        )
+
+    async def test_local_store_streams_in_chunks(self):
+        data = bytes(range(256)) * 4
+        blob_id = await self.store.put(data, "D-1.pdf")
+
+        chunks = [chunk async for chunk in self.store.stream(blob_id)]
+
+        self.assertEqual(len(chunks), 16)
+        self.assertEqual(b"".join(chunks), data)
+        await self.store.delete(blob_id)
+        await self.store.delete(blob_id)
+
+    async def test_small_xml_stays_inline(self):
+        fields = await store_xml("D-1", "<DespatchAdvice/>")
+        self.assertEqual(fields, {"XMLData": "<DespatchAdvice/>",
+                                  "XMLRef": None})
+
+    @patch.object(blobStore, "BLOB_THRESHOLD_BYTES", 100)
+    async def test_large_xml_is_offloaded(self):
+        fields = await store_xml("D-1", self.xml)
+
+        self.assertIsNone(fields["XMLData"])
+        ref = fields["XMLRef"]
+        self.assertEqual(ref["store"], "local")
+        self.assertTrue(ref["compressed"])
+        self.assertLess(ref["length"], len(self.xml))
+
+        pieces = [text async for text in stream_despatch_xml(fields)]
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual("".join(pieces), self.xml)
+        self.assertEqual(await load_despatch_xml(fields), self.xml)
+
+    @patch.object(blobStore, "BLOB_THRESHOLD_BYTES", 100)
+    @patch("src.despatch.despatchCreate.getDespatchAdvice",
+           new_callable=AsyncMock)
+    async def test_xml_download_streams_the_blob(self, mock_get_despatch):
+        mock_get_despatch.return_value = await store_xml("D-1", self.xml)
+
+        with patch.object(self.store, "stream",
+                          wraps=self.store.stream) as stream:
+            result = await get_despatch_xml("D-1")
+
+        self.assertEqual(result["statusCode"], 200)
+        self.assertEqual(result["body"], self.xml)
+        stream.assert_called_once()
+
+    @patch.object(blobStore, "BLOB_THRESHOLD_BYTES", 100)
+    @patch("src.despatch.blobStore.encode_xml", side_effect=lambda xml: xml)
+    async def test_uncompressed_blob(self, mock_encode):
+        fields = await store_xml("D-1", self.xml)
+
+        self.assertFalse(fields["XMLRef"]["compressed"])
+        self.assertEqual(await load_despatch_xml(fields), self.xml)
+
+    async def test_inline_documents_still_read(self):
+        self.assertEqual(
+            await load_despatch_xml({"XMLData": encode_xml(self.xml)}),
+            self.xml,
+        )
+        self.assertEqual(await load_despatch_xml({"XMLData": "<a/>"}), "<a/>")
+        self.assertEqual(await load_despatch_xml({}), "")
+
+    @patch("src.despatch.despatchCreate.xml_to_pdf", new_callable=AsyncMock)
+    @patch("src.despatch.despatchCreate.getDespatchAdvice",
+           new_callable=AsyncMock)
+    async def test_pdf_served_from_blob(self, mock_get_despatch, mock_pdf):
+        # several 64 byte chunks, not a multiple of 3 bytes long
+        pdf = b"%PDF-stored" + bytes(range(256))
+        blob_id = await self.store.put(pdf, "D-1.pdf")
+        mock_get_despatch.return_value = {
+            "ID": "D-1",
+            "XMLData": "<DespatchAdvice/>",
+            "PDFRef": {"store": "local", "id": blob_id, "length": len(pdf)},
+        }
+
+        result = await generate_despatch_pdf("D-1")
+
+        self.assertEqual(result["statusCode"], 200)
+        mock_pdf.assert_not_called()
+        self.assertEqual(
+            await read_blob(mock_get_despatch.return_value["PDFRef"]), pdf
+        )
+        self.assertEqual(
+            base64.b64decode(json.loads(result["body"])["pdf_data"]), pdf
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
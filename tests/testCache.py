@@ -0,0 +1,205 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from src.cache import AsyncLRUCache, documentTags, orderCache, despatchCache
+from src.mongodb import (
+    getOrderInfo, updateDocument, deleteOrder, clearDb
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAsyncLRUCache(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.clock = FakeClock()
+        self.cache = AsyncLRUCache(2, 10, clock=self.clock)
+
+    async def testHitAndMiss(self):
+        loader = AsyncMock(return_value={"UUID": "a"})
+        first = await self.cache.getOrLoad("a", loader)
+        second = await self.cache.getOrLoad("a", loader)
+
+        self.assertEqual(first, second)
+        loader.assert_awaited_once()
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    async def testReturnsCopies(self):
+        loader = AsyncMock(return_value={"lines": [1]})
+        value = await self.cache.getOrLoad("a", loader)
+        value["lines"].append(2)
+
+        self.assertEqual(await self.cache.getOrLoad("a", loader),
+                         {"lines": [1]})
+
+    async def testNoneIsNotCached(self):
+        loader = AsyncMock(return_value=None)
+        self.assertIsNone(await self.cache.getOrLoad("a", loader))
+        self.assertIsNone(await self.cache.getOrLoad("a", loader))
+        self.assertEqual(loader.await_count, 2)
+
+    async def testLruEviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    async def testTtlExpiry(self):
+        self.cache.set("a", 1)
+        self.clock.now = 9.9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    async def testSingleFlight(self):
+        release = asyncio.Event()
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"UUID": "a"}
+
+        tasks = [
+            asyncio.create_task(self.cache.getOrLoad("a", loader))
+            for _ in range(5)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks)
+
+        self.assertEqual(calls, 1)
+        self.assertEqual(results, [{"UUID": "a"}] * 5)
+
+    async def testSingleFlightSharesErrors(self):
+        release = asyncio.Event()
+        loader = AsyncMock(side_effect=ValueError("boom"))
+
+        async def slowLoader():
+            await release.wait()
+            return await loader()
+
+        tasks = [
+            asyncio.create_task(self.cache.getOrLoad("a", slowLoader))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        loader.assert_awaited_once()
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+        self.assertEqual(self.cache.inflight, {})
+
+    async def testInvalidateTag(self):
+        tags = documentTags("UUID", "OrderID")
+        loader = AsyncMock(return_value={"UUID": "u-1", "OrderID": "ORD-1"})
+        await self.cache.getOrLoad("by-uuid", loader, tags)
+        await self.cache.getOrLoad("by-order-id", loader, tags)
+
+        self.cache.invalidateTag("ORD-1")
+
+        self.assertIsNone(self.cache.get("by-uuid"))
+        self.assertIsNone(self.cache.get("by-order-id"))
+        self.assertEqual(self.cache.tagIndex, {})
+
+    async def testWriteDuringLoadIsNotCached(self):
+        release = asyncio.Event()
+
+        async def loader():
+            await release.wait()
+            return {"UUID": "a", "version": 1}
+
+        task = asyncio.create_task(self.cache.getOrLoad("a", loader))
+        await asyncio.sleep(0)
+        self.cache.invalidateTag("a")
+        release.set()
+        await task
+
+        self.assertIsNone(self.cache.get("a"))
+
+    async def testDisabled(self):
+        cache = AsyncLRUCache(2, 10, enabled=False)
+        loader = AsyncMock(return_value={"UUID": "a"})
+        await cache.getOrLoad("a", loader)
+        await cache.getOrLoad("a", loader)
+
+        self.assertEqual(loader.await_count, 2)
+        self.assertEqual(cache.stats()["size"], 0)
+
+
+class TestOrderCache(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        orderCache.clear()
+        self.order = {"UUID": "u-1", "OrderID": "ORD-1"}
+        self.db = MagicMock()
+        self.db.orders.find_one = AsyncMock(return_value=self.order)
+
+    async def asyncTearDown(self):
+        orderCache.clear()
+
+    async def testGetOrderInfoIsCached(self):
+        await getOrderInfo("ORD-1", self.db)
+        await getOrderInfo("ORD-1", self.db)
+        self.db.orders.find_one.assert_awaited_once()
+
+    async def testProjectionServedFromCachedDocument(self):
+        await getOrderInfo("ORD-1", self.db)
+        result = await getOrderInfo("ORD-1", self.db, projection={"UUID": 1})
+
+        self.assertEqual(result, self.order)
+        self.db.orders.find_one.assert_awaited_once()
+
+    async def testProjectionIsNotCached(self):
+        await getOrderInfo("ORD-1", self.db, projection={"UUID": 1})
+        await getOrderInfo("ORD-1", self.db)
+        self.assertEqual(self.db.orders.find_one.await_count, 2)
+
+    async def testUpdateDocumentInvalidates(self):
+        self.db.__getitem__.return_value.update_one = AsyncMock(
+            return_value=MagicMock(modified_count=1)
+        )
+        await getOrderInfo("ORD-1", self.db)
+        await updateDocument("ORD-1", {"Note": "x"}, self.db)
+        await getOrderInfo("ORD-1", self.db)
+        self.assertEqual(self.db.orders.find_one.await_count, 2)
+
+    async def testDeleteOrderInvalidates(self):
+        self.db.orders.delete_many = AsyncMock(
+            return_value=MagicMock(deleted_count=1)
+        )
+        await getOrderInfo("u-1", self.db)
+        await deleteOrder("u-1", self.db)
+        await getOrderInfo("u-1", self.db)
+        self.assertEqual(self.db.orders.find_one.await_count, 2)
+
+    async def testClearDbClearsBothCaches(self):
+        self.db.orders.delete_many = AsyncMock()
+        await getOrderInfo("u-1", self.db)
+        despatchCache.set("DES-1", {"DespatchID": "DES-1"})
+        self.addCleanup(despatchCache.clear)
+
+        await clearDb(self.db)
+
+        self.assertIsNone(despatchCache.get("DES-1"))
+        await getOrderInfo("u-1", self.db)
+        self.assertEqual(self.db.orders.find_one.await_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
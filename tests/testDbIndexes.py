@@ -0,0 +1,252 @@
+import asyncio
+import importlib
+import importlib.util
+import unittest
+from unittest.mock import patch, AsyncMock, MagicMock
+
+import pymongo.errors
+
+import src.dbIndexes as dbIndexes
+from src.dbIndexes import (
+    INDEX_VERSION,
+    applyIndexes,
+    applyIndexesSync,
+    ensureIndexes,
+    indexReport,
+)
+from src.memoryStore import MemoryClient
+
+
+def mockDb(storedVersion=None, asyncMethods=True):
+    """db mock whose collections are created on first access"""
+    collections = {}
+    mockType = AsyncMock if asyncMethods else MagicMock
+
+    def collection(name):
+        if name not in collections:
+            coll = MagicMock()
+            coll.create_index = mockType(
+                side_effect=lambda keys, **kw: "_".join(
+                    f"{f}_{d}" for f, d in keys
+                )
+            )
+            meta = {"version": storedVersion} if storedVersion else None
+            coll.find_one = mockType(return_value=meta)
+            coll.update_one = mockType()
+            collections[name] = coll
+        return collections[name]
+
+    db = MagicMock()
+    db.__getitem__.side_effect = collection
+    return db, collections
+
+
+class TestDbIndexes(unittest.IsolatedAsyncioTestCase):
+
+    async def test_applies_all_and_records_version(self):
+        db, collections = mockDb()
+
+        result = await applyIndexes(db)
+
+        self.assertTrue(result["success"])
+        self.assertFalse(result["skipped"])
+        self.assertEqual(result["version"], INDEX_VERSION)
+        self.assertIn("orders.UUID_1", result["applied"])
+        self.assertIn("despatches.DespatchID_1", result["applied"])
+        collections["schema_meta"].update_one.assert_called_once_with(
+            {"_id": "indexes"},
+            {"$set": {"version": INDEX_VERSION}},
+            upsert=True,
+        )
+
+    async def test_up_to_date_is_skipped(self):
+        db, collections = mockDb(storedVersion=INDEX_VERSION)
+
+        result = await applyIndexes(db)
+
+        self.assertTrue(result["skipped"])
+        self.assertNotIn("orders", collections)
+
+    async def test_failure_does_not_record_version(self):
+        db, collections = mockDb()
+        db["orders"].create_index.side_effect = Exception("dup key")
+
+        result = await applyIndexes(db)
+
+        self.assertFalse(result["success"])
+        self.assertTrue(any("orders.UUID_1" in f for f in result["failed"]))
+        collections["schema_meta"].update_one.assert_not_called()
+
+    async def test_single_collection(self):
+        db, collections = mockDb()
+
+        result = await applyIndexes(db, force=True, collections=["shipments"])
+
+        self.assertEqual(result["applied"], ["shipments.ID_1"])
+        self.assertNotIn("orders", collections)
+        # a partial run must not claim the whole version is applied
+        collections["schema_meta"].update_one.assert_not_called()
+
+    def test_sync_variant(self):
+        db, collections = mockDb(asyncMethods=False)
+
+        result = applyIndexesSync(db)
+
+        self.assertTrue(result["success"])
+        self.assertIn("users.google_id_1", result["applied"])
+        collections["schema_meta"].update_one.assert_called_once()
+
+    def resetEnsured(self):
+        for name, value in (("_ensured", False), ("_pending", None),
+                            ("_retryAt", 0.0)):
+            setattr(dbIndexes, name, value)
+            self.addCleanup(setattr, dbIndexes, name, value)
+
+    async def test_duplicate_uuids_do_not_block_migration(self):
+        db = MemoryClient()["ubl_docs"]
+        await db["orders"].insert_many([{"UUID": "u-1"}, {"UUID": "u-1"}])
+
+        result = await applyIndexes(db)
+
+        self.assertTrue(result["success"])
+        self.assertIn("orders.UUID_1", result["applied"])
+
+    async def test_duplicates_on_unique_index_are_named(self):
+        db = MemoryClient()["ubl_docs"]
+        await db["shipments"].insert_many([{"ID": "S-1"}, {"ID": "S-1"}])
+
+        with self.assertLogs("src.dbIndexes", "ERROR") as logs:
+            result = await applyIndexes(db)
+
+        self.assertFalse(result["success"])
+        self.assertEqual(result["duplicates"], ["shipments.ID_1"])
+        self.assertTrue(any("shipments.ID_1" in line and "duplicates" in line
+                            for line in logs.output))
+
+    async def test_options_conflict_rebuilds_the_index(self):
+        db = MemoryClient()["ubl_docs"]
+        # built by an older version, when orders.UUID was unique
+        await db["orders"].create_index("UUID", unique=True)
+
+        with self.assertLogs("src.dbIndexes", "WARNING"):
+            result = await applyIndexes(db)
+
+        self.assertTrue(result["success"])
+        self.assertIn("orders.UUID_1", result["applied"])
+        information = await db["orders"].index_information()
+        self.assertNotIn("unique", information["UUID_1"])
+
+    async def test_unresolved_options_conflict_is_a_failure(self):
+        db, collections = mockDb()
+        db["orders"].create_index.side_effect = pymongo.errors.OperationFailure(
+            "Index already exists with different options", 85
+        )
+        db["orders"].drop_index = AsyncMock()
+
+        with self.assertLogs("src.dbIndexes", "WARNING"):
+            result = await applyIndexes(db)
+
+        self.assertFalse(result["success"])
+        self.assertNotIn("orders.UUID_1", result["applied"])
+        collections["orders"].drop_index.assert_any_await("UUID_1")
+        collections["schema_meta"].update_one.assert_not_called()
+
+    @patch("src.dbIndexes.applyIndexes", new_callable=AsyncMock)
+    async def test_ensure_stops_retrying_on_duplicates(self, mock_apply):
+        mock_apply.return_value = {
+            "success": False, "skipped": False, "version": INDEX_VERSION - 1,
+            "applied": [], "failed": ["shipments.ID_1: E11000"],
+            "duplicates": ["shipments.ID_1"],
+        }
+        self.resetEnsured()
+
+        with self.assertLogs("src.dbIndexes", "ERROR") as logs:
+            await (await ensureIndexes(MagicMock()))
+
+        self.assertIn("shipments.ID_1", "".join(logs.output))
+        self.assertIsNone(await ensureIndexes(MagicMock()))
+        mock_apply.assert_called_once()
+
+    @unittest.skipUnless(importlib.util.find_spec("jwt"),
+                         "google_auth_handler needs PyJWT")
+    def test_login_path_applies_users_index_only(self):
+        auth = importlib.import_module("src.lambda.google_auth_handler")
+        self.addCleanup(setattr, auth, "_indexes_checked", False)
+        auth._indexes_checked = False
+        db, collections = mockDb(asyncMethods=False)
+
+        auth.init_user_collection(db)
+
+        self.assertTrue(auth._indexes_checked)
+        self.assertNotIn("orders", collections)
+        collections["users"].create_index.assert_called_once()
+
+    @patch("src.dbIndexes.applyIndexes", new_callable=AsyncMock)
+    async def test_ensure_runs_once(self, mock_apply):
+        mock_apply.return_value = {
+            "success": True, "skipped": True, "version": INDEX_VERSION,
+            "applied": [],
+        }
+        self.resetEnsured()
+
+        await (await ensureIndexes(MagicMock()))
+        self.assertIsNone(await ensureIndexes(MagicMock()))
+
+        mock_apply.assert_called_once()
+
+    @patch("src.dbIndexes.applyIndexes", new_callable=AsyncMock)
+    async def test_ensure_retries_after_failure(self, mock_apply):
+        mock_apply.side_effect = [
+            Exception("no server"),
+            {"success": True, "skipped": False, "version": INDEX_VERSION,
+             "applied": ["orders.UUID_1"]},
+        ]
+        self.resetEnsured()
+
+        await (await ensureIndexes(MagicMock()))
+        self.assertFalse(dbIndexes._ensured)
+        # not again straight away
+        self.assertIsNone(await ensureIndexes(MagicMock()))
+
+        dbIndexes._retryAt = 0.0
+        await (await ensureIndexes(MagicMock()))
+        self.assertTrue(dbIndexes._ensured)
+        self.assertEqual(mock_apply.call_count, 2)
+
+    async def test_ensure_does_not_block_the_caller(self):
+        self.resetEnsured()
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_apply(db):
+            started.set()
+            await release.wait()
+            return {"success": True, "skipped": True,
+                    "version": INDEX_VERSION, "applied": []}
+
+        with patch("src.dbIndexes.applyIndexes", slow_apply):
+            task = await ensureIndexes(MagicMock())
+            await started.wait()
+            self.assertFalse(task.done())
+            # a second request does not start another build
+            self.assertIsNone(await ensureIndexes(MagicMock()))
+            release.set()
+            await task
+        self.assertTrue(dbIndexes._ensured)
+
+    def test_report_covers_hot_queries(self):
+        report = {
+            f"{spec['collection']}.{spec['name']}": spec
+            for spec in indexReport()
+        }
+        for name in [
+            "orders.UUID_1", "orders.OrderID_1", "orders.ID_1",
+            "despatches.DespatchID_1", "despatches.UUID_1",
+            "despatches.OrderID_1", "shipments.ID_1",
+        ]:
+            self.assertIn(name, report)
+            self.assertTrue(report[name]["covers"])
+
+
+if __name__ == "__main__":
+    unittest.main()
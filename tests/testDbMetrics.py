@@ -0,0 +1,113 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import src.mongodb as mongodb
+from src.dbMetrics import (
+    CommandMetrics,
+    DbMetrics,
+    LatencyHistogram,
+    PoolMetrics,
+    dbMetrics,
+)
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def testPercentiles(self):
+        histogram = LatencyHistogram()
+        for _ in range(98):
+            histogram.record(0.8)
+        histogram.record(40)
+        histogram.record(3000)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 100)
+        self.assertEqual(snapshot["p50_ms"], 1)
+        self.assertEqual(snapshot["p99_ms"], 50)
+        self.assertEqual(snapshot["max_ms"], 3000)
+        self.assertEqual(snapshot["buckets"], {
+            "<=1": 98, "<=50": 1, "<=5000": 1,
+        })
+
+    def testEmpty(self):
+        snapshot = LatencyHistogram().snapshot()
+        self.assertEqual((snapshot["count"], snapshot["p99_ms"]), (0, 0.0))
+
+    def testOverflowBucket(self):
+        histogram = LatencyHistogram(bounds=(1, 2))
+        histogram.record(7)
+        self.assertEqual(histogram.snapshot()["buckets"], {">2": 1})
+        self.assertEqual(histogram.percentile(0.5), 7)
+
+
+class TestListeners(unittest.TestCase):
+    def testCommandLatencyAndFailures(self):
+        commands = CommandMetrics()
+        for duration in (1500, 2500):
+            commands.started(SimpleNamespace(command_name="find"))
+            commands.succeeded(SimpleNamespace(
+                command_name="find", duration_micros=duration
+            ))
+        commands.started(SimpleNamespace(command_name="insert"))
+        commands.failed(SimpleNamespace(
+            command_name="insert", duration_micros=9000
+        ))
+
+        snapshot = commands.snapshot()
+        self.assertEqual(snapshot["in_flight"], 0)
+        self.assertEqual(snapshot["commands"]["find"]["count"], 2)
+        self.assertEqual(snapshot["commands"]["find"]["mean_ms"], 2.0)
+        self.assertEqual(snapshot["commands"]["insert"]["failures"], 1)
+
+    def testPoolWaitsAndConnections(self):
+        pool = PoolMetrics()
+        pool.connection_created(SimpleNamespace())
+        pool.connection_ready(SimpleNamespace(duration=0.004))
+        pool.connection_check_out_started(SimpleNamespace())
+        pool.connection_checked_out(SimpleNamespace(duration=0.030))
+        pool.connection_check_out_started(SimpleNamespace())
+        pool.connection_check_out_failed(
+            SimpleNamespace(duration=0.5, reason="timeout")
+        )
+        pool.connection_checked_in(SimpleNamespace())
+        pool.connection_closed(SimpleNamespace(reason="idle"))
+
+        snapshot = pool.snapshot()
+        self.assertEqual(snapshot["checkout_wait"]["count"], 2)
+        self.assertEqual(snapshot["checkout_wait"]["max_ms"], 500)
+        self.assertEqual(snapshot["checkout_failures"], {"timeout": 1})
+        self.assertEqual((snapshot["waiting"], snapshot["checked_out"]),
+                         (0, 0))
+        self.assertEqual(snapshot["connections_created"], 1)
+        self.assertEqual(snapshot["connections_closed"], {"idle": 1})
+
+    def testSnapshotAndReset(self):
+        metrics = DbMetrics()
+        metrics.commands.succeeded(SimpleNamespace(
+            command_name="find", duration_micros=100
+        ))
+        self.assertIn("cpu_seconds", metrics.snapshot()["process"])
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()["commands"]["commands"], {})
+
+
+class TestClientRegistration(unittest.TestCase):
+    @unittest.skipIf(mongodb.DB_BACKEND == "memory",
+                     "needs a Motor client")
+    def testGetClientRegistersListeners(self):
+        with patch.dict(mongodb._clients, clear=True):
+            client = mongodb.getClient(
+                "mongodb://localhost:27017/metrics"
+                "?serverSelectionTimeoutMS=50"
+            )
+            try:
+                listeners = client.delegate.options.event_listeners
+                self.assertIn(dbMetrics.commands, listeners)
+                self.assertIn(dbMetrics.pool, listeners)
+            finally:
+                client.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,4 @@
+import asyncio
 import unittest
 import os
 import sys
@@ -15,6 +16,8 @@ from src.despatch.despatchCreate import (
     update_despatch_advice,
     delete_despatch_advice,
 )
+from src.admission import AdmissionLimiter, Overloaded
+from src.despatch.xmlStorage import decode_xml, encode_xml
 
 dirPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(dirPath)
@@ -144,9 +147,9 @@ class TestDespatchCreate(unittest.IsolatedAsyncioTestCase):
 
         self.assertEqual(result, self.valid_despatch_data)
         mock_db_connect.assert_called_once()
-        self.db.despatches.find_one.assert_called_once_with(
-            {"DespatchID": "D-12345678"}
-        )
+        self.db.despatches.find_one.assert_called_once_with({"$or": [
+            {"ID": "D-12345678"}, {"DespatchID": "D-12345678"},
+        ]})
         self.client.close.assert_called_once()
 
     @patch("src.despatch.despatchCreate.dbConnect", new_callable=AsyncMock)
@@ -247,6 +250,97 @@ class TestDespatchCreate(unittest.IsolatedAsyncioTestCase):
         self.db.despatches.insert_one.assert_called_once()
         self.client.close.assert_called_once()
 
+    @patch("src.despatch.despatchCreate.dbConnect", new_callable=AsyncMock)
+    @patch("src.despatch.despatchCreate.getOrderInfo", new_callable=AsyncMock)
+    async def test_create_despatch_advice_with_loaded_order(
+        self, mock_get_order, mock_db_connect
+    ):
+        mock_db_connect.return_value = (self.client, self.db)
+        insert_result = MagicMock()
+        insert_result.inserted_id = "mock_id"
+        self.db.despatches.insert_one.return_value = insert_result
+
+        result = await create_despatch_advice(
+            self.valid_event_body, order=self.sample_order
+        )
+
+        self.assertEqual(result["statusCode"], 200)
+        mock_get_order.assert_not_called()
+        self.db.despatches.insert_one.assert_called_once()
+
+    @patch("src.despatch.despatchCreate.dbConnect", new_callable=AsyncMock)
+    async def test_create_despatch_advice_stores_compressed_xml(
+        self, mock_db_connect
+    ):
+        mock_db_connect.return_value = (self.client, self.db)
+
+        result = await create_despatch_advice(
+            self.valid_event_body, order=self.sample_order
+        )
+
+        self.assertEqual(result["statusCode"], 200)
+        response_body = json.loads(result["body"])
+        stored = self.db.despatches.insert_one.call_args[0][0]
+        self.assertIsInstance(stored["XMLData"], bytes)
+        self.assertLess(len(stored["XMLData"]),
+                        len(response_body["xml_content"]))
+        self.assertEqual(decode_xml(stored["XMLData"]),
+                         response_body["xml_content"])
+        self.assertEqual(response_body["despatch_data"]["XMLData"],
+                         response_body["xml_content"])
+
+    @patch("src.despatch.despatchCreate.dbConnect", new_callable=AsyncMock)
+    async def test_create_despatch_advice_waits_for_an_xml_slot(
+        self, mock_db_connect
+    ):
+        mock_db_connect.return_value = (self.client, self.db)
+        limiter = AdmissionLimiter("xml", 1, queueSize=1, maxWait=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        with patch("src.despatch.despatchCreate.xmlLimiter", limiter):
+            holder = asyncio.create_task(hold())
+            await asyncio.sleep(0)
+            queued = asyncio.create_task(create_despatch_advice(
+                self.valid_event_body, order=self.sample_order
+            ))
+            await asyncio.sleep(0.01)
+            self.assertEqual(limiter.snapshot()["queued"], 1)
+
+            # the queue is full: turned away, nothing stored
+            with self.assertRaises(Overloaded) as raised:
+                await create_despatch_advice(
+                    self.valid_event_body, order=self.sample_order
+                )
+            self.assertEqual(raised.exception.response()["statusCode"], 429)
+            self.db.despatches.insert_one.assert_not_called()
+
+            release.set()
+            await holder
+            result = await queued
+
+        self.assertEqual(result["statusCode"], 200)
+        self.db.despatches.insert_one.assert_called_once()
+
+    @patch("src.despatch.despatchCreate.dbConnect", new_callable=AsyncMock)
+    async def test_create_despatch_advice_serialises_creation_date(
+        self, mock_db_connect
+    ):
+        mock_db_connect.return_value = (self.client, self.db)
+
+        result = await create_despatch_advice(
+            self.valid_event_body, order=self.sample_order
+        )
+
+        self.assertEqual(result["statusCode"], 200)
+        stored = self.db.despatches.insert_one.call_args[0][0]
+        response_body = json.loads(result["body"])
+        self.assertEqual(response_body["despatch_data"]["CreationDate"],
+                         stored["CreationDate"].isoformat())
+
     @patch("src.despatch.despatchCreate.dbConnect", new_callable=AsyncMock)
     @patch("src.despatch.despatchCreate.getOrderInfo", new_callable=AsyncMock)
     async def test_create_despatch_advice_missing_order_id(
@@ -475,6 +569,25 @@ class TestDespatchCreate(unittest.IsolatedAsyncioTestCase):
 
         mock_get_despatch.assert_called_once_with("D-12345678")
 
+    @patch(
+            "src.despatch.despatchCreate.getDespatchAdvice",
+            new_callable=AsyncMock
+        )
+    async def test_get_despatch_xml_compressed(self, mock_get_despatch):
+        compressed = dict(self.valid_despatch_data)
+        compressed["XMLData"] = encode_xml(self.sample_xml)
+        self.assertNotIsInstance(compressed["XMLData"], str)
+        mock_get_despatch.return_value = compressed
+
+        result = await get_despatch_xml("D-12345678")
+
+        self.assertEqual(result["statusCode"], 200)
+        self.assertEqual(result["body"], self.sample_xml)
+
+        result = await validate_despatch_advice("D-12345678")
+        validation = json.loads(result["body"])
+        self.assertEqual(validation["validation_status"], "Valid")
+
     @patch(
             "src.despatch.despatchCreate.getDespatchAdvice",
             new_callable=AsyncMock
@@ -546,7 +659,7 @@ class TestDespatchCreate(unittest.IsolatedAsyncioTestCase):
 
         # Verify update data contains correct fields
         update_data = mock_update_document.call_args[0][1]
-        self.assertEqual(update_data["XMLData"], self.sample_xml)
+        self.assertEqual(decode_xml(update_data["XMLData"]), self.sample_xml)
         self.assertEqual(update_data["Status"], "Completed")
         self.assertEqual(update_data["LastModified"], "2025-03-16T11:00:00")
 
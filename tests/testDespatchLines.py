@@ -0,0 +1,193 @@
+import asyncio
+import copy
+import datetime
+import json
+import os
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from src.despatch.despatchLine import (
+    DespatchLineError,
+    despatchLine,
+    despatchLines,
+)
+from src.despatch.lineColumns import INVALID_MESSAGE
+from src.memoryStore import MemoryClient
+from src.mongodb import addOrder
+
+
+dirPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+filePath = os.path.join(dirPath, "public", "exampleOrderDoc.json")
+
+with open(filePath, "r") as file:
+    EXAMPLE_ORDER = json.load(file)
+
+
+def lineSpec(**overrides):
+    spec = {
+        "DeliveredQuantity": 10,
+        "BackOrderQuantity": 2,
+        "ID": "DL-001",
+        "Note": "Test Note",
+        "BackOrderReason": "Stock shortage",
+        "LotNumber": "LOT-123",
+        "ExpiryDate": "2024-12-31",
+    }
+    spec.update(overrides)
+    return spec
+
+
+def multiLineOrder(count):
+    order = copy.deepcopy(EXAMPLE_ORDER)
+    template = order["OrderLine"]
+    order["OrderLine"] = []
+    for number in range(1, count + 1):
+        line = copy.deepcopy(template)
+        line["LineItem"]["ID"] = str(number)
+        line["LineItem"]["Item"]["Name"] = f"item {number}"
+        order["OrderLine"].append(line)
+    return order
+
+
+class TestDespatchLines(unittest.IsolatedAsyncioTestCase):
+    async def testBuildsEveryLineFromGivenOrder(self):
+        order = multiLineOrder(300)
+        specs = [lineSpec(ID=f"DL-{n}") for n in range(300)]
+
+        result = await despatchLines(specs, order["UUID"], order=order)
+
+        lines = result["DespatchLine"]
+        self.assertEqual(len(lines), 300)
+        self.assertEqual(lines[0]["ID"], "DL-0")
+        self.assertEqual(lines[299]["Item"]["Name"], "item 300")
+        self.assertEqual(lines[5]["OrderLineReference"]["LineID"], "6")
+        self.assertEqual(
+            lines[0]["OrderLineReference"]["OrderReference"]["ID"],
+            order["ID"],
+        )
+        lot = lines[0]["Item"]["ItemInstance"]["LotIdentification"]
+        self.assertEqual(lot["LotNumberID"], 123)
+        self.assertEqual(lot["ExpiryDate"], datetime.datetime(2024, 12, 31))
+
+    async def testLineIdPicksOrderLine(self):
+        order = multiLineOrder(3)
+        result = await despatchLines(
+            [lineSpec(LineID="3"), lineSpec(LineID="missing")],
+            order["UUID"], order=order,
+        )
+        names = [line["Item"]["Name"] for line in result["DespatchLine"]]
+        # an unknown LineID falls back to pairing by position
+        self.assertEqual(names, ["item 3", "item 2"])
+
+    async def testSingleLineOrder(self):
+        result = await despatchLines(
+            [lineSpec(), lineSpec(ID="DL-002")],
+            EXAMPLE_ORDER["UUID"], order=EXAMPLE_ORDER,
+        )
+        names = {line["Item"]["Name"] for line in result["DespatchLine"]}
+        self.assertEqual(names, {"beeswax"})
+
+    async def testReportsEveryInvalidLine(self):
+        specs = [
+            lineSpec(),
+            lineSpec(DeliveredQuantity="ten"),
+            {"ID": "DL-3"},
+            lineSpec(ExpiryDate="31/12/2024"),
+        ]
+
+        with self.assertRaises(DespatchLineError) as raised:
+            await despatchLines(specs, "UUID", order=EXAMPLE_ORDER)
+
+        errors = raised.exception.errors
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(errors[0].startswith("Line 2:"))
+        self.assertIn("insufficient information", errors[1])
+
+    async def testEmptySpecs(self):
+        with self.assertRaises(ValueError):
+            await despatchLines([], "UUID", order=EXAMPLE_ORDER)
+
+    async def testLoadsOrderFromDatabase(self):
+        db = MemoryClient()["ubl_docs"]
+        await db["orders"].insert_one(copy.deepcopy(EXAMPLE_ORDER))
+
+        result = await despatchLines(
+            [lineSpec()], EXAMPLE_ORDER["UUID"], db=db
+        )
+
+        self.assertEqual(result["DespatchLine"][0]["Item"]["Name"], "beeswax")
+        with self.assertRaises(ValueError):
+            await despatchLines([lineSpec()], "INVALID_UUID_1234", db=db)
+
+    async def testLegacyWrapperRefusesRunningLoop(self):
+        with self.assertRaises(RuntimeError) as raised:
+            despatchLine(lineSpec(), EXAMPLE_ORDER["UUID"], EXAMPLE_ORDER)
+        self.assertIn("await despatchLines", str(raised.exception))
+
+    async def testOrderWithItemsOnly(self):
+        # as create_order stores it: Items, no OrderLine
+        order = {
+            "OrderID": "ORD-1",
+            "UUID": "u-1",
+            "Items": [
+                {"item_id": "A-1", "quantity": 5, "price": 1},
+                {"item_id": "B-2", "quantity": 1, "price": 2},
+            ],
+        }
+
+        result = await despatchLines(
+            [lineSpec(), lineSpec(ID="DL-2", LineID="2")], "u-1", order=order
+        )
+
+        lines = result["DespatchLine"]
+        self.assertEqual(
+            [line["Item"]["SellersItemIdentification"]["ID"]
+             for line in lines],
+            ["A-1", "B-2"],
+        )
+        reference = lines[1]["OrderLineReference"]
+        self.assertEqual(reference["LineID"], "2")
+        self.assertEqual(reference["OrderReference"]["ID"], "ORD-1")
+
+        with self.assertRaises(ValueError):
+            await despatchLines([lineSpec()], "u-2",
+                                order={"UUID": "u-2", "Items": []})
+
+
+class TestLegacyDespatchLine(unittest.TestCase):
+    def testLoadsOrderInOneEventLoop(self):
+        client = MemoryClient()
+        db = client["ubl_docs"]
+        asyncio.run(addOrder(copy.deepcopy(EXAMPLE_ORDER), db))
+
+        with patch("src.despatch.despatchLine.dbConnect",
+                   AsyncMock(return_value=(client, db))), \
+                patch("asyncio.run", wraps=asyncio.run) as run:
+            result = despatchLine(lineSpec(), EXAMPLE_ORDER["UUID"])
+            run.assert_called_once()
+            with self.assertRaises(ValueError) as raised:
+                despatchLine(lineSpec(), "INVALID_UUID_1234")
+
+        self.assertEqual(result["DespatchLine"]["Item"]["Name"], "beeswax")
+        self.assertTrue(str(raised.exception).startswith("Database error"))
+
+    def testSingleLineMatches(self):
+        legacy = despatchLine(lineSpec(), EXAMPLE_ORDER["UUID"],
+                              EXAMPLE_ORDER)
+        lines = asyncio.run(despatchLines(
+            [lineSpec()], EXAMPLE_ORDER["UUID"], order=EXAMPLE_ORDER
+        ))
+        self.assertEqual(
+            legacy["DespatchLine"]["Item"],
+            lines["DespatchLine"][0]["Item"],
+        )
+
+    def testInvalidSpecKeepsItsMessage(self):
+        with self.assertRaises(ValueError) as raised:
+            despatchLine(lineSpec(DeliveredQuantity="many"), "UUID")
+        self.assertEqual(str(raised.exception),
+                         INVALID_MESSAGE)
+
+
+if __name__ == "__main__":
+    unittest.main()
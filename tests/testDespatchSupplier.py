@@ -1,4 +1,4 @@
-from src.mongodb import dbConnect, clearDb, addOrder
+from src.mongodb import dbConnect, clearDb, addOrder, releaseClient
 from src.despatch.despatchSupplier import despatchSupplier
 import unittest
 import json
@@ -27,7 +27,7 @@ class testDespatchSupplier(unittest.IsolatedAsyncioTestCase):
     async def asyncTearDown(self):
         if self.client.close:
             await clearDb(self.db)
-            self.client.close()
+            releaseClient(self.client)
     # ============================================
     # ============================================
 
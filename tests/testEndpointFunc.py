@@ -1,10 +1,42 @@
-from src.apiEndpoint import endpointFunc
+from src.apiEndpoint import (
+    batch_ndjson,
+    batchEndpointFunc,
+    despatch_job_status,
+    despatch_worker_pool,
+    endpointFunc,
+    submit_despatch_job,
+)
+from src.admission import AdmissionLimiter, Overloaded
+from src.despatch.despatchCreate import create_despatch_advice
+from src.memoryStore import MemoryClient
+from src.queryBudget import (
+    QueryBudgetExceeded, queryBudget, recordCommand
+)
+import asyncio
+import datetime
+import json
+from pymongo.errors import DuplicateKeyError
 import unittest
+from unittest.mock import patch, AsyncMock, MagicMock
 import os
 
 os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
 
+EXAMPLE_LINE = {
+    "LineItem": {
+        "ID": "1",
+        "SalesOrderID": "A",
+        "Item": {
+            "Description": "Acme beeswax",
+            "Name": "beeswax",
+            "BuyersItemIdentification": {"ID": "6578489"},
+            "SellersItemIdentification": {"ID": "17589683"},
+        },
+    },
+}
+
+
 class testFirstApiEndpoint(
     unittest.IsolatedAsyncioTestCase
 ):  # Change to IsolatedAsyncioTestCase
@@ -25,5 +57,842 @@ class testFirstApiEndpoint(
                 await endpointFunc(*arguments)  # Add await here
 
 
+class testMockedEndpoint(unittest.IsolatedAsyncioTestCase):
+    """endpointFunc with every stage mocked out"""
+
+    async def asyncSetUp(self):
+        self.order = {
+            "OrderID": "ORD-12345",
+            "UUID": "550e8400-e29b-41d4-a716-446655440000",
+            "SellerSupplierParty": {"Party": {}},
+        }
+        order_json = {
+            "CustomerID": "CUST-001",
+            "Items": [{"item_id": "ITEM-001", "quantity": 5, "price": 1}],
+        }
+        self.shipment = {
+            "ID": "SHIP-123456",
+            "Consignment": {"ID": "C-1"},
+            "Delivery": {},
+        }
+
+        self.db = MagicMock()
+        self.db["shipments"].delete_one = AsyncMock()
+
+        patches = {
+            "dbConnect": AsyncMock(return_value=(MagicMock(), self.db)),
+            "validate_order_document": AsyncMock(
+                return_value=(True, [], order_json)
+            ),
+            "create_order": AsyncMock(return_value={
+                "statusCode": 200,
+                "body": json.dumps({
+                    "order_id": "ORD-12345",
+                    "uuid": self.order["UUID"],
+                }),
+            }),
+            "create_order_reference": AsyncMock(return_value={"ID": "1"}),
+            "despatchSupplier": AsyncMock(return_value={"Party": {}}),
+            "deliveryCustomer": AsyncMock(return_value={"Party": {}}),
+            "create_shipment": AsyncMock(
+                return_value={"success": True, "document": {}}
+            ),
+            "create_despatch_advice": AsyncMock(return_value={
+                "statusCode": 200,
+                "body": json.dumps({
+                    "despatch_id": "D-1",
+                    "despatch_data": {"ID": "D-1"},
+                }),
+            }),
+            "validate_despatch_advice": AsyncMock(return_value={
+                "statusCode": 200,
+                "body": json.dumps({"validation_status": "Valid"}),
+            }),
+            "json_to_xml": MagicMock(return_value="<DespatchAdvice/>"),
+        }
+        self.mocks = {}
+        for name, mock in patches.items():
+            patcher = patch(f"src.apiEndpoint.{name}", mock)
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = patch(
+            "src.despatch.orderContext.getOrderInfo",
+            AsyncMock(return_value=self.order),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # idempotency records go to a fresh in-memory store per test
+        self.idempotencyDb = MemoryClient()["ubl_docs"]
+        patcher = patch(
+            "src.idempotency.getDb", MagicMock(return_value=self.idempotencyDb)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def runEndpoint(self, **kwargs):
+        return await endpointFunc("<Order/>", self.shipment, {}, {}, **kwargs)
+
+    async def testStagesOverlap(self):
+        # each branch waits until all four have started, which can
+        # only happen if they run concurrently
+        started = 0
+        all_started = asyncio.Event()
+
+        def branch(result):
+            async def run(*args, **kwargs):
+                nonlocal started
+                started += 1
+                if started == 4:
+                    all_started.set()
+                await all_started.wait()
+                return result
+            return run
+
+        self.mocks["create_order_reference"].side_effect = branch({})
+        self.mocks["despatchSupplier"].side_effect = branch({"Party": {}})
+        self.mocks["deliveryCustomer"].side_effect = branch({"Party": {}})
+        self.mocks["create_shipment"].side_effect = branch(
+            {"success": True, "document": {}}
+        )
+
+        result = await asyncio.wait_for(self.runEndpoint(), timeout=2)
+
+        self.assertEqual(result["statusCode"], 200)
+        self.assertEqual(started, 4)
+
+    async def testReportsDbQueries(self):
+        async def update_reference(*args, **kwargs):
+            recordCommand("findAndModify")
+            return {"ID": "1"}
+
+        self.mocks["create_order_reference"].side_effect = update_reference
+
+        result = await self.runEndpoint(idempotency_key="k-1",
+                                        fields="db_queries")
+
+        # the idempotency claim and the order reference update
+        self.assertEqual(json.loads(result["body"])["db_queries"], 2)
+
+    async def testOverBudgetResponseIsNotStored(self):
+        async def update_reference(*args, **kwargs):
+            for _ in range(3):
+                recordCommand("find")
+            return {"ID": "1"}
+
+        self.mocks["create_order_reference"].side_effect = update_reference
+
+        # endpointFunc under a strict budget of 2 commands
+        strict = queryBudget(limit=2, strict=True)(endpointFunc.__wrapped__)
+        for _ in range(2):
+            with self.assertRaises(QueryBudgetExceeded):
+                await strict("<Order/>", self.shipment, {}, {},
+                             idempotency_key="k-1")
+
+        # the retry ran again instead of replaying a stored response
+        self.assertEqual(self.mocks["create_order"].await_count, 2)
+        self.assertEqual(
+            await self.idempotencyDb.idempotency.count_documents({}), 0
+        )
+
+    async def testServerTimingAndTimings(self):
+        result = await endpointFunc(
+            "<Order/>", self.shipment, {}, {}, timings=True
+        )
+
+        header = result["headers"]["Server-Timing"]
+        for stage in ("validate_order", "create_order", "supplier",
+                      "create_despatch", "xml", "total"):
+            self.assertIn(f"{stage};dur=", header)
+        timings = json.loads(result["body"])["timings"]
+        self.assertIn("order_reference", timings)
+        self.assertGreaterEqual(timings["total"], timings["supplier"])
+
+    async def testReplayReportsItsOwnTimings(self):
+        first = await self.runEndpoint(idempotency_key="k-1", timings=True)
+        record = await self.idempotencyDb.idempotency.find_one(
+            {"_id": "key:k-1"}
+        )
+        self.assertNotIn("Server-Timing",
+                         record["Response"].get("headers") or {})
+        self.assertNotIn("timings", json.loads(record["Response"]["body"]))
+
+        retry = await self.runEndpoint(idempotency_key="k-1")
+
+        self.assertIn("supplier;dur=", first["headers"]["Server-Timing"])
+        # nothing ran but the replay itself
+        self.assertNotIn("supplier;dur=", retry["headers"]["Server-Timing"])
+        self.assertIn("total;dur=", retry["headers"]["Server-Timing"])
+        self.assertNotIn("timings", json.loads(retry["body"]))
+
+    async def testErrorResponsesAreTimedToo(self):
+        self.mocks["despatchSupplier"].side_effect = ValueError("no party")
+
+        result = await self.runEndpoint()
+
+        self.assertEqual(result["statusCode"], 400)
+        self.assertIn("total;dur=", result["headers"]["Server-Timing"])
+        self.assertNotIn("timings", json.loads(result["body"]))
+
+    async def testSupplierErrorCancelsOthers(self):
+        cancelled = asyncio.Event()
+
+        async def slow_customer(*args, **kwargs):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        self.mocks["deliveryCustomer"].side_effect = slow_customer
+        self.mocks["despatchSupplier"].side_effect = ValueError("no party")
+
+        result = await asyncio.wait_for(self.runEndpoint(), timeout=2)
+
+        self.assertEqual(result["statusCode"], 400)
+        self.assertEqual(
+            json.loads(result["body"])["error"], "Supplier error: no party"
+        )
+        self.assertTrue(cancelled.is_set())
+        self.mocks["create_despatch_advice"].assert_not_called()
+
+    async def testTurnedAwayRequestUndoesTheShipment(self):
+        inserted = asyncio.Event()
+
+        async def slow_insert(*args, **kwargs):
+            # still running when the supplier stage fails
+            await asyncio.sleep(0.05)
+            inserted.set()
+            return {"success": True, "document": {"ID": "SHIP-123456"}}
+
+        self.mocks["create_shipment"].side_effect = slow_insert
+        self.mocks["despatchSupplier"].side_effect = ValueError("no party")
+
+        result = await asyncio.wait_for(self.runEndpoint(), timeout=2)
+
+        self.assertEqual(result["statusCode"], 400)
+        # the cancelled insert finished and was deleted again
+        self.assertTrue(inserted.is_set())
+        self.db["shipments"].delete_one.assert_awaited_once_with(
+            {"ID": "SHIP-123456"}
+        )
+
+    async def testLineErrorUndoesTheShipment(self):
+        self.mocks["create_shipment"].return_value = {
+            "success": True, "document": {"ID": "SHIP-123456"}
+        }
+
+        result = await endpointFunc(
+            "<Order/>", self.shipment,
+            {"line_details": [{"ID": "L-1", "ExpiryDate": "soon"}]}, {}
+        )
+
+        self.assertEqual(result["statusCode"], 400)
+        self.assertIn("Despatch line error",
+                      json.loads(result["body"])["error"])
+        self.db["shipments"].delete_one.assert_awaited_once_with(
+            {"ID": "SHIP-123456"}
+        )
+
+    async def testShipmentFailureIs400(self):
+        self.mocks["create_shipment"].return_value = {
+            "success": False, "error": "Duplicate shipment ID"
+        }
+
+        result = await self.runEndpoint()
+
+        self.assertEqual(result["statusCode"], 400)
+        self.assertEqual(
+            json.loads(result["body"])["error"],
+            "Shipment error: Duplicate shipment ID"
+        )
+
+    async def testNonStringShipmentIdIs400(self):
+        self.shipment["ID"] = 123456
+
+        result = await self.runEndpoint()
+
+        self.assertEqual(result["statusCode"], 400)
+        self.assertIn("must be a string", json.loads(result["body"])["error"])
+        self.mocks["create_shipment"].assert_not_called()
+
+    async def testGeneratedShipmentIdIsRetried(self):
+        self.shipment["ID"] = "client-ref-1"
+        self.mocks["create_shipment"].side_effect = [
+            DuplicateKeyError("E11000 duplicate key", 11000,
+                              {"keyPattern": {"ID": 1}}),
+            {"success": True, "inserted_id": "x"},
+        ]
+
+        result = await self.runEndpoint()
+
+        self.assertEqual(result["statusCode"], 200)
+        calls = self.mocks["create_shipment"].await_args_list
+        self.assertEqual(len(calls), 2)
+        first, second = (call.args[0] for call in calls)
+        self.assertNotEqual(first, second)
+        self.assertTrue(second.startswith("SHIP-"))
+        self.assertEqual(calls[1].args[1]["ID"], second)
+        self.assertTrue(calls[1].kwargs["raise_duplicate"])
+
+    async def testFullXmlLimiterIs429(self):
+        limiter = AdmissionLimiter("xml", 1, queueSize=0, maxWait=1)
+        await limiter.acquire()
+
+        with patch("src.apiEndpoint.xmlLimiter", limiter):
+            result = await self.runEndpoint()
+
+        limiter.release()
+        self.assertEqual(result["statusCode"], 429)
+        self.assertEqual(json.loads(result["body"])["limiter"], "xml")
+
+    async def testUnexpectedErrorIs500(self):
+        self.mocks["create_order_reference"].side_effect = KeyError("ID")
+
+        result = await self.runEndpoint()
+
+        self.assertEqual(result["statusCode"], 500)
+        self.assertIn("'ID'", json.loads(result["body"])["error"])
+
+    def batchItem(self, xmlDoc="<Order/>"):
+        return {"xmlDoc": xmlDoc, "shipment": dict(self.shipment),
+                "despatch": {}, "supplier": {}}
+
+    def patchInsertOrders(self, outcomes):
+        async def insert_orders(bodies, db=None, chunk_size=None):
+            results, documents = [], []
+            for body, ok in zip(bodies, outcomes):
+                order_id = f"ORD-{len(results)}"
+                results.append({
+                    "order_id": order_id,
+                    "uuid": f"u-{len(results)}",
+                    "status": "Order Created" if ok else "Failed",
+                    "error": None if ok else "Duplicate order",
+                })
+                documents.append(dict(self.order, OrderID=order_id)
+                                 if ok else None)
+            return results, documents
+
+        mock = AsyncMock(side_effect=insert_orders)
+        patcher = patch("src.apiEndpoint.insert_orders", mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock
+
+    async def testBatchReportsEachItem(self):
+        insert_orders = self.patchInsertOrders([True, False])
+        self.mocks["validate_order_document"].side_effect = [
+            (True, [], {"CustomerID": "C-1", "Items": []}),
+            (False, ["bad"], None),
+            (True, [], {"CustomerID": "C-3", "Items": []}),
+        ]
+
+        with patch("src.despatch.orderContext.getOrderInfo",
+                   new_callable=AsyncMock) as get_order:
+            result = await batchEndpointFunc([
+                self.batchItem(), self.batchItem(), "not an item",
+                self.batchItem(),
+            ])
+
+        body = json.loads(result["body"])
+        self.assertEqual(result["statusCode"], 200)
+        self.assertEqual((body["succeeded"], body["failed"]), (1, 3))
+        self.assertEqual(
+            [item["statusCode"] for item in body["results"]],
+            [200, 400, 400, 500],
+        )
+        self.assertIn("Duplicate order", body["results"][3]["body"]["error"])
+        # one bulk insert for both valid documents, no order re-reads
+        insert_orders.assert_awaited_once()
+        self.assertEqual(len(insert_orders.await_args.args[0]), 2)
+        self.mocks["dbConnect"].assert_awaited_once()
+        get_order.assert_not_awaited()
+
+    async def testBatchConcurrencyIsBounded(self):
+        self.patchInsertOrders([True] * 6)
+        running = peak = 0
+
+        async def create_despatch(*args, **kwargs):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return {"statusCode": 200, "body": json.dumps({
+                "despatch_id": "D-1", "despatch_data": {"ID": "D-1"},
+            })}
+
+        self.mocks["create_despatch_advice"].side_effect = create_despatch
+
+        result = await batchEndpointFunc(
+            [self.batchItem() for _ in range(6)], concurrency=2
+        )
+
+        self.assertEqual(json.loads(result["body"])["succeeded"], 6)
+        self.assertEqual(peak, 2)
+
+    async def testBatchRejectsNonList(self):
+        result = await batchEndpointFunc({"xmlDoc": "<Order/>"})
+        self.assertEqual(result["statusCode"], 400)
+
+    async def testNdjsonStreamsInCompletionOrder(self):
+        self.patchInsertOrders([True, True])
+        release_first = asyncio.Event()
+
+        async def create_despatch(despatch_input, order=None):
+            if despatch_input["order_id"] == "ORD-0":
+                await release_first.wait()
+            return {"statusCode": 200, "body": json.dumps({
+                "despatch_id": "D-1", "despatch_data": {"ID": "D-1"},
+            })}
+
+        self.mocks["create_despatch_advice"].side_effect = create_despatch
+
+        stream = batch_ndjson([self.batchItem(), self.batchItem()])
+        first = json.loads(await anext(stream))
+        # item 1 arrives while item 0 is still in progress
+        self.assertEqual((first["index"], first["statusCode"]), (1, 200))
+        release_first.set()
+        rest = [json.loads(line) async for line in stream]
+        self.assertEqual([line["index"] for line in rest], [0])
+
+    async def testNdjsonClosingEarlyCancelsItems(self):
+        self.patchInsertOrders([True, True])
+        cancelled = asyncio.Event()
+
+        async def create_despatch(despatch_input, order=None):
+            if despatch_input["order_id"] == "ORD-0":
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+            return {"statusCode": 200, "body": "{}"}
+
+        self.mocks["create_despatch_advice"].side_effect = create_despatch
+
+        stream = batch_ndjson([self.batchItem(), self.batchItem()])
+        self.assertTrue((await anext(stream)).endswith("\n"))
+        await stream.aclose()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        self.mocks["dbConnect"].return_value[0].close.assert_called_once()
+
+    async def testNdjsonInvalidBatch(self):
+        lines = [line async for line in batch_ndjson("not a list")]
+        self.assertEqual(len(lines), 1)
+        self.assertIn("expected a list", json.loads(lines[0])["error"])
+
+    def despatchWithXml(self):
+        self.mocks["create_despatch_advice"].return_value = {
+            "statusCode": 200,
+            "body": json.dumps({
+                "despatch_id": "D-1",
+                "status": "Initiated",
+                "despatch_data": {"ID": "D-1", "XMLData": "<Stored/>"},
+                "xml_content": "<Stored/>",
+            }),
+        }
+
+    async def testMinimalProfileReturnsOneXmlCopy(self):
+        self.despatchWithXml()
+
+        result = await endpointFunc(
+            "<Order/>", self.shipment, {}, {}, profile="minimal"
+        )
+
+        body = json.loads(result["body"])
+        self.assertEqual(set(body),
+                         {"order", "despatch", "despatch_xml", "validation"})
+        self.assertEqual(body["order"]["order_id"], "ORD-12345")
+        self.assertEqual(body["despatch"], {
+            "despatch_id": "D-1", "status": "Initiated",
+        })
+        self.assertEqual(body["validation"]["validation_status"], "Valid")
+        self.assertEqual(body["despatch_xml"], "<Stored/>")
+        # the stored XML is reused instead of rendered again
+        self.mocks["json_to_xml"].assert_not_called()
+
+    async def testStandardProfileTrimsDocuments(self):
+        self.despatchWithXml()
+        self.mocks["create_shipment"].return_value = {
+            "success": True, "inserted_id": "1", "document": {"ID": "S"},
+        }
+
+        result = await endpointFunc(
+            "<Order/>", self.shipment, {}, {}, profile="standard"
+        )
+
+        body = json.loads(result["body"])
+        self.assertNotIn("despatch_data", body["despatch"])
+        self.assertNotIn("xml_content", body["despatch"])
+        self.assertEqual(body["shipment"],
+                         {"success": True, "inserted_id": "1"})
+        self.assertEqual(result["body"].count("<Stored/>"), 1)
+
+    async def testProfilesNest(self):
+        keys = {}
+        for profile in ("minimal", "standard", "full"):
+            result = await endpointFunc(
+                "<Order/>", self.shipment, {}, {}, profile=profile
+            )
+            keys[profile] = set(json.loads(result["body"]))
+
+        self.assertLessEqual(keys["minimal"], keys["standard"])
+        self.assertLessEqual(keys["standard"], keys["full"])
+        # the original response, nothing added
+        self.assertEqual(keys["full"], {
+            "order", "despatch", "despatch_xml", "validation",
+            "delivery_period", "backordering", "shipment", "despatch_line",
+        })
+
+    async def testFullProfileIsTheDefault(self):
+        self.despatchWithXml()
+
+        body = json.loads((await self.runEndpoint())["body"])
+
+        self.assertEqual(body["despatch"]["xml_content"], "<Stored/>")
+        self.assertEqual(body["despatch_xml"], "<DespatchAdvice/>")
+
+    async def testStoredDatesAreIsoFormatted(self):
+        requested = datetime.datetime(2025, 3, 16, 9, 30,
+                                      tzinfo=datetime.timezone.utc)
+        self.mocks["create_shipment"].return_value = {
+            "success": True, "inserted_id": "1",
+            "document": {"ID": "S", "RequestedDeliveryDate": requested},
+        }
+
+        body = json.loads((await self.runEndpoint())["body"])
+
+        self.assertEqual(
+            body["shipment"]["document"]["RequestedDeliveryDate"],
+            "2025-03-16T09:30:00+00:00",
+        )
+
+    async def testFieldSelection(self):
+        result = await endpointFunc(
+            "<Order/>", self.shipment, {}, {},
+            fields="despatch_id,db_queries",
+        )
+        self.assertEqual(set(json.loads(result["body"])),
+                         {"despatch_id", "db_queries"})
+
+        with self.assertRaises(ValueError):
+            await endpointFunc("<Order/>", self.shipment, {}, {},
+                               fields=["despatch_id", "nope"])
+        with self.assertRaises(ValueError):
+            await endpointFunc("<Order/>", self.shipment, {}, {},
+                               profile="tiny")
+        result = await batchEndpointFunc([], profile="tiny")
+        self.assertEqual(result["statusCode"], 400)
+
+    async def testRetryReplaysStoredResponse(self):
+        first = await self.runEndpoint(idempotency_key="k-1")
+        retry = await self.runEndpoint(idempotency_key="k-1")
+
+        self.assertEqual(retry["body"], first["body"])
+        self.assertEqual(retry["headers"]["Idempotent-Replayed"], "true")
+        self.mocks["create_order"].assert_awaited_once()
+        self.mocks["create_despatch_advice"].assert_awaited_once()
+
+    async def testNoKeyIsNotDeduplicated(self):
+        await self.runEndpoint()
+        again = await self.runEndpoint()
+
+        self.assertNotIn("Idempotent-Replayed", again["headers"])
+        self.assertEqual(self.mocks["create_order"].await_count, 2)
+        with patch("src.idempotency.IDEMPOTENCY_CONTENT_HASH", True):
+            await self.runEndpoint()
+            hashed = await self.runEndpoint()
+        self.assertEqual(hashed["headers"]["Idempotent-Replayed"], "true")
+
+    def storeXmlDespatch(self):
+        self.mocks["create_despatch_advice"].return_value = {
+            "statusCode": 200,
+            "body": json.dumps({
+                "despatch_id": "D-1",
+                "despatch_data": {"ID": "D-1", "XMLData": "<Stored/>"},
+                "xml_content": "<Stored/>",
+            }),
+        }
+        get_xml = AsyncMock(return_value={
+            "statusCode": 200, "body": "<Stored/>",
+        })
+        patcher = patch("src.apiEndpoint.get_despatch_xml", get_xml)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return get_xml
+
+    async def testStoredResponseReferencesTheDespatch(self):
+        get_xml = self.storeXmlDespatch()
+
+        for profile in ("full", "minimal"):
+            key = f"k-{profile}"
+            first = await self.runEndpoint(idempotency_key=key,
+                                           profile=profile)
+            record = await self.idempotencyDb.idempotency.find_one(
+                {"_id": f"key:{key}"}
+            )
+            self.assertNotIn("<Stored/>", record["Response"]["body"])
+            self.assertNotIn("<DespatchAdvice/>", record["Response"]["body"])
+            self.assertEqual(record["Response"]["replay"]["despatch_id"],
+                             "D-1")
+
+            retry = await self.runEndpoint(idempotency_key=key,
+                                           profile=profile)
+            self.assertEqual(retry["body"], first["body"])
+            self.assertNotIn("replay", retry)
+        self.assertEqual(get_xml.await_count, 2)
+
+    async def testReplayReadsTheCreatedDespatch(self):
+        client = MemoryClient()
+        patcher = patch("src.despatch.despatchCreate.dbConnect",
+                        AsyncMock(return_value=(client, client["ubl_docs"])))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mocks["create_despatch_advice"].side_effect = \
+            create_despatch_advice
+
+        for profile in ("full", "minimal"):
+            key = f"k-{profile}"
+            first = await self.runEndpoint(idempotency_key=key,
+                                           profile=profile)
+            retry = await self.runEndpoint(idempotency_key=key,
+                                           profile=profile)
+
+            self.assertEqual(retry["statusCode"], 200)
+            self.assertEqual(retry["headers"]["Idempotent-Replayed"], "true")
+            self.assertEqual(retry["body"], first["body"])
+        # the minimal profile returns the stored XML itself
+        self.assertIn("<DespatchAdvice",
+                      json.loads(retry["body"])["despatch_xml"])
+        self.assertEqual(
+            self.mocks["create_despatch_advice"].await_count, 2
+        )
+
+    async def testReplayOfDeletedDespatchIsGone(self):
+        get_xml = self.storeXmlDespatch()
+        await self.runEndpoint(idempotency_key="k-1")
+        get_xml.return_value = {"statusCode": 404, "body": "{}"}
+
+        retry = await self.runEndpoint(idempotency_key="k-1")
+
+        self.assertEqual(retry["statusCode"], 410)
+        self.mocks["create_order"].assert_awaited_once()
+
+    async def testIdempotencyKey(self):
+        await endpointFunc("<Order/>", self.shipment, {}, {},
+                           idempotency_key="k-1")
+        other = await endpointFunc("<Order/>", self.shipment, {}, {},
+                                   idempotency_key="k-2")
+        self.assertNotIn("Idempotent-Replayed", other["headers"])
+
+        reused = await endpointFunc("<Other/>", self.shipment, {}, {},
+                                    idempotency_key="k-1")
+        self.assertEqual(reused["statusCode"], 422)
+        self.assertEqual(self.mocks["create_order"].await_count, 2)
+
+    async def testConcurrentRepeatIsRejectedWhileRunning(self):
+        release = asyncio.Event()
+
+        async def slow_supplier(*args, **kwargs):
+            await release.wait()
+            return {"Party": {}}
+
+        self.mocks["despatchSupplier"].side_effect = slow_supplier
+        first = asyncio.create_task(self.runEndpoint(idempotency_key="k-1"))
+        await asyncio.sleep(0.01)
+
+        repeat = await self.runEndpoint(idempotency_key="k-1")
+        release.set()
+
+        self.assertEqual(repeat["statusCode"], 409)
+        self.assertIn("Retry-After", repeat["headers"])
+        self.assertEqual((await first)["statusCode"], 200)
+
+    async def testFailuresAreNotStored(self):
+        self.mocks["create_order_reference"].side_effect = [
+            KeyError("ID"), {"ID": "1"},
+        ]
+
+        failed = await self.runEndpoint()
+        retried = await self.runEndpoint()
+
+        self.assertEqual(failed["statusCode"], 500)
+        self.assertEqual(retried["statusCode"], 200)
+        self.assertNotIn("Idempotent-Replayed", retried["headers"])
+
+    async def testDespatchJob(self):
+        with patch("src.jobQueue.getDb",
+                   MagicMock(return_value=self.idempotencyDb)):
+            submitted = await submit_despatch_job(
+                "<Order/>", self.shipment, {}, {}, profile="minimal"
+            )
+            self.assertEqual(submitted["statusCode"], 202)
+            job_id = json.loads(submitted["body"])["job_id"]
+            self.mocks["create_order"].assert_not_awaited()
+
+            queued = await despatch_job_status(job_id)
+            self.assertEqual(json.loads(queued["body"])["status"], "queued")
+
+            self.assertTrue(await despatch_worker_pool().runOnce())
+
+            status = json.loads((await despatch_job_status(job_id))["body"])
+            self.assertEqual(status["status"], "succeeded")
+            self.assertIn("create_order", status["progress"])
+            self.assertEqual(
+                json.loads(status["result"]["body"])["despatch"]
+                ["despatch_id"], "D-1"
+            )
+            missing = await despatch_job_status("JOB-missing")
+            self.assertEqual(missing["statusCode"], 404)
+
+    async def testFailedJobAttemptIsUndoneBeforeRetry(self):
+        db = MagicMock()
+        db["shipments"].delete_one = AsyncMock()
+        self.mocks["dbConnect"].return_value = (MagicMock(), db)
+        self.mocks["create_shipment"].return_value = {
+            "success": True, "document": {"ID": "SHIP-123456"},
+        }
+        self.mocks["create_despatch_advice"].side_effect = [
+            {"statusCode": 500, "body": json.dumps({"error": "down"})},
+            self.mocks["create_despatch_advice"].return_value,
+        ]
+        delete_order = AsyncMock(return_value=True)
+        with patch("src.jobQueue.getDb",
+                   MagicMock(return_value=self.idempotencyDb)), \
+                patch("src.apiEndpoint.deleteOrder", delete_order):
+            submitted = await submit_despatch_job(
+                "<Order/>", self.shipment, {}, {}
+            )
+            job_id = json.loads(submitted["body"])["job_id"]
+            pool = despatch_worker_pool()
+
+            # the order and shipment were created, then the despatch
+            # failed: both are removed and the job is queued again
+            self.assertTrue(await pool.runOnce())
+            delete_order.assert_awaited_once_with(self.order["UUID"], db)
+            db["shipments"].delete_one.assert_awaited_once_with(
+                {"ID": "SHIP-123456"}
+            )
+            status = json.loads((await despatch_job_status(job_id))["body"])
+            self.assertEqual(status["status"], "queued")
+
+            self.assertTrue(await pool.runOnce())
+            status = json.loads((await despatch_job_status(job_id))["body"])
+            self.assertEqual(status["status"], "succeeded")
+            self.assertEqual(status["attempts"], 2)
+            delete_order.assert_awaited_once()
+
+        record = await self.idempotencyDb.idempotency.find_one(
+            {"_id": f"key:job:{job_id}"}
+        )
+        self.assertEqual(record["Status"], "completed")
+
+    async def testRetriedJobReplaysFinishedAttempt(self):
+        with patch("src.jobQueue.getDb",
+                   MagicMock(return_value=self.idempotencyDb)):
+            submitted = await submit_despatch_job(
+                "<Order/>", self.shipment, {}, {}
+            )
+            job_id = json.loads(submitted["body"])["job_id"]
+            pool = despatch_worker_pool()
+
+            # the attempt finished but its outcome was not recorded;
+            # the lease expires and the job is claimed again
+            with patch("src.jobQueue.finishJob",
+                       AsyncMock(side_effect=RuntimeError("down"))):
+                self.assertTrue(await pool.runOnce())
+            await self.idempotencyDb.jobs.update_one(
+                {"_id": job_id}, {"$set": {"LeaseExpiresAt": None,
+                                           "Status": "queued"}}
+            )
+            self.assertTrue(await pool.runOnce())
+
+            status = json.loads((await despatch_job_status(job_id))["body"])
+        self.assertEqual(status["status"], "succeeded")
+        self.assertEqual(
+            status["result"]["headers"]["Idempotent-Replayed"], "true"
+        )
+        self.mocks["create_order"].assert_awaited_once()
+
+    async def testDespatchJobRejectsBadInput(self):
+        result = await submit_despatch_job(None, self.shipment, {}, {})
+        self.assertEqual(result["statusCode"], 400)
+        result = await submit_despatch_job("<Order/>", self.shipment, {}, {},
+                                           profile="tiny")
+        self.assertEqual(result["statusCode"], 400)
+
+    async def testOverloadedIsRejectedAndNotStored(self):
+        busy = AsyncMock(side_effect=[
+            Overloaded("db", 429, 3, "queue is full"), None,
+        ])
+        with patch("src.apiEndpoint.dbLimiter.acquire", busy):
+            rejected = await self.runEndpoint()
+            retried = await self.runEndpoint()
+
+        self.assertEqual(rejected["statusCode"], 429)
+        self.assertEqual(rejected["headers"]["Retry-After"], "3")
+        self.assertEqual(retried["statusCode"], 200)
+        self.assertNotIn("Idempotent-Replayed", retried["headers"])
+
+    async def testDeadlineStopsSlowRequest(self):
+        async def stuck_supplier(*args, **kwargs):
+            await asyncio.sleep(5)
+
+        self.mocks["despatchSupplier"].side_effect = stuck_supplier
+        result = await asyncio.wait_for(
+            endpointFunc("<Order/>", self.shipment, {}, {}, deadline=0.05),
+            timeout=2,
+        )
+
+        self.assertEqual(result["statusCode"], 504)
+        self.mocks["create_despatch_advice"].assert_not_awaited()
+
+    async def testMultipleDespatchLines(self):
+        line = dict(
+            EXAMPLE_LINE, LineItem=dict(EXAMPLE_LINE["LineItem"], ID="1")
+        )
+        self.order["OrderLine"] = [line, line]
+        # the order reference update hands back the refreshed order
+        self.mocks["create_order_reference"].return_value = self.order
+        despatch = {"line_details": [{"LotNumber": "7"}, {"ID": "L-2"}]}
+
+        result = await endpointFunc("<Order/>", self.shipment, despatch, {})
+
+        lines = json.loads(result["body"])["despatch_line"]["DespatchLine"]
+        self.assertEqual([entry["ID"] for entry in lines], ["1", "L-2"])
+        self.assertEqual(lines[0]["DeliveredQuantity unitCode"], 5)
+        sent = self.mocks["create_despatch_advice"].await_args.args[0]
+        self.assertEqual(len(sent["despatch_line"]["DespatchLine"]), 2)
+
+    async def testLinesForCreatedOrderWithoutOrderLine(self):
+        # create_order stores Items only
+        self.order["Items"] = [
+            {"item_id": "ITEM-001", "quantity": 5, "price": 1},
+        ]
+        self.mocks["create_order_reference"].return_value = self.order
+        despatch = {"line_details": {"ID": "L-1"}}
+
+        result = await endpointFunc("<Order/>", self.shipment, despatch, {})
+
+        self.assertEqual(result["statusCode"], 200)
+        line = json.loads(result["body"])["despatch_line"]["DespatchLine"]
+        self.assertEqual(line["DeliveredQuantity unitCode"], 5)
+        self.assertEqual(
+            line["Item"]["SellersItemIdentification"]["ID"], "ITEM-001"
+        )
+
+    async def testInvalidDespatchLinesAreListed(self):
+        self.order["OrderLine"] = EXAMPLE_LINE
+        self.mocks["create_order_reference"].return_value = self.order
+        despatch = {"line_details": [{"ExpiryDate": "soon"}, {}]}
+
+        result = await endpointFunc("<Order/>", self.shipment, despatch, {})
+
+        self.assertEqual(result["statusCode"], 400)
+        self.assertEqual(len(json.loads(result["body"])["issues"]), 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,121 @@
+import re
+import time
+import unittest
+from unittest.mock import AsyncMock
+
+import pymongo.errors
+
+from src.idGenerator import (
+    DESPATCH_PREFIX,
+    ORDER_PREFIX,
+    SHIPMENT_PREFIX,
+    ULID_PATTERN,
+    idTimestamp,
+    isGeneratedId,
+    isIdConflict,
+    newId,
+    newUlid,
+    withFreshId,
+)
+from src.memoryStore import MemoryClient
+
+
+def duplicate(field):
+    message = f"E11000 duplicate key error index: {field}_1 dup key"
+    return pymongo.errors.DuplicateKeyError(
+        message, 11000, {"keyPattern": {field: 1}}
+    )
+
+
+class TestIdGenerator(unittest.TestCase):
+    def testFormat(self):
+        for prefix in (ORDER_PREFIX, DESPATCH_PREFIX, SHIPMENT_PREFIX):
+            value = newId(prefix)
+            self.assertTrue(value.startswith(prefix))
+            self.assertEqual(len(value), len(prefix) + 26)
+            self.assertTrue(isGeneratedId(value, prefix))
+        self.assertFalse(isGeneratedId("ORD-1A2B3C4D", ORDER_PREFIX))
+        self.assertTrue(re.fullmatch(ULID_PATTERN, newUlid()))
+
+    def testMonotonicWithinOneMillisecond(self):
+        ids = [newUlid(nowMs=1_700_000_000_000) for _ in range(1000)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 1000)
+
+    def testClockGoingBackwardsStaysMonotonic(self):
+        nowMs = time.time_ns() // 1_000_000
+        later = newUlid(nowMs=nowMs + 20)
+        earlier = newUlid(nowMs=nowMs)
+        self.assertGreater(earlier, later)
+
+    def testSortsByCreationTime(self):
+        first = newId(ORDER_PREFIX)
+        time.sleep(0.002)
+        second = newId(ORDER_PREFIX)
+        self.assertLess(first, second)
+        self.assertAlmostEqual(idTimestamp(second), time.time(), delta=5)
+
+
+class TestWithFreshId(unittest.IsolatedAsyncioTestCase):
+    async def testRetriesOnIdConflict(self):
+        insert = AsyncMock(side_effect=[duplicate("OrderID"), "inserted"])
+
+        result = await withFreshId(ORDER_PREFIX, insert, "OrderID")
+
+        self.assertEqual(result, "inserted")
+        first, second = [call.args[0] for call in insert.await_args_list]
+        self.assertNotEqual(first, second)
+
+    async def testOtherDuplicatesAreRaised(self):
+        insert = AsyncMock(side_effect=duplicate("UUID"))
+
+        with self.assertRaises(pymongo.errors.DuplicateKeyError):
+            await withFreshId(ORDER_PREFIX, insert, "OrderID")
+        insert.assert_awaited_once()
+
+    async def testSimilarIndexNamesAreNotIdConflicts(self):
+        # OrderID_1 contains "ID_1" but is another index
+        for error in (
+            duplicate("OrderID"),
+            pymongo.errors.DuplicateKeyError(
+                "E11000 duplicate key error collection: ubl_docs.orders "
+                "index: OrderID_1 dup key: { OrderID: \"x\" }", 11000
+            ),
+        ):
+            insert = AsyncMock(side_effect=error)
+            with self.assertRaises(pymongo.errors.DuplicateKeyError):
+                await withFreshId(DESPATCH_PREFIX, insert, "ID")
+            insert.assert_awaited_once()
+
+        self.assertTrue(isIdConflict(pymongo.errors.DuplicateKeyError(
+            "E11000 duplicate key error collection: ubl_docs.despatches "
+            "index: ID_1 dup key: { ID: \"x\" }", 11000
+        ), "ID"))
+
+    async def testGivesUpAfterAttempts(self):
+        insert = AsyncMock(side_effect=duplicate("ID"))
+
+        with self.assertRaises(pymongo.errors.DuplicateKeyError):
+            await withFreshId(DESPATCH_PREFIX, insert, "ID", attempts=3)
+        self.assertEqual(insert.await_count, 3)
+
+    async def testUniqueIndexConflictInMemoryBackend(self):
+        orders = MemoryClient()["ubl_docs"].orders
+        await orders.create_index("OrderID", unique=True, sparse=True)
+        taken = newId(ORDER_PREFIX)
+        await orders.insert_one({"OrderID": taken})
+        attempts = iter([taken])
+
+        async def insert(order_id):
+            order_id = next(attempts, order_id)
+            await orders.insert_one({"OrderID": order_id})
+            return order_id
+
+        stored = await withFreshId(ORDER_PREFIX, insert, "OrderID")
+
+        self.assertNotEqual(stored, taken)
+        self.assertEqual(await orders.count_documents({}), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+import asyncio
+import datetime
+import json
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pymongo.errors
+
+from src.dbIndexes import IDEMPOTENCY_TTL_SECONDS, INDEXES
+from src.idempotency import (
+    IDEMPOTENCY_COLLECTION,
+    asUtc,
+    contentHash,
+    requestKey,
+    runOnce,
+)
+from src.memoryStore import MemoryClient
+from src.requestDeadline import RequestDeadline
+
+
+def ok(body):
+    return {"statusCode": 200, "body": json.dumps(body)}
+
+
+class TestRequestKey(unittest.TestCase):
+    def testCanonicalHash(self):
+        self.assertEqual(
+            contentHash("<Order/>", {"a": 1, "b": [1, 2]}),
+            contentHash("<Order/>", {"b": [1, 2], "a": 1}),
+        )
+        self.assertNotEqual(contentHash({"a": 1}), contentHash({"a": 2}))
+
+    def testClientKeyKeepsContentFingerprint(self):
+        key, fingerprint = requestKey("abc", "<Order/>")
+        self.assertEqual(key, "key:abc")
+        self.assertEqual(fingerprint, contentHash("<Order/>"))
+        self.assertEqual(requestKey(None, "<Order/>"), (None, None))
+        with patch("src.idempotency.IDEMPOTENCY_CONTENT_HASH", True):
+            self.assertEqual(requestKey(None, "<Order/>")[0],
+                             f"content:{fingerprint}")
+
+    def testTtlIndexIsDeclared(self):
+        spec = next(spec for spec in INDEXES
+                    if spec["collection"] == IDEMPOTENCY_COLLECTION)
+        self.assertEqual(spec["options"],
+                         {"expireAfterSeconds": IDEMPOTENCY_TTL_SECONDS})
+
+
+class TestRunOnce(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = MemoryClient()["ubl_docs"]
+
+    async def testRunsOnceAndReplays(self):
+        run = AsyncMock(return_value=ok({"id": 1}))
+
+        first = await runOnce("k", "f", run, db=self.db)
+        second = await runOnce("k", "f", run, db=self.db)
+
+        run.assert_awaited_once()
+        self.assertEqual(second["body"], first["body"])
+        self.assertEqual(second["headers"], {"Idempotent-Replayed": "true"})
+
+    async def testCompactedResponseIsExpandedOnReplay(self):
+        run = AsyncMock(return_value=ok({"id": 1, "xml": "<Big/>"}))
+
+        def compact(response):
+            return dict(response, body=json.dumps({"id": 1}), ref="D-1")
+
+        async def expand(stored):
+            if stored["ref"] != "D-1":
+                raise LookupError(stored["ref"])
+            return ok({"id": 1, "xml": "<Big/>"})
+
+        first = await runOnce("k", "f", run, db=self.db,
+                              compact=compact, expand=expand)
+        record = await self.db[IDEMPOTENCY_COLLECTION].find_one({"_id": "k"})
+        self.assertNotIn("<Big/>", record["Response"]["body"])
+
+        second = await runOnce("k", "f", run, db=self.db,
+                               compact=compact, expand=expand)
+        self.assertEqual(second["body"], first["body"])
+
+        await self.db[IDEMPOTENCY_COLLECTION].update_one(
+            {"_id": "k"}, {"$set": {"Response.ref": "D-2"}}
+        )
+        gone = await runOnce("k", "f", run, db=self.db,
+                             compact=compact, expand=expand)
+        self.assertEqual(gone["statusCode"], 410)
+        run.assert_awaited_once()
+
+    async def testNoKeyAlwaysRuns(self):
+        run = AsyncMock(return_value=ok({}))
+        await runOnce(None, None, run, db=self.db)
+        await runOnce(None, None, run, db=self.db)
+        self.assertEqual(run.await_count, 2)
+
+    async def testExceptionReleasesKey(self):
+        run = AsyncMock(side_effect=[RuntimeError("boom"), ok({})])
+
+        with self.assertRaises(RuntimeError):
+            await runOnce("k", "f", run, db=self.db)
+        response = await runOnce("k", "f", run, db=self.db)
+
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(run.await_count, 2)
+
+    async def testClientErrorsAreReplayed(self):
+        run = AsyncMock(return_value={"statusCode": 400, "body": "{}"})
+        await runOnce("k", "f", run, db=self.db)
+        replay = await runOnce("k", "f", run, db=self.db)
+        self.assertEqual(replay["statusCode"], 400)
+        run.assert_awaited_once()
+
+    async def testOverloadedIsNotStored(self):
+        run = AsyncMock(side_effect=[
+            {"statusCode": 429, "body": "{}"}, ok({}),
+        ])
+        await runOnce("k", "f", run, db=self.db)
+        response = await runOnce("k", "f", run, db=self.db)
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(run.await_count, 2)
+
+    async def testExpiredRecordIsTakenOver(self):
+        expired = datetime.datetime.now(datetime.timezone.utc) - \
+            datetime.timedelta(seconds=IDEMPOTENCY_TTL_SECONDS + 5)
+        await self.db[IDEMPOTENCY_COLLECTION].insert_one({
+            "_id": "k", "Fingerprint": "f", "Status": "completed",
+            "CreatedAt": expired.replace(tzinfo=None),
+            "Response": ok({"old": True}),
+        })
+        run = AsyncMock(return_value=ok({"new": True}))
+
+        response = await runOnce("k", "f", run, db=self.db)
+
+        self.assertEqual(json.loads(response["body"]), {"new": True})
+        run.assert_awaited_once()
+
+    async def testCrashedClaimIsTakenOverAfterLease(self):
+        # the claimant died between insert_one and release()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        await self.db[IDEMPOTENCY_COLLECTION].insert_one({
+            "_id": "k", "Fingerprint": "f", "Status": "pending",
+            "CreatedAt": (now - datetime.timedelta(minutes=5))
+            .replace(tzinfo=None),
+            "LeaseUntil": (now - datetime.timedelta(seconds=1))
+            .replace(tzinfo=None),
+        })
+        run = AsyncMock(return_value=ok({"id": 1}))
+
+        response = await runOnce("k", "f", run, db=self.db)
+
+        self.assertEqual(response["statusCode"], 200)
+        run.assert_awaited_once()
+        record = await self.db[IDEMPOTENCY_COLLECTION].find_one({"_id": "k"})
+        self.assertEqual(record["Status"], "completed")
+
+    async def testLiveClaimIsInProgress(self):
+        run = AsyncMock(return_value=ok({}))
+        started = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await finish.wait()
+            return ok({})
+
+        first = asyncio.create_task(runOnce("k", "f", slow, db=self.db))
+        await started.wait()
+        response = await runOnce("k", "f", run, db=self.db)
+        finish.set()
+        await first
+
+        self.assertEqual(response["statusCode"], 409)
+        run.assert_not_awaited()
+
+    async def testLeaseFollowsRequestDeadline(self):
+        records = self.db[IDEMPOTENCY_COLLECTION]
+        seen = {}
+
+        async def run():
+            record = await records.find_one({"_id": "k"})
+            seen["lease"] = asUtc(record["LeaseUntil"]) - \
+                asUtc(record["CreatedAt"])
+            return ok({})
+
+        with RequestDeadline(300):
+            await runOnce("k", "f", run, db=self.db)
+
+        self.assertGreater(seen["lease"].total_seconds(), 300)
+
+    async def testStoreDownRunsAnyway(self):
+        records = MagicMock()
+        records.insert_one = AsyncMock(
+            side_effect=pymongo.errors.ServerSelectionTimeoutError("down")
+        )
+        db = MagicMock()
+        db.__getitem__.return_value = records
+        run = AsyncMock(return_value=ok({}))
+
+        response = await runOnce("k", "f", run, db=db)
+
+        self.assertEqual(response["statusCode"], 200)
+        run.assert_awaited_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+import asyncio
+import datetime
+import json
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from src import jobQueue
+from src.jobQueue import (
+    FAILED,
+    QUEUED,
+    RUNNING,
+    SUCCEEDED,
+    JobWorkerPool,
+    claimJob,
+    finishJob,
+    jobStatus,
+    renewLease,
+    submitJob,
+)
+from src.memoryStore import MemoryClient
+from src.stageTiming import StageTimer, stage
+
+
+def ok(body):
+    return {"statusCode": 200, "body": json.dumps(body)}
+
+
+class TestJobQueue(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = MemoryClient()["ubl_docs"]
+        self.jobs = self.db[jobQueue.JOB_COLLECTION]
+
+    async def expireLease(self, jobId):
+        past = datetime.datetime.now(datetime.timezone.utc) - \
+            datetime.timedelta(seconds=1)
+        await self.jobs.update_one(
+            {"_id": jobId}, {"$set": {"LeaseExpiresAt": past}}
+        )
+
+    async def testSubmitClaimFinish(self):
+        jobId = await submitJob("despatch", {"n": 1}, db=self.db)
+        self.assertTrue(jobId.startswith("JOB-"))
+        self.assertEqual((await jobStatus(jobId, db=self.db))["status"], QUEUED)
+
+        job = await claimJob("w1", db=self.db)
+        self.assertEqual(job["_id"], jobId)
+        self.assertEqual(job["Status"], RUNNING)
+        self.assertEqual(job["Attempts"], 1)
+        self.assertIsNone(await claimJob("w2", db=self.db))
+
+        status = await finishJob(job, "w1", ok({"id": 1}), db=self.db)
+
+        self.assertEqual(status, SUCCEEDED)
+        report = await jobStatus(jobId, db=self.db)
+        self.assertEqual(report["status"], SUCCEEDED)
+        self.assertEqual(json.loads(report["result"]["body"]), {"id": 1})
+        self.assertIsNotNone(report["finished_at"])
+
+    async def testConcurrentClaimsGetDistinctJobs(self):
+        for n in range(3):
+            await submitJob("despatch", {"n": n}, db=self.db)
+
+        jobs = await asyncio.gather(
+            *(claimJob(f"w{n}", db=self.db) for n in range(4))
+        )
+
+        claimed = [job["_id"] for job in jobs if job is not None]
+        self.assertEqual(len(claimed), 3)
+        self.assertEqual(len(set(claimed)), 3)
+
+    async def testOnlyHandledKindsAreClaimed(self):
+        await submitJob("report", {}, db=self.db)
+        self.assertIsNone(await claimJob("w1", db=self.db, kinds=["despatch"]))
+
+    async def testExpiredLeaseIsReclaimed(self):
+        jobId = await submitJob("despatch", {}, db=self.db)
+        job = await claimJob("w1", db=self.db)
+        await self.expireLease(jobId)
+
+        again = await claimJob("w2", db=self.db)
+
+        self.assertEqual(again["_id"], jobId)
+        self.assertEqual(again["Attempts"], 2)
+        # the first worker can no longer write its result
+        self.assertIsNone(await finishJob(job, "w1", ok({}), db=self.db))
+        self.assertFalse(await renewLease(jobId, "w1", [], db=self.db))
+
+    async def testServerErrorsRetryUpToMaxAttempts(self):
+        jobId = await submitJob("despatch", {}, db=self.db, maxAttempts=2)
+        failure = {"statusCode": 500, "body": "{}"}
+
+        job = await claimJob("w1", db=self.db)
+        self.assertEqual(await finishJob(job, "w1", failure, db=self.db), QUEUED)
+        job = await claimJob("w1", db=self.db)
+        self.assertEqual(await finishJob(job, "w1", failure, db=self.db), FAILED)
+
+        self.assertIsNone(await claimJob("w1", db=self.db))
+        report = await jobStatus(jobId, db=self.db)
+        self.assertEqual(report["attempts"], 2)
+        self.assertEqual(report["result"]["statusCode"], 500)
+
+    async def testClientErrorsAreFinal(self):
+        await submitJob("despatch", {}, db=self.db)
+        job = await claimJob("w1", db=self.db)
+        response = {"statusCode": 400, "body": "{}"}
+        self.assertEqual(await finishJob(job, "w1", response, db=self.db), FAILED)
+
+    async def testLastAttemptLeaseExpiredReportsFailed(self):
+        jobId = await submitJob("despatch", {}, db=self.db, maxAttempts=1)
+        await claimJob("w1", db=self.db)
+        await self.expireLease(jobId)
+        self.assertEqual((await jobStatus(jobId, db=self.db))["status"], FAILED)
+
+    async def testUnknownJob(self):
+        self.assertIsNone(await jobStatus("JOB-missing", db=self.db))
+
+    async def testPoolRunsJobWithProgress(self):
+        async def handler(payload):
+            with stage("work"):
+                await asyncio.sleep(0)
+            return ok(payload)
+
+        pool = JobWorkerPool({"despatch": handler}, db=self.db)
+        jobId = await submitJob("despatch", {"n": 7}, db=self.db)
+
+        self.assertTrue(await pool.runOnce())
+        self.assertFalse(await pool.runOnce())
+
+        report = await jobStatus(jobId, db=self.db)
+        self.assertEqual(report["status"], SUCCEEDED)
+        self.assertEqual(json.loads(report["result"]["body"]), {"n": 7})
+
+    async def testPoolHeartbeatWritesProgress(self):
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def handler(payload):
+            with stage("first"):
+                pass
+            started.set()
+            await release.wait()
+            return ok({})
+
+        pool = JobWorkerPool({"despatch": handler}, db=self.db)
+        jobId = await submitJob("despatch", {}, db=self.db)
+        with patch.object(jobQueue, "JOB_LEASE_SECONDS", 0.03):
+            run = asyncio.create_task(pool.runOnce())
+            await started.wait()
+            await asyncio.sleep(0.05)
+            report = await jobStatus(jobId, db=self.db)
+            release.set()
+            await run
+
+        self.assertEqual(report["status"], RUNNING)
+        self.assertEqual(report["progress"], ["first"])
+
+    async def testPoolRetriesHandlerExceptions(self):
+        handler = AsyncMock(side_effect=[RuntimeError("boom"), ok({})])
+        pool = JobWorkerPool({"despatch": handler}, db=self.db)
+        jobId = await submitJob("despatch", {}, db=self.db)
+
+        await pool.runOnce()
+        self.assertEqual((await jobStatus(jobId, db=self.db))["status"], QUEUED)
+        await pool.runOnce()
+
+        report = await jobStatus(jobId, db=self.db)
+        self.assertEqual(report["status"], SUCCEEDED)
+        self.assertEqual(report["attempts"], 2)
+
+    async def testStartedPoolPicksUpJobs(self):
+        done = asyncio.Event()
+
+        async def handler(payload):
+            done.set()
+            return ok({})
+
+        pool = JobWorkerPool({"despatch": handler}, size=2, db=self.db,
+                             pollInterval=0.01).start()
+        try:
+            await submitJob("despatch", {}, db=self.db)
+            pool.notify()
+            await asyncio.wait_for(done.wait(), 1)
+        finally:
+            await pool.stop()
+
+    async def testWorkerSurvivesFailedFinish(self):
+        handler = AsyncMock(return_value=ok({}))
+        finish = AsyncMock(side_effect=[RuntimeError("store down"), SUCCEEDED])
+        pool = JobWorkerPool({"despatch": handler}, size=1, db=self.db,
+                             pollInterval=0.01)
+        first = await submitJob("despatch", {}, db=self.db)
+
+        with patch("src.jobQueue.finishJob", finish):
+            pool.start()
+            try:
+                for _ in range(100):
+                    if handler.await_count:
+                        break
+                    await asyncio.sleep(0.01)
+                # the failed job keeps its lease until it expires
+                report = await jobStatus(first, db=self.db)
+                self.assertEqual(report["status"], RUNNING)
+
+                await submitJob("despatch", {}, db=self.db)
+                pool.notify()
+                for _ in range(100):
+                    if finish.await_count == 2:
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(finish.await_count, 2)
+            finally:
+                await pool.stop()
+
+        await self.expireLease(first)
+        self.assertEqual((await claimJob("w2", db=self.db))["_id"], first)
+
+    async def testDrainRunsUntilQueueIsEmpty(self):
+        handler = AsyncMock(return_value=ok({}))
+        pool = JobWorkerPool({"despatch": handler}, size=2, db=self.db)
+        for _ in range(5):
+            await submitJob("despatch", {}, db=self.db)
+
+        self.assertEqual(await pool.drain(5), 5)
+        self.assertEqual(handler.await_count, 5)
+        self.assertEqual(await pool.drain(5), 0)
+
+        await submitJob("despatch", {}, db=self.db)
+        self.assertEqual(await pool.drain(0), 0)
+
+
+class TestNestedStageTimer(unittest.TestCase):
+    def testInnerStagesReachOuterTimer(self):
+        outer = StageTimer("outer")
+        with outer:
+            with StageTimer("inner"):
+                with stage("load"):
+                    pass
+        self.assertIn("load", outer.timings)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import importlib
+import json
+import subprocess
+import sys
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+# "lambda" is a keyword, the package cannot be named in an import statement
+lambda_handler = importlib.import_module("src.lambda.lambda_handler")
+job_worker_handler = importlib.import_module("src.lambda.job_worker_handler")
+
+ORDER_XML = """<Order xmlns="urn:oasis:names:specification:ubl:schema:xsd:Order-2"
+    xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+    xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2">
+  <cbc:ID>{order_id}</cbc:ID>
+  <cbc:IssueDate>2025-03-15</cbc:IssueDate>
+</Order>"""
+
+
+def event(xml_docs):
+    return {"body": json.dumps({"xmlDocs": xml_docs})}
+
+
+class TestBatchStream(unittest.IsolatedAsyncioTestCase):
+    async def collect(self, order_xmls):
+        return [
+            json.loads(line)
+            async for line in lambda_handler.convert_orders_to_despatch_stream(
+                order_xmls
+            )
+        ]
+
+    async def testEachLineIsYieldedBeforeTheNextConversion(self):
+        converted = []
+
+        def convert(order_xml):
+            converted.append(order_xml)
+            return {"statusCode": 200, "body": json.dumps({"xml": order_xml})}
+
+        with patch.object(lambda_handler, "convert_order_to_despatch",
+                          convert):
+            stream = lambda_handler.convert_orders_to_despatch_stream(
+                ["first", "second"]
+            )
+            first = json.loads(await anext(stream))
+            self.assertEqual(converted, ["first"])
+            lines = [first] + [json.loads(line) async for line in stream]
+
+        self.assertEqual([line["index"] for line in lines], [0, 1])
+        self.assertEqual(lines[1]["body"], {"xml": "second"})
+
+    async def testPerItemErrors(self):
+        lines = await self.collect([
+            ORDER_XML.format(order_id="ORD-1"), "<not xml", None, "",
+        ])
+
+        by_index = {line["index"]: line for line in lines}
+        self.assertEqual(sorted(by_index), [0, 1, 2, 3])
+        self.assertEqual(by_index[0]["statusCode"], 200)
+        self.assertEqual(by_index[0]["body"]["summary"]["ID"], "ORD-1")
+        self.assertEqual(by_index[1]["statusCode"], 400)
+        self.assertIn("conversion failed", by_index[1]["body"]["error"])
+        self.assertEqual(by_index[2]["body"]["error"], "Missing order XML")
+        self.assertEqual(by_index[3]["statusCode"], 400)
+
+    def testHandlerDoesNotLoadTheApiModules(self):
+        # the conversion Lambda ships without Motor, lxml or dotenv
+        loaded = subprocess.run(
+            [sys.executable, "-c",
+             "import importlib, sys\n"
+             "importlib.import_module('src.lambda.lambda_handler')\n"
+             "print('src.apiEndpoint' in sys.modules)"],
+            capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(loaded.stdout.strip(), "False")
+
+
+class TestBatchHandler(unittest.TestCase):
+    def testBufferedHandler(self):
+        response = lambda_handler.batch_lambda_handler(event([
+            ORDER_XML.format(order_id="ORD-1"),
+            ORDER_XML.format(order_id="ORD-2"),
+        ]), None)
+
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(response["headers"]["Content-Type"],
+                         "application/x-ndjson")
+        lines = response["body"].splitlines()
+        self.assertEqual(
+            sorted(json.loads(line)["body"]["summary"]["ID"] for line in lines),
+            ["ORD-1", "ORD-2"],
+        )
+
+    def testMissingList(self):
+        response = lambda_handler.batch_lambda_handler(
+            {"body": json.dumps({"xmlDoc": "<Order/>"})}, None
+        )
+        self.assertEqual(response["statusCode"], 400)
+
+    def testStreamingHandlerWritesEachLineWhenReady(self):
+        events = []
+
+        class Out:
+            def write(self, line):
+                events.append(("write", json.loads(line)["index"]))
+
+            def flush(self):
+                events.append(("flush", None))
+
+        def convert(order_xml):
+            events.append(("convert", order_xml))
+            return {"statusCode": 200, "body": "{}"}
+
+        with patch.object(lambda_handler, "convert_order_to_despatch",
+                          convert):
+            result = lambda_handler.stream_batch_lambda_handler(
+                event(["first", "second"]), Out()
+            )
+
+        self.assertIsNone(result)
+        # the first line went out before the second document converted
+        self.assertEqual(events, [
+            ("convert", "first"), ("write", 0), ("flush", None),
+            ("convert", "second"), ("write", 1), ("flush", None),
+        ])
+
+
+class TestJobWorkerHandler(unittest.TestCase):
+    def context(self, remaining_seconds):
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = \
+            remaining_seconds * 1000
+        return context
+
+    def testDrainsWithinTheFunctionTimeout(self):
+        pool = MagicMock()
+        pool.drain = AsyncMock(return_value=3)
+        with patch.object(job_worker_handler, "despatch_worker_pool",
+                          MagicMock(return_value=pool)), \
+                patch.object(job_worker_handler, "DESPATCH_JOB_DEADLINE", 300):
+            result = job_worker_handler.lambda_handler(
+                {}, self.context(900)
+            )
+
+        self.assertEqual(result, {"jobs_run": 3})
+        window = pool.drain.await_args.args[0]
+        self.assertEqual(
+            window, 900 - 300 - job_worker_handler.WORKER_MARGIN_SECONDS
+        )
+
+    def testTimeoutTooShortClaimsNothing(self):
+        with patch.object(job_worker_handler, "despatch_worker_pool") as pool:
+            result = job_worker_handler.lambda_handler({}, self.context(60))
+
+        self.assertEqual(result, {"jobs_run": 0})
+        pool.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
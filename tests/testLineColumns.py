@@ -0,0 +1,159 @@
+import datetime
+import unittest
+from unittest.mock import patch
+
+import src.despatch.lineColumns as lineColumns
+from src.despatch.despatchLine import (
+    DespatchLineError,
+    despatchLines,
+    parseLineSpec,
+)
+from src.despatch.lineColumns import validateLineColumns
+
+
+def lineSpec(**overrides):
+    spec = {
+        "DeliveredQuantity": 10,
+        "BackOrderQuantity": 2,
+        "ID": "DL-001",
+        "Note": "Test Note",
+        "BackOrderReason": "Stock shortage",
+        "LotNumber": "LOT-123",
+        "ExpiryDate": "2024-12-31",
+    }
+    spec.update(overrides)
+    return spec
+
+
+MIXED_SPECS = [
+    lineSpec(),
+    lineSpec(DeliveredQuantity="7.9", BackOrderQuantity=1.5),
+    lineSpec(DeliveredQuantity=True, LotNumber=42, LineID="2"),
+    lineSpec(DeliveredQuantity="ten"),
+    lineSpec(BackOrderQuantity=None),
+    lineSpec(LotNumber="LOT"),
+    lineSpec(LotNumber=[1]),
+    lineSpec(ExpiryDate="31/12/2024"),
+    lineSpec(DeliveredQuantity=float("nan")),
+    lineSpec(DeliveredQuantity="inf"),
+    {"ID": "DL-3"},
+    None,
+    lineSpec(ID=7, ExpiryDate="2025-1-5"),
+]
+
+
+class TestLineColumns(unittest.TestCase):
+    def perLine(self, specs):
+        rows, bad = {}, set()
+        for row, spec in enumerate(specs):
+            try:
+                rows[row] = parseLineSpec(spec)
+            except ValueError:
+                bad.add(row)
+        return rows, bad
+
+    def assertMatchesPerLine(self, specs):
+        rows, bad = self.perLine(specs)
+        columns = validateLineColumns(specs)
+
+        self.assertEqual(set(columns.errors), bad)
+        converted = columns.rows()
+        for row, expected in rows.items():
+            self.assertEqual(converted[row], expected)
+
+    def testMatchesPerLineRules(self):
+        self.assertMatchesPerLine(MIXED_SPECS)
+
+    def testMatchesPerLineRulesWithoutNumpy(self):
+        with patch.object(lineColumns, "numpy", None):
+            self.assertMatchesPerLine(MIXED_SPECS)
+
+    def testNumpyIsOptIn(self):
+        self.assertFalse(lineColumns.LINE_COLUMNS_NUMPY)
+
+    @unittest.skipIf(lineColumns.numpy is None, "NumPy is not installed")
+    def testMatchesPerLineRulesWithNumpy(self):
+        specs = MIXED_SPECS + [
+            lineSpec(DeliveredQuantity=n + 0.5, BackOrderQuantity=n)
+            for n in range(20)
+        ]
+        with patch.object(lineColumns, "LINE_COLUMNS_NUMPY", True):
+            self.assertTrue(lineColumns.useNumpy())
+            self.assertMatchesPerLine(specs)
+            self.assertMatchesPerLine([
+                lineSpec(DeliveredQuantity=1e20),
+                lineSpec(DeliveredQuantity=2.0 ** 63),
+                lineSpec(BackOrderQuantity=-2.0 ** 63),
+            ])
+
+    def testAllValid(self):
+        specs = [lineSpec(ID=n, ExpiryDate="2025-06-30") for n in range(50)]
+        columns = validateLineColumns(specs)
+
+        self.assertTrue(columns.valid)
+        self.assertEqual(list(columns.delivered), [10] * 50)
+        self.assertEqual(columns.lotNumber, [123] * 50)
+        self.assertEqual(columns.expiry[0], datetime.datetime(2025, 6, 30))
+        self.assertEqual(columns.ids[49], "49")
+
+    def testCompactReport(self):
+        columns = validateLineColumns([
+            lineSpec(),
+            lineSpec(DeliveredQuantity="x", ExpiryDate="soon"),
+            {"ID": "1", "Note": ""},
+        ])
+
+        report = columns.report()
+        self.assertEqual(
+            (report["lines"], report["valid"], report["invalid"]), (3, 1, 2)
+        )
+        self.assertEqual(report["errors"][0], {
+            "line": 2, "invalid": ["DeliveredQuantity", "ExpiryDate"],
+        })
+        self.assertEqual(report["errors"][1]["line"], 3)
+        self.assertIn("LotNumber", report["errors"][1]["missing"])
+        self.assertEqual(columns.messages(), [
+            "Line 2: Please re-enter an amount for quantity.",
+            "Line 3: Error: insufficient information entered.",
+        ])
+
+    def testQuantitiesOutsideInt64(self):
+        columns = validateLineColumns([lineSpec(DeliveredQuantity=1e20)])
+        self.assertEqual(columns.report()["errors"][0]["invalid"],
+                         ["DeliveredQuantity"])
+        for quantity in (1e20, 2 ** 63, "-1e19"):
+            with self.assertRaises(ValueError):
+                parseLineSpec(lineSpec(BackOrderQuantity=quantity))
+        self.assertMatchesPerLine([
+            lineSpec(DeliveredQuantity=2 ** 63 - 1),
+            lineSpec(DeliveredQuantity=2 ** 63),
+            lineSpec(BackOrderQuantity=-2 ** 63),
+        ])
+
+    def testTenThousandLines(self):
+        specs = [
+            lineSpec(ID=n, DeliveredQuantity=n % 7 or "3",
+                     LotNumber=f"LOT-{n % 20}")
+            for n in range(10000)
+        ]
+        specs[5000]["ExpiryDate"] = "never"
+
+        columns = validateLineColumns(specs)
+
+        self.assertEqual(columns.report()["errors"],
+                         [{"line": 5001, "invalid": ["ExpiryDate"]}])
+        self.assertEqual(columns.delivered[7], 3)
+
+
+class TestDespatchLinesReport(unittest.IsolatedAsyncioTestCase):
+    async def testErrorCarriesReport(self):
+        with self.assertRaises(DespatchLineError) as raised:
+            await despatchLines(
+                [lineSpec(), lineSpec(LotNumber="none")], "UUID", order={}
+            )
+        self.assertEqual(raised.exception.report["errors"],
+                         [{"line": 2, "invalid": ["LotNumber"]}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+import unittest
+from unittest.mock import patch
+
+import pymongo
+import pymongo.errors
+
+import src.mongodb as mongodb
+from src.cache import orderCache
+from src.dbIndexes import applyIndexes
+from src.memoryStore import MemoryClient, matches
+
+
+class TestMatches(unittest.TestCase):
+    def testQuerySubset(self):
+        document = {
+            "UUID": "u-1",
+            "Total": 5,
+            "Lines": ["a", "b"],
+            "Party": {"Name": "Supplier"},
+        }
+        self.assertTrue(matches(document, {"UUID": "u-1"}))
+        self.assertTrue(matches(document, {"Party.Name": "Supplier"}))
+        self.assertTrue(matches(document, {"Lines": "b"}))
+        self.assertTrue(matches(document, {"Total": {"$gte": 5, "$lt": 6}}))
+        self.assertTrue(matches(document, {"UUID": {"$in": ["x", "u-1"]}}))
+        self.assertTrue(matches(document, {"Missing": {"$exists": False}}))
+        self.assertTrue(matches(document, {"Missing": None}))
+        self.assertTrue(matches(
+            document, {"$or": [{"UUID": "x"}, {"Total": 5}]}
+        ))
+        self.assertFalse(matches(document, {"UUID": {"$ne": "u-1"}}))
+        self.assertFalse(matches(document, {"Total": {"$gt": "a"}}))
+
+
+class TestMemoryCollection(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = MemoryClient()
+        self.db = self.client["testdb"]
+
+    async def testInsertFindUpdateDelete(self):
+        order = {"UUID": "u-1", "Status": "new"}
+        result = await self.db.orders.insert_one(order)
+        self.assertEqual(order["_id"], result.inserted_id)
+
+        found = await self.db.orders.find_one({"UUID": "u-1"}, {"Status": 1})
+        self.assertEqual(found, {"_id": result.inserted_id, "Status": "new"})
+
+        found["Status"] = "changed"
+        update = await self.db.orders.update_one(
+            {"UUID": "u-1"}, {"$set": {"Status": "sent"}}
+        )
+        self.assertEqual((update.matched_count, update.modified_count), (1, 1))
+        stored = await self.db.orders.find_one({"UUID": "u-1"})
+        self.assertEqual(stored["Status"], "sent")
+
+        deleted = await self.db.orders.delete_many({"UUID": "u-1"})
+        self.assertEqual(deleted.deleted_count, 1)
+        self.assertIsNone(await self.db.orders.find_one({"UUID": "u-1"}))
+
+    async def testUniqueIndex(self):
+        await self.db.orders.create_index("UUID", unique=True)
+        await self.db.orders.insert_one({"UUID": "u-1"})
+
+        with self.assertRaises(pymongo.errors.DuplicateKeyError):
+            await self.db.orders.insert_one({"UUID": "u-1"})
+
+        with self.assertRaises(pymongo.errors.BulkWriteError) as context:
+            await self.db.orders.insert_many(
+                [{"UUID": "u-2"}, {"UUID": "u-1"}, {"UUID": "u-3"}],
+                ordered=False,
+            )
+        errors = context.exception.details["writeErrors"]
+        self.assertEqual([error["index"] for error in errors], [1])
+        self.assertEqual(errors[0]["code"], 11000)
+        self.assertEqual(await self.db.orders.count_documents({}), 3)
+
+    async def testSparseIndexAllowsMissingField(self):
+        await self.db.orders.create_index(
+            [("OrderID", pymongo.ASCENDING)], unique=True, sparse=True
+        )
+        await self.db.orders.insert_one({"UUID": "u-1"})
+        await self.db.orders.insert_one({"UUID": "u-2"})
+        self.assertEqual(await self.db.orders.count_documents({}), 2)
+
+    async def testIndexedLookups(self):
+        await self.db.orders.create_index("UUID", unique=True)
+        await self.db.orders.create_index("OrderID", unique=True, sparse=True)
+        for number in range(50):
+            await self.db.orders.insert_one(
+                {"UUID": f"u-{number}", "OrderID": f"ORD-{number}"}
+            )
+
+        found = await self.db.orders.find_one(
+            {"$or": [{"UUID": "ORD-7"}, {"OrderID": "ORD-7"}]}
+        )
+        self.assertEqual(found["UUID"], "u-7")
+        found = await self.db.orders.find(
+            {"UUID": {"$in": ["u-3", "u-1"]}}
+        ).to_list(length=None)
+        self.assertEqual([doc["UUID"] for doc in found], ["u-1", "u-3"])
+        self.assertEqual(self.client.stats()["scans"], 0)
+
+    async def testFindSortSkipLimit(self):
+        for number in [3, 1, 2]:
+            await self.db.orders.insert_one({"n": number})
+
+        cursor = self.db.orders.find({}, {"_id": 0}).sort("n", -1).limit(2)
+        self.assertEqual(await cursor.to_list(length=None),
+                         [{"n": 3}, {"n": 2}])
+
+        seen = [doc["n"] async for doc in self.db.orders.find().skip(1)]
+        self.assertEqual(seen, [1, 2])
+
+    async def testFindOneAndUpdateUpsert(self):
+        result = await self.db.orders.find_one_and_update(
+            {"ID": "ORD-1"},
+            {"$set": {"SalesOrderID": "SO-1"}},
+            upsert=True,
+            return_document=True,
+        )
+        self.assertEqual(result["ID"], "ORD-1")
+        self.assertEqual(result["SalesOrderID"], "SO-1")
+
+        before = await self.db.orders.find_one_and_update(
+            {"ID": "ORD-1"}, {"$set": {"SalesOrderID": "SO-2"}}
+        )
+        self.assertEqual(before["SalesOrderID"], "SO-1")
+
+    async def testBulkWrite(self):
+        await self.db.orders.insert_many([{"ID": 1}, {"ID": 2}])
+        result = await self.db.orders.bulk_write([
+            pymongo.UpdateOne({"ID": 1}, {"$set": {"x": 1}}),
+            pymongo.DeleteOne({"ID": 2}),
+            pymongo.InsertOne({"ID": 3}),
+        ], ordered=False)
+        self.assertEqual(
+            (result.modified_count, result.deleted_count,
+             result.inserted_count),
+            (1, 1, 1),
+        )
+
+    async def testCloseKeepsData(self):
+        await self.db.orders.insert_one({"UUID": "u-1"})
+        self.client.close()
+        self.assertEqual(await self.db.orders.count_documents({}), 1)
+        self.client.shutdown()
+        self.assertEqual(
+            await self.client["testdb"].orders.count_documents({}), 0
+        )
+
+    async def testNotIterable(self):
+        for value in (self.client, self.db, self.db.orders):
+            with self.assertRaises(TypeError):
+                iter(value)
+            with self.assertRaises(TypeError):
+                "orders" in value
+
+
+class TestMemoryBackend(unittest.IsolatedAsyncioTestCase):
+    """The mongodb.py data-access functions against the memory backend"""
+
+    async def asyncSetUp(self):
+        orderCache.clear()
+        self.client = MemoryClient()
+        self.db = self.client["ubl_docs"]
+        await applyIndexes(self.db)
+
+    async def asyncTearDown(self):
+        orderCache.clear()
+
+    @patch.object(mongodb, "DB_BACKEND", "memory")
+    async def testGetClientUsesMemoryBackend(self):
+        with patch.dict(mongodb._clients, clear=True):
+            client = mongodb.getClient("memory://test")
+            self.assertIsInstance(client, MemoryClient)
+            self.assertIs(mongodb.getClient("memory://test"), client)
+
+    async def testOrderRoundTrip(self):
+        order = {"UUID": "u-1", "OrderID": "ORD-1", "Total": 10}
+        await mongodb.addOrder(order, self.db)
+
+        found = await mongodb.getOrderInfo("ORD-1", self.db)
+        self.assertEqual(found["UUID"], "u-1")
+
+        self.assertTrue(
+            await mongodb.updateDocument("ORD-1", {"Total": 12}, self.db)
+        )
+        found = await mongodb.getOrderInfo("u-1", self.db)
+        self.assertEqual(found["Total"], 12)
+
+        self.assertTrue(await mongodb.deleteOrder("u-1", self.db))
+        self.assertIsNone(await mongodb.getOrderInfo("u-1", self.db))
+
+    async def testAddOrdersReportsDuplicates(self):
+        results = await mongodb.addOrders(
+            [{"UUID": "u-1", "OrderID": "ORD-1"},
+             {"UUID": "u-2", "OrderID": "ORD-1"},
+             {"UUID": "u-3", "OrderID": "ORD-3"}], self.db
+        )
+        self.assertEqual(
+            [result["duplicate"] for result in results],
+            [False, True, False],
+        )
+
+    async def testBulkWriteDocuments(self):
+        await self.db.orders.insert_one({"UUID": "u-1", "OrderID": "ORD-1"})
+        results = await mongodb.updateDocuments(
+            [("ORD-1", {"Status": "sent"}), ("ORD-404", {"Status": "x"})],
+            self.db,
+        )
+        self.assertEqual(
+            [result["success"] for result in results], [True, False]
+        )
+        stored = await self.db.orders.find_one({"OrderID": "ORD-1"})
+        self.assertEqual(stored["Status"], "sent")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,22 @@
-from src.mongodb import addOrder, getOrderInfo, deleteOrder, dbConnect, clearDb
+from src.mongodb import (
+    addOrder, getOrderInfo, deleteOrder, dbConnect, clearDb, getDb,
+    closeDbClients, orderQuery, addOrders, updateDocuments, deleteDocuments,
+    listOrders, listDespatches, releaseClient, updateDocument, deleteDocument
+)
+from src.despatch.despatchCreate import (
+    build_despatch_document,
+    delete_despatch_advice,
+    getDespatchAdvice,
+)
+from src.memoryStore import MemoryClient
+from src.dbIndexes import applyIndexes
+import src.mongodb as mongodb
+import asyncio
+import datetime
+import pymongo
 import pymongo.errors
 import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
 import motor.motor_asyncio
 
 
@@ -12,6 +28,9 @@ class TestOrder(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
         # isolated connection to db for every test
         self.client, self.db = await dbConnect()
+        # dbConnect builds the indexes in the background, the duplicate
+        # UUID check needs them in place
+        await applyIndexes(self.db)
         self.orders = self.db["orders"]
 
         self.testUUID = "RANDOM-123F-321F-8888-RANDOM1234"
@@ -27,7 +46,7 @@ class TestOrder(unittest.IsolatedAsyncioTestCase):
 
     async def asyncTearDown(self):
         await clearDb(self.db)
-        self.client.close()
+        releaseClient(self.client)
 
     # ============================================
     # ============================================
@@ -60,13 +79,390 @@ class TestOrder(unittest.IsolatedAsyncioTestCase):
 
         self.assertTrue(await deleteOrder(self.testUUID, self.orders))
 
+    @unittest.skipIf(mongodb.DB_BACKEND == "memory",
+                     "needs a Motor client")
     async def testDbConnect(self):
         client, db = await dbConnect()
 
         self.assertIsInstance(client, motor.motor_asyncio.AsyncIOMotorClient)
 
         self.assertIsInstance(db, motor.motor_asyncio.AsyncIOMotorDatabase)
-        client.close()
+        releaseClient(client)
+
+    async def testSharedClient(self):
+        client, db = await dbConnect()
+        again, _ = await dbConnect()
+        self.assertIs(client, again)
+        self.assertIs(getDb().client, client)
+
+        # releasing the client must not tear down the shared pool
+        releaseClient(client)
+        await addOrder(self.fakeOrder, self.orders)
+        fetched = await getOrderInfo(self.testUUID, self.orders)
+        self.assertEqual(fetched["ID"], self.fakeOrder["ID"])
+
+        closeDbClients()
+        fresh, _ = await dbConnect()
+        self.assertIsNot(fresh, client)
+        self.client, self.db = fresh, fresh["ubl_docs"]
+        self.orders = self.db["orders"]
+
+
+class TestClientRegistry(unittest.TestCase):
+    """One shared client per event loop, no database needed"""
+
+    URI = "mongodb://localhost:27017/testdb?serverSelectionTimeoutMS=200"
+
+    def setUp(self):
+        patcher = patch.dict(mongodb._clients, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(mongodb.closeDbClients)
+
+    @unittest.skipIf(mongodb.DB_BACKEND == "memory",
+                     "needs a Motor client")
+    def testClientPerEventLoop(self):
+        async def fetch():
+            client = mongodb.getClient(self.URI)
+            self.assertIs(mongodb.getClient(self.URI), client)
+            return client
+
+        first = asyncio.run(fetch())
+        second = asyncio.run(fetch())
+
+        self.assertIsNot(first, second)
+        # the client of the finished loop was closed and dropped
+        self.assertEqual(list(mongodb._clients.values()), [second])
+
+    def testReleaseKeepsSharedClient(self):
+        async def release():
+            client = mongodb.getClient(self.URI)
+            mongodb.releaseClient(client)
+            self.assertIs(mongodb.getClient(self.URI), client)
+
+        asyncio.run(release())
+
+    def testReleaseClosesOtherClients(self):
+        client = MagicMock()
+        mongodb.releaseClient(client)
+        client.close.assert_called_once()
+
+
+class TestOrderLookup(unittest.IsolatedAsyncioTestCase):
+    """getOrderInfo query shape, no database needed"""
+
+    async def asyncSetUp(self):
+        self.db = MagicMock()
+        self.db.orders.find_one = AsyncMock(return_value={"UUID": "1"})
+
+    async def testSingleQuery(self):
+        await getOrderInfo("1234", self.db)
+
+        self.db.orders.find_one.assert_called_once_with(
+            {"$or": [{"UUID": "1234"}, {"OrderID": "1234"}]}, None
+        )
+
+    async def testTypedLookupWithProjection(self):
+        projection = {"SellerSupplierParty": 1}
+        await getOrderInfo("ORD-1", self.db, projection=projection,
+                           key="OrderID")
+
+        self.db.orders.find_one.assert_called_once_with(
+            {"OrderID": "ORD-1"}, projection
+        )
+
+    async def testMissReturnsNone(self):
+        self.db.orders.find_one.return_value = None
+
+        self.assertIsNone(await getOrderInfo("1234", self.db))
+        self.db.orders.find_one.assert_called_once()
+
+    def testUnknownKey(self):
+        with self.assertRaises(ValueError):
+            orderQuery("1234", key="CustomerID")
+
+
+class TestBulkInsert(unittest.IsolatedAsyncioTestCase):
+    """addOrders batching and per-document results, no database needed"""
+
+    async def asyncSetUp(self):
+        self.calls = []
+
+        async def insert_many(documents, ordered=True):
+            self.calls.append((len(documents), ordered))
+            for i, document in enumerate(documents):
+                document["_id"] = f"id-{document['UUID']}"
+            duplicates = [
+                {"index": i, "code": 11000, "errmsg": "E11000 duplicate key"}
+                for i, document in enumerate(documents)
+                if document["UUID"] == "dup"
+            ]
+            if duplicates:
+                raise pymongo.errors.BulkWriteError(
+                    {"writeErrors": duplicates}
+                )
+
+        self.db = MagicMock()
+        self.db.orders.insert_many = insert_many
+
+    async def testChunksAndReportsDuplicates(self):
+        documents = [{"UUID": str(i)} for i in range(5)]
+        documents[3]["UUID"] = "dup"
+
+        results = await addOrders(documents, self.db, chunkSize=2)
+
+        self.assertEqual(self.calls, [(2, False), (2, False), (1, False)])
+        self.assertEqual([r["index"] for r in results], [0, 1, 2, 3, 4])
+        self.assertEqual(results[0]["inserted_id"], "id-0")
+        self.assertTrue(results[3]["duplicate"])
+        self.assertIsNone(results[3]["inserted_id"])
+        self.assertEqual(results[4]["inserted_id"], "id-4")
+
+    async def testEmptyAndInvalidChunk(self):
+        self.assertEqual(await addOrders([], self.db), [])
+        with self.assertRaises(ValueError):
+            await addOrders([{"UUID": "1"}], self.db, chunkSize=0)
+
+
+class TestBulkWrite(unittest.IsolatedAsyncioTestCase):
+    """updateDocuments / deleteDocuments, no database needed"""
+
+    async def asyncSetUp(self):
+        existing = {
+            "orders": ["ORD-1", "ORD-2"],
+            "despatches": ["D-1", "D-2"],
+        }
+        self.collections = {}
+        for name, ids in existing.items():
+            field = "OrderID" if name == "orders" else "ID"
+            collection = MagicMock()
+            cursor = MagicMock()
+            cursor.to_list = AsyncMock(
+                return_value=[{field: i} for i in ids]
+            )
+            collection.find = MagicMock(return_value=cursor)
+            collection.bulk_write = AsyncMock()
+            self.collections[name] = collection
+
+        self.db = MagicMock()
+        self.db.__getitem__.side_effect = self.collections.__getitem__
+
+    async def testUpdateGroupsByCollection(self):
+        updates = [
+            ("ORD-1", {"Status": "Shipped"}),
+            ("D-1", {"Status": "Shipped"}),
+            ("ORD-9", {"Status": "Shipped"}),
+            ("D-2", {"Status": "Shipped"}),
+        ]
+
+        outcomes = await updateDocuments(updates, self.db)
+
+        self.assertEqual([o["id"] for o in outcomes],
+                         ["ORD-1", "D-1", "ORD-9", "D-2"])
+        self.assertEqual([o["success"] for o in outcomes],
+                         [True, True, False, True])
+        self.assertEqual(outcomes[2]["error"], "Document not found")
+
+        # one round trip per collection for the writes
+        orders_ops = self.collections["orders"].bulk_write.call_args[0][0]
+        despatch_ops = (
+            self.collections["despatches"].bulk_write.call_args[0][0]
+        )
+        self.assertEqual(len(orders_ops), 1)
+        self.assertEqual(len(despatch_ops), 2)
+        self.assertEqual(
+            orders_ops[0],
+            pymongo.UpdateOne({"OrderID": "ORD-1"},
+                              {"$set": {"Status": "Shipped"}})
+        )
+
+    async def testDeleteReportsWriteErrors(self):
+        self.collections["despatches"].bulk_write.side_effect = (
+            pymongo.errors.BulkWriteError({"writeErrors": [
+                {"index": 1, "code": 2, "errmsg": "boom"}
+            ]})
+        )
+
+        outcomes = await deleteDocuments(["D-1", "D-2", "ORD-2"], self.db)
+
+        self.assertEqual([o["success"] for o in outcomes],
+                         [True, False, True])
+        self.assertEqual(outcomes[1]["error"], "boom")
+        self.assertEqual(
+            self.collections["orders"].bulk_write.call_args[0][0],
+            [pymongo.DeleteOne({"OrderID": "ORD-2"})]
+        )
+
+    async def testCollectionFailure(self):
+        self.collections["orders"].bulk_write.side_effect = (
+            Exception("network down")
+        )
+
+        outcomes = await deleteDocuments(["ORD-1", "D-1"], self.db)
+
+        self.assertFalse(outcomes[0]["success"])
+        self.assertEqual(outcomes[0]["error"], "network down")
+        self.assertTrue(outcomes[1]["success"])
+
+
+class TestWriteCreatedDespatches(unittest.IsolatedAsyncioTestCase):
+    """Update / delete despatches as create_despatch_advice stores them"""
+
+    async def asyncSetUp(self):
+        self.db = MemoryClient()["ubl_docs"]
+        self.ids = []
+        for number in range(2):
+            despatch, _ = await build_despatch_document(
+                f"DES-{number}", "ORD-1", {"CustomerID": "CUST-1"}, {}
+            )
+            await self.db.despatches.insert_one(despatch)
+            self.ids.append(despatch["ID"])
+
+    async def testBatchedWritesFindThem(self):
+        updated = await updateDocuments(
+            [(self.ids[0], {"Status": "Shipped"})], self.db
+        )
+        deleted = await deleteDocuments([self.ids[1]], self.db)
+
+        self.assertEqual(updated[0], {"id": "DES-0", "success": True,
+                                      "error": None})
+        self.assertTrue(deleted[0]["success"])
+        remaining = await self.db.despatches.find({}).to_list(length=None)
+        self.assertEqual([(d["ID"], d["Status"]) for d in remaining],
+                         [("DES-0", "Shipped")])
+
+    async def testSingleWritesFindThem(self):
+        self.assertTrue(await updateDocument(
+            self.ids[0], {"Status": "Shipped"}, self.db
+        ))
+        self.assertTrue(await deleteDocument(self.ids[0], self.db))
+
+    async def testLegacyDespatchIdIsWritable(self):
+        await self.db.despatches.insert_one(
+            {"DespatchID": "D-LEGACY", "Status": "Initiated"}
+        )
+        client = MagicMock()
+        with patch("src.despatch.despatchCreate.dbConnect",
+                   AsyncMock(return_value=(client, self.db))):
+            fetched = await getDespatchAdvice("D-LEGACY")
+            self.assertTrue(await updateDocument(
+                "D-LEGACY", {"Status": "Shipped"}, self.db
+            ))
+            updated = await updateDocuments(
+                [("D-LEGACY", {"Status": "Delivered"})], self.db
+            )
+            deleted = await delete_despatch_advice("D-LEGACY")
+
+        self.assertEqual(fetched["DespatchID"], "D-LEGACY")
+        self.assertTrue(updated[0]["success"])
+        self.assertEqual(deleted["statusCode"], 200)
+        self.assertIsNone(
+            await self.db.despatches.find_one({"DespatchID": "D-LEGACY"})
+        )
+
+
+class TestListing(unittest.IsolatedAsyncioTestCase):
+    """Keyset pagination, run against the in-memory backend"""
+
+    async def asyncSetUp(self):
+        self.db = MemoryClient()["ubl_docs"]
+        # two orders share every CreationDate so _id has to break ties
+        for number in range(25):
+            await self.db.orders.insert_one({
+                "OrderID": f"ORD-{number:02d}",
+                "CustomerID": "CUST-1" if number % 2 else "CUST-2",
+                "Status": "Created",
+                "CreationDate": datetime.datetime(
+                    2025, 3, number // 2 + 1, tzinfo=datetime.timezone.utc
+                ),
+                "Items": [{"item_id": "ITEM-1"}],
+            })
+
+    async def collect(self, limit, **filters):
+        seen, cursor, pages = [], None, 0
+        while True:
+            page = await listOrders(
+                self.db, limit=limit, cursor=cursor, **filters
+            )
+            pages += 1
+            seen += [order["OrderID"] for order in page["items"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return seen, pages
+
+    async def testPagesCoverEveryOrderOnce(self):
+        seen, pages = await self.collect(limit=4)
+
+        self.assertEqual(pages, 7)
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+        self.assertEqual(seen[0], "ORD-24")
+
+    async def testFiltersAndProjection(self):
+        page = await listOrders(
+            self.db, limit=50, customerId="CUST-1",
+            createdFrom="2025-03-02", createdTo="2025-03-05",
+        )
+
+        self.assertEqual(
+            [order["OrderID"] for order in page["items"]],
+            ["ORD-07", "ORD-05", "ORD-03"],
+        )
+        self.assertIsNone(page["next_cursor"])
+        self.assertNotIn("Items", page["items"][0])
+
+        seen, _ = await self.collect(limit=3, customerId="CUST-2")
+        self.assertEqual(len(seen), 13)
+
+    async def testUndatedAndLegacyDocumentsArePaged(self):
+        await self.db.orders.insert_many([
+            {"OrderID": "ORD-NONE-1", "Status": "Created"},
+            {"OrderID": "ORD-NONE-2", "Status": "Created",
+             "CreationDate": None},
+            # stored before CreationDate became a datetime
+            {"OrderID": "ORD-STR", "Status": "Created",
+             "CreationDate": "2025-03-20T10:00:00"},
+        ])
+
+        seen, _ = await self.collect(limit=2)
+
+        self.assertEqual(len(seen), 28)
+        self.assertEqual(len(set(seen)), 28)
+        self.assertEqual(seen[25], "ORD-STR")
+        self.assertEqual(set(seen[26:]), {"ORD-NONE-1", "ORD-NONE-2"})
+
+    async def testDateFilters(self):
+        page = await listOrders(
+            self.db, limit=50,
+            createdFrom=datetime.datetime(2025, 3, 12),
+            createdTo="2025-03-13T00:00:00+00:00",
+        )
+        self.assertEqual(
+            [order["OrderID"] for order in page["items"]],
+            ["ORD-23", "ORD-22"],
+        )
+        with self.assertRaises(ValueError):
+            await listOrders(self.db, createdFrom="last tuesday")
+
+    async def testBadCursorAndLimit(self):
+        with self.assertRaises(ValueError):
+            await listOrders(self.db, cursor="not-a-cursor")
+        with self.assertRaises(ValueError):
+            await listOrders(self.db, limit=0)
+
+    async def testDespatchesExcludeXml(self):
+        await self.db.despatches.insert_one({
+            "ID": "D-1", "CustomerID": "CUST-1", "Status": "Initiated",
+            "CreationDate": datetime.datetime(
+                2025, 3, 16, tzinfo=datetime.timezone.utc
+            ),
+            "XMLData": "<DespatchAdvice/>",
+        })
+
+        page = await listDespatches(self.db, status="Initiated")
+
+        self.assertEqual(len(page["items"]), 1)
+        self.assertNotIn("XMLData", page["items"][0])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+import unittest
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from src.despatch.orderContext import OrderContext
+from src.despatch.despatchSupplier import despatchSupplier
+from src.despatch.deliveryCustomer import deliveryCustomer
+from src.despatch.OrderReference import create_order_reference
+
+
+class TestOrderContext(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.order = {
+            "_id": "object-id",
+            "OrderID": "ORD-12345",
+            "UUID": "550e8400-e29b-41d4-a716-446655440000",
+            "IssueDate": "2025-03-15",
+            "SellerSupplierParty": {
+                "CustomerAssignedAccountID": "SUPP-1",
+                "Party": {"PartyName": "Supplier Co."},
+            },
+            "DeliveryCustomerParty": {
+                "CustomerAssignedAccountID": "CUST-1",
+                "Party": {"PartyName": "Customer Ltd."},
+            },
+        }
+        self.db = MagicMock()
+
+    @patch("src.despatch.orderContext.getOrderInfo", new_callable=AsyncMock)
+    async def test_load_fetches_once(self, mock_get_order):
+        mock_get_order.return_value = self.order
+
+        context = await OrderContext.load("ORD-12345", self.db)
+
+        self.assertIs(context.order, self.order)
+        self.assertEqual(context.get("UUID"), self.order["UUID"])
+        mock_get_order.assert_called_once_with("ORD-12345", self.db)
+
+    @patch("src.despatch.orderContext.getOrderInfo", new_callable=AsyncMock)
+    async def test_missing_order(self, mock_get_order):
+        mock_get_order.return_value = None
+
+        context = await OrderContext.load("ORD-MISSING", self.db)
+
+        self.assertIsNone(context.order)
+        self.assertEqual(context.get("UUID", "default"), "default")
+
+    async def test_update_keeps_newer_copy(self):
+        context = OrderContext("ORD-12345", self.order)
+        updated = dict(self.order, SalesOrderID="SO-1")
+
+        context.update(updated)
+        self.assertEqual(context.get("SalesOrderID"), "SO-1")
+
+        # a failed write returns None, keep what we had
+        context.update(None)
+        self.assertIs(context.order, updated)
+
+    @patch("src.despatch.despatchSupplier.dbConnect", new_callable=AsyncMock)
+    async def test_supplier_reads_from_order(self, mock_db_connect):
+        res = await despatchSupplier(self.order["UUID"], order=self.order)
+
+        self.assertEqual(res["CustomerAssignedAccountID"], "SUPP-1")
+        self.assertIsNot(res, self.order["SellerSupplierParty"])
+        mock_db_connect.assert_not_called()
+
+    @patch("src.despatch.deliveryCustomer.dbConnect", new_callable=AsyncMock)
+    async def test_customer_reads_from_order(self, mock_db_connect):
+        res = await deliveryCustomer(self.order["UUID"], order=self.order)
+
+        self.assertEqual(res["CustomerAssignedAccountID"], "CUST-1")
+        self.assertEqual(res["Party"]["PartyName"], "Customer Ltd.")
+        mock_db_connect.assert_not_called()
+
+    async def test_order_reference_skips_lookup(self):
+        collection = MagicMock()
+        collection.find_one = AsyncMock()
+        collection.find_one_and_update = AsyncMock(return_value=self.order)
+
+        result = await create_order_reference(
+            "ORD-12345", "SO-1", collection, order=self.order
+        )
+
+        self.assertIs(result, self.order)
+        collection.find_one.assert_not_called()
+        query = collection.find_one_and_update.call_args[0][0]
+        self.assertEqual(query, {"_id": "object-id"})
+
+
+if __name__ == "__main__":
+    unittest.main()
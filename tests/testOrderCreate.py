@@ -1,3 +1,4 @@
+import datetime
 import unittest
 import os
 import sys
@@ -7,9 +8,12 @@ from unittest.mock import patch, MagicMock, AsyncMock
 from src.despatch.orderCreate import (
     validate_order_document,
     create_order,
+    create_orders_bulk,
+    insert_orders,
     validate_order,
     get_order,
     check_stock,
+    list_orders,
 )
 
 dirPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -218,6 +222,80 @@ class TestOrderCreate(unittest.IsolatedAsyncioTestCase):
         mock_db_connect.assert_not_called()
         mock_add_order.assert_not_called()
 
+    @patch("src.despatch.orderCreate.dbConnect", new_callable=AsyncMock)
+    @patch("src.despatch.orderCreate.addOrders", new_callable=AsyncMock)
+    async def test_create_orders_bulk_partial_failure(
+        self, mock_add_orders, mock_db_connect
+    ):
+        mock_db_connect.return_value = (self.client, self.db)
+
+        def outcome(index, error=None, duplicate=False):
+            return {
+                "index": index,
+                "inserted_id": None if error else f"id-{index}",
+                "error": error,
+                "code": 11000 if duplicate else None,
+                "duplicate": duplicate,
+            }
+
+        mock_add_orders.return_value = [
+            outcome(0),
+            outcome(1, "E11000 duplicate key", duplicate=True),
+        ]
+
+        bodies = [
+            self.valid_event_body,
+            {"customer_id": "CUST-001"},
+            self.valid_event_body,
+        ]
+        result = await create_orders_bulk(bodies, chunk_size=500)
+
+        self.assertEqual(result["statusCode"], 200)
+        response_body = json.loads(result["body"])
+        self.assertEqual(response_body["created"], 1)
+        self.assertEqual(response_body["failed"], 2)
+
+        results = response_body["results"]
+        self.assertEqual([r["index"] for r in results], [0, 1, 2])
+        self.assertEqual(results[0]["status"], "Order Created")
+        self.assertTrue(results[0]["order_id"].startswith("ORD-"))
+        self.assertIn("missing required fields", results[1]["error"])
+        self.assertEqual(results[2]["error"], "Duplicate order")
+
+        # only the two valid bodies are sent, in one call
+        documents = mock_add_orders.call_args[0][0]
+        self.assertEqual(len(documents), 2)
+        self.assertEqual(mock_add_orders.call_args[1], {"chunkSize": 500})
+        self.client.close.assert_called_once()
+
+    @patch("src.despatch.orderCreate.dbConnect", new_callable=AsyncMock)
+    @patch("src.despatch.orderCreate.addOrders", new_callable=AsyncMock)
+    async def test_insert_orders_uses_given_db(
+        self, mock_add_orders, mock_db_connect
+    ):
+        mock_add_orders.return_value = [
+            {"index": 0, "inserted_id": "id-0", "error": None,
+             "code": None, "duplicate": False},
+        ]
+
+        results, documents = await insert_orders(
+            [{"customer_id": "CUST-001"}, self.valid_event_body], self.db
+        )
+
+        self.assertEqual([r["status"] for r in results],
+                         ["Failed", "Order Created"])
+        self.assertIsNone(documents[0])
+        self.assertEqual(documents[1]["OrderID"], results[1]["order_id"])
+        self.assertIs(mock_add_orders.call_args[0][1], self.db)
+        mock_db_connect.assert_not_called()
+
+    @patch("src.despatch.orderCreate.dbConnect", new_callable=AsyncMock)
+    async def test_create_orders_bulk_invalid_input(self, mock_db_connect):
+        result = await create_orders_bulk({"customer_id": "CUST-001"})
+
+        self.assertEqual(result["statusCode"], 400)
+        mock_db_connect.assert_not_called()
+
     @patch("src.despatch.orderCreate.dbConnect", new_callable=AsyncMock)
     @patch("src.despatch.orderCreate.getOrderInfo", new_callable=AsyncMock)
     async def test_validate_order_valid(self, mock_get_order, mock_db_connect):
@@ -276,6 +354,24 @@ class TestOrderCreate(unittest.IsolatedAsyncioTestCase):
         mock_get_order.assert_called_once_with("ORD-12345", self.db)
         self.client.close.assert_called_once()
 
+    @patch("src.despatch.orderCreate.dbConnect", new_callable=AsyncMock)
+    @patch("src.despatch.orderCreate.getOrderInfo", new_callable=AsyncMock)
+    async def test_get_order_serialises_stored_dates(
+        self, mock_get_order, mock_db_connect
+    ):
+        mock_db_connect.return_value = (self.client, self.db)
+        expiry = datetime.datetime(2025, 6, 1, tzinfo=datetime.timezone.utc)
+        mock_get_order.return_value = dict(self.sample_order, Items=[
+            {"item_id": "ITEM-001", "quantity": 5, "ExpiryDate": expiry},
+        ])
+
+        result = await get_order("ORD-12345")
+
+        self.assertEqual(result["statusCode"], 200)
+        response_body = json.loads(result["body"])
+        self.assertEqual(response_body["items"][0]["ExpiryDate"],
+                         "2025-06-01T00:00:00+00:00")
+
     @patch("src.despatch.orderCreate.dbConnect", new_callable=AsyncMock)
     @patch("src.despatch.orderCreate.getOrderInfo", new_callable=AsyncMock)
     async def test_check_stock_available(
@@ -535,6 +631,51 @@ class TestOrderCreate(unittest.IsolatedAsyncioTestCase):
         mock_db_connect.assert_called_once()
         mock_get_order.assert_not_called()
 
+    @patch("src.despatch.listing.dbConnect", new_callable=AsyncMock)
+    @patch("src.despatch.orderCreate.listOrders", new_callable=AsyncMock)
+    async def test_list_orders_success(self, mock_list_orders, mock_db_connect):
+        mock_db_connect.return_value = (self.client, self.db)
+        created = datetime.datetime(2025, 3, 15, 10,
+                                    tzinfo=datetime.timezone.utc)
+        mock_list_orders.return_value = {
+            "items": [dict(self.sample_order, CreationDate=created)],
+            "next_cursor": "abc",
+        }
+
+        result = await list_orders({
+            "customer_id": "CUST-001", "status": "", "limit": "10",
+            "cursor": "prev",
+        })
+
+        self.assertEqual(result["statusCode"], 200)
+        response_body = json.loads(result["body"])
+        self.assertEqual(response_body["next_cursor"], "abc")
+        self.assertEqual(response_body["orders"][0]["order_id"], "ORD-12345")
+        self.assertNotIn("items", response_body["orders"][0])
+        self.assertEqual(response_body["orders"][0]["creation_date"],
+                         "2025-03-15T10:00:00+00:00")
+        mock_list_orders.assert_called_once_with(
+            self.db, limit=10, cursor="prev", customerId="CUST-001"
+        )
+        self.client.close.assert_called_once()
+
+    @patch("src.despatch.listing.dbConnect", new_callable=AsyncMock)
+    @patch("src.despatch.orderCreate.listOrders", new_callable=AsyncMock)
+    async def test_list_orders_bad_params(
+        self, mock_list_orders, mock_db_connect
+    ):
+        mock_db_connect.return_value = (self.client, self.db)
+
+        result = await list_orders({"limit": "ten"})
+        self.assertEqual(result["statusCode"], 400)
+        mock_list_orders.assert_not_called()
+
+        mock_list_orders.side_effect = ValueError("Invalid cursor.")
+        result = await list_orders({"cursor": "garbage"})
+        self.assertEqual(result["statusCode"], 400)
+        self.assertEqual(json.loads(result["body"])["error"],
+                         "Invalid cursor.")
+
 
 if __name__ == "__main__":
     unittest.main()
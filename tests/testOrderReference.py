@@ -1,5 +1,5 @@
 import unittest
-from src.mongodb import dbConnect, clearDb
+from src.mongodb import dbConnect, clearDb, releaseClient
 from src.despatch.OrderReference\
     import OrderNotFoundError, InvalidOrderReferenceError, \
     create_order_reference
@@ -39,7 +39,7 @@ class TestCreateOrderReference(unittest.IsolatedAsyncioTestCase):
         """Clean up the database after each test."""
         if self.client.close:
             await clearDb(self.db)
-            self.client.close()
+            releaseClient(self.client)
 
     # ============================================
     # Success Tests
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from pymongo import DeleteOne, InsertOne, UpdateOne
+
+import src.mongodb as mongodb
+from src.cache import orderCache
+from src.despatch.orderCreate import create_order, list_orders
+from src.memoryStore import MemoryClient
+from src.queryBudget import (
+    BudgetListener,
+    QueryBudget,
+    QueryBudgetExceeded,
+    currentBudget,
+    queryBudget,
+    recordCommand,
+)
+
+
+class TestQueryBudget(unittest.TestCase):
+    def testCountsOnlyInsideTheBlock(self):
+        recordCommand("find")
+        with QueryBudget() as budget:
+            recordCommand("find")
+            recordCommand("insert")
+            self.assertIs(currentBudget(), budget)
+        recordCommand("find")
+
+        self.assertIsNone(currentBudget())
+        self.assertEqual(budget.report(), {
+            "name": None,
+            "count": 2,
+            "limit": None,
+            "exceeded": False,
+            "commands": {"find": 1, "insert": 1},
+        })
+
+    def testNestedBudgetsBothCount(self):
+        with QueryBudget(name="outer") as outer:
+            recordCommand("find")
+            with QueryBudget(name="inner") as inner:
+                recordCommand("update")
+            self.assertIs(currentBudget(), outer)
+
+        self.assertEqual(inner.count, 1)
+        self.assertEqual(outer.commands, {"find": 1, "update": 1})
+
+    def testStrictBudgetRaisesOnExit(self):
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with QueryBudget(limit=1, strict=True, name="stage"):
+                recordCommand("find")
+                recordCommand("find")
+        self.assertIn("stage issued 2", str(raised.exception))
+
+        with QueryBudget(limit=1, strict=False) as budget:
+            recordCommand("find")
+            recordCommand("find")
+        self.assertTrue(budget.exceeded)
+
+    def testSettleChecksOnceBeforeCommit(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with QueryBudget(limit=1, strict=True) as budget:
+                recordCommand("find")
+                recordCommand("find")
+                budget.settle()
+                self.fail("settle() should have raised")
+
+        with QueryBudget(limit=1, strict=True) as budget:
+            recordCommand("find")
+            budget.settle()
+            # bookkeeping after the result is committed
+            recordCommand("update")
+        self.assertEqual(budget.count, 2)
+
+    def testErrorInsideBlockIsNotMasked(self):
+        with self.assertRaises(KeyError):
+            with QueryBudget(limit=0, strict=True):
+                recordCommand("find")
+                raise KeyError("original")
+
+    def testListenerCountsDriverCommands(self):
+        listener = BudgetListener()
+        with QueryBudget() as budget:
+            for name in ("find", "endSessions", "hello", "insert"):
+                listener.started(SimpleNamespace(command_name=name))
+        self.assertEqual(budget.commands, {"find": 1, "insert": 1})
+
+    @unittest.skipIf(mongodb.DB_BACKEND == "memory",
+                     "needs a Motor client")
+    def testGetClientRegistersListener(self):
+        with patch.dict(mongodb._clients, clear=True):
+            client = mongodb.getClient(
+                "mongodb://localhost:27017/budget"
+                "?serverSelectionTimeoutMS=50"
+            )
+            try:
+                listeners = client.delegate.options.event_listeners
+                self.assertTrue(any(
+                    isinstance(listener, BudgetListener)
+                    for listener in listeners
+                ))
+            finally:
+                client.shutdown()
+
+
+class TestAsyncBudgets(unittest.IsolatedAsyncioTestCase):
+    async def testConcurrentRequestsAreSeparate(self):
+        @queryBudget()
+        async def request(commands):
+            for _ in range(commands):
+                recordCommand("find")
+                await asyncio.sleep(0)
+            return currentBudget().count
+
+        counts = await asyncio.gather(request(1), request(3), request(5))
+        self.assertEqual(counts, [1, 3, 5])
+
+    async def testCountsWorkInThreads(self):
+        async with QueryBudget() as budget:
+            await asyncio.to_thread(recordCommand, "find")
+        self.assertEqual(budget.count, 1)
+
+
+class TestMemoryBackendBudgets(unittest.IsolatedAsyncioTestCase):
+    """'At most N queries' pins, run against the memory backend"""
+
+    async def asyncSetUp(self):
+        orderCache.clear()
+        self.client = MemoryClient()
+        self.db = self.client["ubl_docs"]
+
+    async def asyncTearDown(self):
+        orderCache.clear()
+
+    async def testCommandsAreNamedLikeTheDriver(self):
+        orders = self.db.orders
+        with QueryBudget() as budget:
+            await orders.insert_one({"UUID": "u-1"})
+            await orders.find_one({"UUID": "u-1"})
+            await orders.find({}).to_list(None)
+            await orders.count_documents({})
+            await orders.update_one({"UUID": "u-1"}, {"$set": {"a": 1}})
+            await orders.find_one_and_update(
+                {"UUID": "u-1"}, {"$set": {"a": 2}}
+            )
+            await orders.delete_one({"UUID": "u-1"})
+        self.assertEqual(budget.commands, {
+            "insert": 1, "find": 2, "aggregate": 1, "update": 1,
+            "findAndModify": 1, "delete": 1,
+        })
+
+    async def testBulkWriteIsOneCommandPerBatch(self):
+        requests = [
+            InsertOne({"UUID": "u-1"}),
+            InsertOne({"UUID": "u-2"}),
+            UpdateOne({"UUID": "u-1"}, {"$set": {"a": 1}}),
+            DeleteOne({"UUID": "u-2"}),
+            InsertOne({"UUID": "u-3"}),
+        ]
+        with QueryBudget() as ordered:
+            await self.db.orders.bulk_write(requests)
+        with QueryBudget() as unordered:
+            await self.db.other.bulk_write(requests, ordered=False)
+
+        self.assertEqual(ordered.count, 4)
+        self.assertEqual(unordered.count, 3)
+
+    async def testCachedOrderLookupIsOneQuery(self):
+        await self.db.orders.insert_one({"UUID": "u-1", "OrderID": "ORD-1"})
+        with QueryBudget(limit=1, strict=True) as budget:
+            for _ in range(3):
+                await mongodb.getOrderInfo("ORD-1", self.db)
+        self.assertEqual(budget.commands, {"find": 1})
+
+    @patch.object(mongodb, "ENSURE_INDEXES", False)
+    @patch.object(mongodb, "DB_BACKEND", "memory")
+    async def testCreateAndListOrders(self):
+        with patch.dict(mongodb._clients, clear=True):
+            with QueryBudget(limit=1, strict=True):
+                created = await create_order({
+                    "customer_id": "C-1",
+                    "items": [{"item_id": "I-1", "quantity": 1}],
+                })
+            self.assertEqual(created["statusCode"], 200)
+
+            with QueryBudget(limit=1, strict=True):
+                listed = await list_orders({"customer_id": "C-1"})
+            self.assertEqual(len(json.loads(listed["body"])["orders"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
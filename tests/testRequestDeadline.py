@@ -0,0 +1,146 @@
+import asyncio
+import json
+import threading
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import pymongo.errors
+from pymongo import _csot
+
+from src.admission import AdmissionLimiter
+from src.despatch.despatchCreate import send_despatch_notification
+from src.requestDeadline import (
+    DeadlineExceeded,
+    RequestDeadline,
+    isTimeout,
+    remaining,
+    timeoutFor,
+    withDeadline,
+)
+
+
+class TestRequestDeadline(unittest.IsolatedAsyncioTestCase):
+    def testNoDeadline(self):
+        self.assertIsNone(remaining())
+        self.assertEqual(timeoutFor(15), 15)
+
+    def testNestedDeadlineOnlyShortens(self):
+        with RequestDeadline(10):
+            with RequestDeadline(60):
+                self.assertLessEqual(remaining(), 10)
+            with RequestDeadline(1):
+                self.assertLessEqual(remaining(), 1)
+                self.assertLessEqual(timeoutFor(15), 1)
+        self.assertIsNone(remaining())
+
+    async def testMongoTimeoutReachesDriverThreads(self):
+        with RequestDeadline(5):
+            left = await asyncio.to_thread(_csot.remaining)
+        self.assertIsNotNone(left)
+        self.assertLessEqual(left, 5)
+        self.assertIsNone(_csot.remaining())
+
+    def testIsTimeout(self):
+        self.assertTrue(isTimeout(DeadlineExceeded()))
+        self.assertTrue(isTimeout(pymongo.errors.ExecutionTimeout("slow")))
+        self.assertFalse(isTimeout(pymongo.errors.OperationFailure("bad")))
+        self.assertFalse(isTimeout(ValueError()))
+
+    async def testSlowEntryPointGets504(self):
+        @withDeadline(0.01)
+        async def slow():
+            await asyncio.sleep(1)
+            return {"statusCode": 200, "body": "{}"}
+
+        response = await slow()
+        self.assertEqual(response["statusCode"], 504)
+
+    async def testFastEntryPointIsUntouched(self):
+        @withDeadline(1)
+        async def fast():
+            return {"statusCode": 500, "body": "{}"}
+
+        self.assertEqual((await fast())["statusCode"], 500)
+
+    async def testLateServerErrorIsTimeout(self):
+        @withDeadline(0.01)
+        async def swallowsTimeout():
+            # a stage that caught the Mongo timeout itself
+            await asyncio.sleep(0.02)
+            return {"statusCode": 500, "body": "{}"}
+
+        with patch(
+            "src.requestDeadline.withinDeadline",
+            lambda awaitable, stage=None: awaitable,
+        ):
+            response = await swallowsTimeout()
+        self.assertEqual(response["statusCode"], 504)
+
+    async def testDeadlineArgumentOverrides(self):
+        @withDeadline(0.01)
+        async def slow(deadline=None):
+            await asyncio.sleep(0.05)
+            return {"statusCode": 200, "body": json.dumps(remaining())}
+
+        response = await slow(deadline=5)
+        self.assertEqual(response["statusCode"], 200)
+
+
+class TestNotificationDeadline(unittest.IsolatedAsyncioTestCase):
+    async def testSmtpDeadlineIs504(self):
+        despatch = {"ID": "D-1", "XMLData": "<DespatchAdvice/>"}
+        patches = [
+            patch("src.despatch.despatchCreate.getDespatchAdvice",
+                  AsyncMock(return_value=despatch)),
+            patch("src.despatch.despatchCreate.load_despatch_xml",
+                  AsyncMock(return_value="<DespatchAdvice/>")),
+            patch("src.despatch.despatchCreate.stored_or_rendered_pdf",
+                  AsyncMock(return_value=b"%PDF")),
+            patch("src.utils.email_sender.SENDER_EMAIL", "a@b.c"),
+            patch("src.utils.email_sender.SENDER_PASSWORD", "secret"),
+            # the deadline itself is far away: only the SMTP check fails
+            patch("src.utils.email_sender.checkDeadline",
+                  side_effect=DeadlineExceeded("smtp")),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        response = await send_despatch_notification("D-1", "x@y.z")
+
+        self.assertEqual(response["statusCode"], 504)
+        self.assertEqual(json.loads(response["body"])["stage"], "smtp")
+
+
+class TestAdmissionDeadline(unittest.IsolatedAsyncioTestCase):
+    async def testQueueWaitEndsAtDeadline(self):
+        limiter = AdmissionLimiter("test", 1, queueSize=4, maxWait=5)
+        await limiter.acquire()
+
+        with RequestDeadline(0.01):
+            with self.assertRaises(DeadlineExceeded) as raised:
+                await limiter.acquire()
+
+        self.assertEqual(raised.exception.stage, "test_queue")
+        limiter.release()
+        self.assertEqual(limiter.snapshot()["active"], 0)
+
+    async def testAbandonedRenderKeepsItsSlot(self):
+        limiter = AdmissionLimiter("test", 1)
+        release = threading.Event()
+
+        with RequestDeadline(0.01):
+            with self.assertRaises(DeadlineExceeded):
+                await limiter.run(release.wait)
+
+        self.assertEqual(limiter.snapshot()["active"], 1)
+        release.set()
+        for _ in range(100):
+            if not limiter.snapshot()["active"]:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(limiter.snapshot()["active"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,4 @@
-from src.mongodb import dbConnect, clearDb
+from src.mongodb import dbConnect, clearDb, releaseClient
 from src.despatch.shipment import create_shipment, setup_indexes
 import unittest
 import json
@@ -38,7 +38,7 @@ class TestShipmentCreation(unittest.IsolatedAsyncioTestCase):
         """Clean up after each test."""
         if self.client:
             await self.shipments.delete_many({})
-            self.client.close()
+            releaseClient(self.client)
     # ============================================
     # ============================================
 
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import unittest
+
+from src.stageTiming import (
+    StageTimer,
+    currentTimer,
+    resetStageStats,
+    stage,
+    stageStatsSnapshot,
+    timed,
+)
+
+
+class TestStageTimer(unittest.TestCase):
+    def setUp(self):
+        resetStageStats()
+
+    def tearDown(self):
+        resetStageStats()
+
+    def testStagesAddUp(self):
+        timer = StageTimer("test")
+        with timer:
+            with stage("xml"):
+                pass
+            with stage("xml"):
+                pass
+            self.assertIs(currentTimer(), timer)
+        self.assertIsNone(currentTimer())
+
+        timer.timings["xml"] = 1.5
+        timer.add("xml", 1.0)
+        self.assertEqual(timer.timings, {"xml": 2.5})
+
+    def testStageWithoutTimerIsNoop(self):
+        with stage("xml"):
+            pass
+        self.assertIsNone(currentTimer())
+
+    def testFinishAddsHeaderAndTimings(self):
+        timer = StageTimer("test")
+        with timer:
+            timer.add("validate", 2.25)
+        response = timer.finish(
+            {"statusCode": 200, "body": json.dumps({"ok": True}),
+             "headers": {"Content-Type": "application/json"}},
+            include_timings=True,
+        )
+
+        header = response["headers"]["Server-Timing"]
+        self.assertTrue(header.startswith("validate;dur=2.2"))
+        self.assertIn(", total;dur=", header)
+        self.assertEqual(
+            response["headers"]["Content-Type"], "application/json"
+        )
+        body = json.loads(response["body"])
+        self.assertEqual(body["timings"]["validate"], 2.25)
+        self.assertIn("total", body["timings"])
+
+    def testTimingsFieldIsOptional(self):
+        timer = StageTimer("test")
+        with timer:
+            pass
+        response = timer.finish({"statusCode": 200, "body": "{}"})
+        self.assertEqual(response["body"], "{}")
+        self.assertIn("Server-Timing", response["headers"])
+
+    def testAggregatePercentiles(self):
+        for ms in (1, 2, 3, 40):
+            timer = StageTimer("test")
+            with timer:
+                timer.add("create_order", ms)
+            timer.finish({})
+
+        snapshot = stageStatsSnapshot()["test"]
+        self.assertEqual(snapshot["create_order"]["count"], 4)
+        self.assertEqual(snapshot["create_order"]["max_ms"], 40)
+        self.assertEqual(snapshot["total"]["count"], 4)
+
+
+class TestConcurrentStages(unittest.IsolatedAsyncioTestCase):
+    async def testTaskGroupStagesShareTheTimer(self):
+        timer = StageTimer("test")
+        with timer:
+            async with asyncio.TaskGroup() as stages:
+                stages.create_task(timed("supplier", asyncio.sleep(0.01)))
+                stages.create_task(timed("customer", asyncio.sleep(0.01)))
+
+        self.assertEqual(set(timer.timings), {"supplier", "customer"})
+        self.assertGreaterEqual(timer.timings["supplier"], 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
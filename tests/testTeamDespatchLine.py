@@ -2,7 +2,7 @@ import unittest
 from src.despatch.despatchLine import despatchLine
 import os
 import datetime
-from src.mongodb import dbConnect, addOrder
+from src.mongodb import dbConnect, addOrder, deleteOrder, releaseClient
 import asyncio
 import json
 
@@ -22,19 +22,30 @@ class TestDespatchSupplier(unittest.TestCase):
     # was used to create these tests
 
     def setUp(self):
-        self.client, self.db = asyncio.run(dbConnect())
-        self.orders = self.db["orders"]
-
         data = {}
         with open(filePath, "r") as file:
             data = json.load(file)
 
-        asyncio.run(addOrder(data, self.orders))
+        async def insert():
+            client, db = await dbConnect()
+            try:
+                # left over by an earlier run, OrderID is unique
+                await deleteOrder(data["UUID"], db)
+                await addOrder(data, db)
+            finally:
+                releaseClient(client)
+
+        asyncio.run(insert())
 
     def tearDown(self):
-        # Make sure we close the client
-        if hasattr(self, "client") and self.client:
-            self.client.close()
+        async def remove():
+            client, db = await dbConnect()
+            try:
+                await deleteOrder(TEST_UUID, db)
+            finally:
+                releaseClient(client)
+
+        asyncio.run(remove())
 
     def testDespatchLineReturn(self):
         # Test invalid UUID case
@@ -0,0 +1,54 @@
+import unittest
+import zlib
+from unittest.mock import patch
+
+from bson import Binary
+
+import src.despatch.xmlStorage as xmlStorage
+from src.despatch.xmlStorage import (
+    compress_xml,
+    decode_xml,
+    encode_xml,
+)
+
+
+class TestXmlStorage(unittest.TestCase):
+    def setUp(self):
+        line = "    <cac:DespatchLine><cbc:ID>1</cbc:ID></cac:DespatchLine>\n"
+        self.xml = f"<DespatchAdvice>\n{line * 50}</DespatchAdvice>"
+
+    def test_round_trip(self):
+        stored = encode_xml(self.xml)
+
+        self.assertIsInstance(stored, Binary)
+        self.assertLess(len(stored), len(self.xml))
+        self.assertEqual(decode_xml(stored), self.xml)
+
+    def test_zlib_round_trip(self):
+        stored = encode_xml(self.xml, method="zlib")
+
+        self.assertEqual(zlib.decompress(stored).decode("utf-8"), self.xml)
+        self.assertEqual(decode_xml(stored), self.xml)
+
+    def test_short_xml_stays_plain(self):
+        self.assertEqual(encode_xml("<a/>"), "<a/>")
+
+    def test_compression_disabled(self):
+        self.assertEqual(compress_xml(self.xml, method="none"), self.xml)
+
+    def test_zstd_falls_back_to_zlib(self):
+        with patch.object(xmlStorage, "zstandard", None):
+            stored = encode_xml(self.xml, method="zstd")
+        self.assertEqual(decode_xml(stored), self.xml)
+
+    def test_legacy_documents(self):
+        self.assertEqual(decode_xml(self.xml), self.xml)
+        self.assertEqual(decode_xml(None), "")
+
+    def test_unknown_bytes(self):
+        with self.assertRaises(ValueError):
+            decode_xml(b"not compressed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,4 @@
-from src.mongodb import dbConnect, clearDb, addOrder
+from src.mongodb import dbConnect, clearDb, addOrder, releaseClient
 from src.despatch.deliveryCustomer import deliveryCustomer
 import unittest
 import json
@@ -26,7 +26,7 @@ class TestDeliveryCustomer(unittest.IsolatedAsyncioTestCase):
     async def asyncTearDown(self):
         if self.client.close:
             await clearDb(self.db)
-            self.client.close()
+            releaseClient(self.client)
     # ============================================
     # ============================================
 